@@ -1,35 +1,481 @@
-import matplotlib
-matplotlib.use("Agg")
+import os
+# The plotting stack is only imported by load_app(), in the background;
+# the Agg backend is picked through the environment so it applies then,
+# and in the render pool workers
+os.environ.setdefault('MPLBACKEND', 'Agg')
 
-from shiny import App, ui, render, reactive
+from shiny import App, ui, render, reactive, req
+from shiny.types import SilentCancelOutputException
 # from shinywidgets import output_plotly, render_plotly
-from plotnine import ggplot, aes, geom_bar, geom_line, geom_point, geom_text
-from plotnine import theme_minimal, theme, labs, scale_x_continuous, scale_y_continuous, element_text, coord_flip
-import matplotlib.pyplot as plt 
 import pandas as pd
-import numpy as np
-import os
+import asyncio
+import atexit
+import glob
+import threading
+from contextlib import asynccontextmanager
+
+from dataset_cache import (
+    CACHE_DIR, DATA_DIR, DIMENSIONS_PATH, INCOMING_DIR, cached_fingerprint, concat_frames, ensure_cache, load_dataset,
+    read_customer_csv, read_sales_csv, read_sales_rows, read_mall_csv, source_fingerprint
+)
+from shared_frame import SharedFrame, attach_feather, cached_array, cached_frame, freeze_frame
+from aggregates import (
+    DATE_WINDOWS, MONTHS, add_to_sales_cube, build_sales_cube, daily_totals, date_window, day_range, month_range,
+    slice_cube, month_number, summarize, summary_years, year_range
+)
+from customers import CUSTOMER_ATTRIBUTE_LABELS, CustomerTable, add_to_customer_cube, build_customer_cube
+from stream_loader import ensure_stream_cache, stream_fingerprint
+from segments import SegmentationJob, segment_customers
+from debounce import DebouncedInputs
+from render_cache import PLOT_CACHE, RENDER_POOL, AccessLog, plot_key, plot_png, png_image_data, render_plot_png, warm_up
+from metrics import cache_result, draw_phase, gauge_lines, instrument, metrics_endpoint
+from startup import STARTUP
+from dimensions import Dimensions
+from exports import EXPORT_FORMATS, export, export_filename, export_totals, sales_chunks
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+
+# With MALL_SHARED_DATA=1 the sales frame is memory-mapped from its cache,
+# so several worker processes share one copy of it (see shared_frame.py)
+SHARED_DATA = os.environ.get('MALL_SHARED_DATA', '0') == '1'
+# With MALL_STREAMING_LOAD=1 sales_data.csv is read in chunks under a memory
+# ceiling, keeping only the columns the dashboard needs (see stream_loader.py)
+STREAMING_LOAD = os.environ.get('MALL_STREAMING_LOAD', '0') == '1'
+
+def prepare_datasets(data_dir=DATA_DIR):
+    """
+    Loads the sales, joined once to their customer through its surrogate
+    customer_key, the mall details and the customers, aggregates the sales
+    cube and the customer cube, and indexes the malls, categories, years and
+    months of the sales (see dimensions.py)
+    """
+    sales_path = os.path.join(data_dir, 'sales_data.csv')
+    mall_path = os.path.join(data_dir, 'shopping_mall_data.csv')
+    customer_path = os.path.join(data_dir, 'customer_data.csv')
+
+    customers = CustomerTable(load_dataset(customer_path, read_customer_csv))
+    # Years and months are date ranges of the sorted invoice_date, found by
+    # binary search, so only the mall and category need an index
+    index_columns = ['shopping_mall', 'category']
+    if STREAMING_LOAD:
+        kept_path, cube_path, customer_cube_path = ensure_stream_cache(sales_path, customer_path, customers)
+        sales = SharedFrame.attach(kept_path, index_columns=index_columns, sorted_by='invoice_date')
+        cube = attach_feather(cube_path)
+        customer_cube = attach_feather(customer_cube_path)
+    elif SHARED_DATA:
+        # The join and the cubes are saved next to the cache by the first
+        # worker, the others map or read them
+        feather_path = ensure_cache(sales_path, read_sales_csv)
+        sources = [feather_path, ensure_cache(customer_path, read_customer_csv)]
+        base = os.path.splitext(feather_path)[0]
+        sales = SharedFrame.attach(feather_path, index_columns=index_columns, sorted_by='invoice_date')
+        keys = cached_array(base + '.customer_key.npy', sources, lambda: customers.keys(sales.rows()['customer_id']))
+        sales = sales.with_columns(customer_key=keys)
+        cube = cached_frame(base + '.cube.feather', sources, lambda: build_sales_cube(sales.rows()))
+        customer_cube = cached_frame(
+            base + '.customer_cube.feather', sources, lambda: build_customer_cube(sales.rows(), customers)
+        )
+    else:
+        df = load_dataset(sales_path, read_sales_csv)
+        sales = SharedFrame(
+            df.assign(customer_key=customers.keys(df['customer_id'])), index_columns=index_columns, sorted_by='invoice_date'
+        )
+        cube = build_sales_cube(sales.rows())
+        customer_cube = build_customer_cube(sales.rows(), customers)
+    mall_details = load_dataset(mall_path, read_mall_csv)
+
+    return (
+        sales,
+        SharedFrame(mall_details, index_columns=['shopping_mall']),
+        freeze_frame(cube),
+        customers,
+        freeze_frame(customer_cube),
+        Dimensions.build(sales, cube)
+    )
+
+# The date range filter of daily_revenue, as a plain function of the shared
+# data so it can also be timed outside a session (benchmark.py)
+def filter_date_range(frame, first, last, mall):
+    """
+    The sales from the first to the last day (both included), of one mall or 'All'
+    """
+    if mall == 'All':
+        return frame.rows_between(*day_range(first, last))
+    return frame.rows_between(*day_range(first, last), shopping_mall=[mall])
+
+def cube_year_mall(cube, year, mall):
+    """
+    The rows of the cube of a year (every year when None) and a mall (every mall when 'All')
+    """
+    return slice_cube(cube, year=None if year is None else int(year), malls=None if mall == 'All' else [mall])
+
+# The shared data, loaded in the background by load_app()
+mall_revenue_data = mall_details = sales_cube = customers = customer_cube = dimensions = None
+# The dimensions of the data loaded last time (or prebuilt by dataset_cache.py),
+# which the pickers of app_ui are built with
+ui_dimensions = Dimensions.load(DIMENSIONS_PATH) or Dimensions([], [], {})
+# Part of every render cache key, bumped whenever the shared data changes
+data_version = 1
+
+# New sales are picked up while the app runs, from rows appended to
+# sales_data.csv and from CSV files dropped into Datasets/incoming
+SALES_PATH = os.path.join(DATA_DIR, 'sales_data.csv')
+sales_ingested_size = None
+ingested_files = set()
+# ingest_lock is held only to swap in the shared data, so sessions never wait
+# for an ingestion; ingestions run one at a time under ingesting
+ingest_lock = threading.Lock()
+ingesting = threading.Lock()
+
+def sales_fingerprint(sales_path=SALES_PATH):
+    """
+    The fingerprint of the sales file the loaded cache was built from, whose
+    size is where reading appended rows starts
+    """
+    return stream_fingerprint(sales_path) if STREAMING_LOAD else cached_fingerprint(sales_path)
+
+def ingest_new_sales():
+    """
+    Adds the sales rows that arrived since the last call to the shared data,
+    updating the aggregate cube from the new rows only, and bumps data_version
+    when anything was added. The new data is built aside from the current
+    one, which sessions keep reading meanwhile, and swapped in at the end.
+    Returns the current data_version.
+    """
+    global mall_revenue_data, sales_cube, customers, customer_cube, dimensions, data_version
+    global sales_ingested_size, ingested_files
+    with ingesting:
+        sales, cube, table, table_cube, dims = mall_revenue_data, sales_cube, customers, customer_cube, dimensions
+        offset, files, changed = sales_ingested_size, set(ingested_files), False
+        new_rows = []
+        size = os.path.getsize(SALES_PATH)
+        if size < offset:
+            # sales_data.csv was replaced rather than appended to, so start over
+            sales, _, cube, table, table_cube, dims = prepare_datasets()
+            offset, files, changed = sales_fingerprint()['size'], set(), True
+        elif size > offset:
+            rows, offset = read_sales_rows(SALES_PATH, offset)
+            new_rows.append(rows)
+
+        for path in sorted(glob.glob(os.path.join(INCOMING_DIR, '*.csv'))):
+            if path not in files:
+                new_rows.append(read_sales_csv(path))
+                files.add(path)
+
+        new_rows = [rows for rows in new_rows if len(rows)]
+        if new_rows:
+            rows = concat_frames(*new_rows)
+            rows = rows.assign(customer_key=table.keys(rows['customer_id']))
+            cube = freeze_frame(add_to_sales_cube(cube, rows))
+            table_cube = freeze_frame(add_to_customer_cube(table_cube, rows, table))
+            # Only the columns the shared frame keeps (see stream_loader.py)
+            sales = sales.merged(rows[list(sales.columns)])
+            # The new sales may bring new malls, categories or months
+            dims = Dimensions.build(sales, cube)
+            changed = True
+        if changed:
+            dims.save(DIMENSIONS_PATH)
+
+        with ingest_lock:
+            mall_revenue_data, sales_cube, customers, customer_cube, dimensions = sales, cube, table, table_cube, dims
+            sales_ingested_size, ingested_files = offset, files
+            if changed:
+                data_version += 1
+            return data_version
+
+def poll_new_sales():
+    """
+    What every session polls: the data_version, once the data is loaded
+    starting ingest_new_sales() in a thread unless one is running, so new
+    sales are never read nor merged on the event loop. The data_version it
+    bumps is picked up by the next poll. (Not awaited with asyncio.to_thread,
+    since polls run within the reactive flush every session waits for.)
+    """
+    if STARTUP.ready and not ingesting.locked():
+        threading.Thread(target=ingest_new_sales, name='ingest', daemon=True).start()
+    return data_version
+
+# The customer segments, computed in the background once per data_version
+SEGMENTS = SegmentationJob()
+
+def request_segmentation():
+    """
+    Starts segmenting the customers of the current data_version, unless it
+    is done or in progress already. Returns that data_version.
+    """
+    with ingest_lock:
+        sales, table, version = mall_revenue_data, customers, data_version
+    SEGMENTS.request(version, lambda: segment_customers(sales.rows(), table))
+    return version
+
+# The Mall Details charts don't depend on any input, so they are rendered once
+# at a fixed size and scaled into every session's output
+MALL_PATH = os.path.join(DATA_DIR, 'shopping_mall_data.csv')
+STATIC_PLOTS = {}
+STATIC_PLOT_SIZE = (1100, 400)
+STATIC_PLOT_PIXELRATIO = 2
+static_plots_lock = threading.Lock()
+
+def prerender_static_plots():
+    """
+    Renders every chart in STATIC_PLOTS from the current mall_details,
+    returning their PNGs and the fingerprint of the mall CSV they were drawn from
+    """
+    width, height = STATIC_PLOT_SIZE
+    df = mall_details.rows()
+    pngs = {
+        output_id: render_plot_png(build(df), width, height, STATIC_PLOT_PIXELRATIO)
+        for output_id, build in STATIC_PLOTS.items()
+    }
+    return pngs, source_fingerprint(MALL_PATH, with_hash=False)
+
+def static_plot(output_id):
+    """
+    Returns the prerendered PNG of a static chart, reloading the mall details
+    and rendering the charts again only when shopping_mall_data.csv changed
+    """
+    global mall_details, static_plots, static_plots_fingerprint
+    with static_plots_lock:
+        if source_fingerprint(MALL_PATH, with_hash=False) != static_plots_fingerprint:
+            mall_details = SharedFrame(load_dataset(MALL_PATH, read_mall_csv), index_columns=['shopping_mall'])
+            static_plots, static_plots_fingerprint = prerender_static_plots()
+        return static_plots[output_id]
+
+static_plots, static_plots_fingerprint = {}, None
+
+# The input-dependent charts, each a function of the aggregate cube and its inputs,
+# looked up in charts.py by load_plotting()
+CHART_IDS = [
+    'line_monthly_revenue', 'bar_mall_revenue',
+    'one_month_categorical_sales', 'one_month_categorical_quantity', 'one_month_categorical_revenue',
+    'monthly_categorical_sales', 'monthly_mall_category_sales',
+    'revenue_by_age_band', 'revenue_by_gender', 'revenue_by_payment_method', 'customer_revenue_per_mall',
+    'daily_revenue', 'segment_sizes', 'segment_revenue_per_mall',
+]
+CHARTS = {}
+# The charts of the Customers tab are drawn from the customer cube, the others from the sales cube
+CUSTOMER_CHARTS = {'revenue_by_age_band', 'revenue_by_gender', 'revenue_by_payment_method', 'customer_revenue_per_mall'}
+# The charts of the Customer Segments tab, and which part of the segmentation they draw
+SEGMENT_CHARTS = {'segment_sizes': 'profiles', 'segment_revenue_per_mall': 'cube'}
+# The charts drawn from the summary of the year and mall slice of the sales cube,
+# which is also what the cards of their tab read
+SUMMARY_CHARTS = {
+    'line_monthly_revenue', 'one_month_categorical_sales', 'one_month_categorical_quantity', 'one_month_categorical_revenue'
+}
+# The charts comparing the tuple of years picked, whose summary holds every year
+YEAR_COMPARISON_CHARTS = {'line_monthly_revenue', 'bar_mall_revenue'}
+
+def chart_data(sources, output_id, *inputs):
+    """
+    The data a chart is drawn from, out of sources (see data_sources()): a
+    cube, a slice of it or the summary of one, a part of the segmentation, or
+    for daily_revenue the daily totals of its date range
+    """
+    if output_id in SUMMARY_CHARTS:
+        year, mall = inputs[:2]
+        return summarize(cube_year_mall(sources['cube'], None if output_id in YEAR_COMPARISON_CHARTS else year, mall))
+    if output_id == 'daily_revenue':
+        first, last, mall = inputs
+        return daily_totals(filter_date_range(sources['sales'], first, last, mall), first, last)
+    if output_id == 'monthly_categorical_sales':
+        mall, = inputs
+        return cube_year_mall(sources['cube'], None, mall)
+    if output_id in SEGMENT_CHARTS:
+        return sources['segments'][SEGMENT_CHARTS[output_id]]
+    return sources['customer_cube'] if output_id in CUSTOMER_CHARTS else sources['cube']
+
+def data_sources(version=None):
+    """
+    The shared data the charts are drawn from, with the last segmentation done
+    up to version, the data_version a session polled (the current one by default)
+    """
+    with ingest_lock:
+        return {
+            'sales': mall_revenue_data, 'cube': sales_cube, 'customer_cube': customer_cube,
+            'segments': SEGMENTS.latest(data_version if version is None else version),
+        }
+
+# How the input-dependent charts are drawn, set per deployment:
+#   png     PNGs drawn on the server with plotnine (cached, see render_cache.py)
+#   client  small Vega-Lite specs drawn by the browser (see client_charts.py)
+CHART_MODE = os.environ.get('MALL_CHART_MODE', 'png')
+if CHART_MODE not in ('png', 'client'):
+    raise ValueError(f"MALL_CHART_MODE must be 'png' or 'client', not {CHART_MODE!r}")
+
+# With MALL_PROGRESSIVE=1, a png mode chart not in PLOT_CACHE yet is first sent
+# as its Vega-Lite spec, drawn by the browser with a Preliminary badge within
+# a few ms of the input change, then replaced by its PNG once drawn
+PROGRESSIVE = CHART_MODE == 'png' and os.environ.get('MALL_PROGRESSIVE', '0') == '1'
+
+if CHART_MODE == 'client' or PROGRESSIVE:
+    # The specs are built from the series of charts.py, so these modes
+    # import the plotting stack with the app
+    import client_charts
+CLIENT_CHARTS = {}
+if PROGRESSIVE:
+    chart_renderer = client_charts.progressive_chart
+else:
+    chart_renderer = plot_png if CHART_MODE == 'png' else client_charts.vega_chart
+
+def output_chart(id):
+    if PROGRESSIVE:
+        return client_charts.output_progressive(id)
+    if CHART_MODE == 'png':
+        return ui.output_plot(id)
+    return client_charts.output_vega(id)
+
+def export_card(prefix, rows_label, totals_label):
+    """
+    The Export card of a view: its format, and the download buttons of its
+    sales (<prefix>_export_rows) and of their totals (<prefix>_export_totals)
+    """
+    return ui.card(
+        ui.card_header('Export'),
+        ui.input_radio_buttons(
+            id=f'{prefix}_export_format',
+            label='Format',
+            choices={'csv': 'CSV', 'parquet': 'Parquet'},
+            selected='csv',
+            inline=True
+        ),
+        ui.download_button(f'{prefix}_export_rows', rows_label),
+        ui.download_button(f'{prefix}_export_totals', totals_label)
+    )
+
+# The choices of the pickers, from the malls, years and months of a Dimensions
+def mall_choices(dims, with_all=True):
+    return (['All'] if with_all else []) + dims.malls
+
+def month_choices(dims, year):
+    return ['All'] + [MONTHS[month - 1] for month in dims.months.get(year, range(1, 13))]
 
-def prepare_datasets():
-    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-    DATA_DIR = os.path.join(BASE_DIR, "Datasets")
-    sales_path = os.path.join(DATA_DIR, 'sales_data.csv')
-    mall_path = os.path.join(DATA_DIR, 'shopping_mall_data.csv')
+def mall_details_html(rows):
+    """
+    The details of the mall of rows (its rows of the shared mall_details) as a list
+    """
+    df = rows[
+        ['shopping_mall', 'construction_year', 'area (sqm)', 'location', 'store_count']
+    ].set_axis(['Shopping Mall', 'Construction Year', 'Area (sqm)', 'Location', 'Store Count'], axis=1)
+    df['Area (sqm)'] = df['Area (sqm)'].apply(lambda x: f'{x:,}')
+    items = "".join(
+        f"<strong>{col}:</strong> {df[col].iloc[0]}"
+        f"<br>"
+        for col in df.columns
+    )[0:-4]
 
-    mall = pd.read_csv(sales_path)
+    return ui.HTML(f"<ul style='padding-left:0; list-style:none;'>{items}</ul>")
 
-    mall['invoice_date'] = pd.to_datetime(mall['invoice date'])
-    mall['Month'] = mall['invoice_date'].dt.month
-    mall['Year'] = mall['invoice_date'].dt.year
+# The default selections of the input pickers, i.e. the view every session loads first
+DEFAULT_DETAILS_MALL = 'Beverly Center'
+DEFAULT_YEAR = '2023'
+DEFAULT_YEARS = (DEFAULT_YEAR,)
+DEFAULT_MALL = 'All'
+DEFAULT_MONTH = 'January'
+DEFAULT_PLOT_MALLS = ('Beverly Center', 'Del Amo Fashion Center')
+DEFAULT_PLOT_CATEGORY = 'Clothing'
+DEFAULT_CUSTOMER_ATTRIBUTE = 'age_band'
+DEFAULT_WINDOW = '90'
+# The Date Range Picker starts on the year of the last sale, from
+# ui_dimensions until load_app() sets it from the loaded sales
+DEFAULT_DATE_RANGE = DEFAULT_WINDOW_DAYS = None
+DEFAULT_VIEW = {
+    'line_monthly_revenue': (DEFAULT_YEARS, DEFAULT_MALL),
+    'bar_mall_revenue': (DEFAULT_YEARS,),
+    'one_month_categorical_sales': (DEFAULT_YEAR, DEFAULT_MALL, DEFAULT_MONTH),
+    'one_month_categorical_quantity': (DEFAULT_YEAR, DEFAULT_MALL, DEFAULT_MONTH),
+    'one_month_categorical_revenue': (DEFAULT_YEAR, DEFAULT_MALL, DEFAULT_MONTH),
+    'monthly_categorical_sales': (DEFAULT_MALL,),
+    'monthly_mall_category_sales': (DEFAULT_YEAR, DEFAULT_PLOT_MALLS, DEFAULT_PLOT_CATEGORY),
+    'revenue_by_age_band': (DEFAULT_YEAR, DEFAULT_MALL),
+    'revenue_by_gender': (DEFAULT_YEAR, DEFAULT_MALL),
+    'revenue_by_payment_method': (DEFAULT_YEAR, DEFAULT_MALL),
+    'customer_revenue_per_mall': (DEFAULT_YEAR, DEFAULT_CUSTOMER_ATTRIBUTE),
+    'daily_revenue': None,
+    'segment_sizes': (),
+    'segment_revenue_per_mall': (DEFAULT_YEAR,),
+}
 
-    mall = mall.drop(["invoice date"], axis=1)
-    mall = mall.sort_values("invoice_date")
+def use_last_sale_day(last_day):
+    """
+    Sets DEFAULT_DATE_RANGE and the default view of daily_revenue from the day of the last sale
+    """
+    global DEFAULT_DATE_RANGE, DEFAULT_WINDOW_DAYS
+    last_day = pd.Timestamp(last_day).normalize()
+    DEFAULT_DATE_RANGE = (last_day.replace(month=1, day=1), last_day)
+    DEFAULT_WINDOW_DAYS = tuple(day.date().isoformat() for day in date_window(DEFAULT_WINDOW, *DEFAULT_DATE_RANGE))
+    DEFAULT_VIEW['daily_revenue'] = (*DEFAULT_WINDOW_DAYS, DEFAULT_MALL)
 
-    mall_details = pd.read_csv(mall_path)
+if ui_dimensions.last_day is not None:
+    use_last_sale_day(ui_dimensions.last_day)
+# The range the Date Range Picker of app_ui is built with, None before any data was loaded
+ui_date_range = DEFAULT_DATE_RANGE
 
-    return mall.copy(deep=True), mall_details.copy(deep=True)
+# Size used for the default view until the access log knows the usual one
+DEFAULT_PLOT_SIZE = (800, 400, 1.0)
 
-mall_revenue_data, mall_details = prepare_datasets()
+access_log = AccessLog(os.path.join(CACHE_DIR, 'access_log.json'))
+atexit.register(access_log.save)
+atexit.register(RENDER_POOL.shutdown)
+
+def warm_up_plot_cache(top_n):
+    """
+    Renders the default view and the top_n most requested views of the
+    access log into PLOT_CACHE, so the first paint of a session is a cache hit.
+    The segment charts are left out, their data is still being computed.
+    """
+    views = [
+        (output_id, inputs, *(access_log.common_size(output_id) or DEFAULT_PLOT_SIZE))
+        for output_id, inputs in DEFAULT_VIEW.items() if output_id not in SEGMENT_CHARTS
+    ]
+    views += [view for view in access_log.top(top_n) if view[0] in CHARTS and view[0] not in SEGMENT_CHARTS]
+    sources = data_sources()
+    warm_up(views, lambda output_id, *inputs: chart_data(sources, output_id, *inputs), CHARTS, data_version, pool=RENDER_POOL)
+
+def load_plotting():
+    """
+    Imports the plotting stack and looks up the chart functions
+    """
+    import charts
+    STATIC_PLOTS.update(mall_store_count=charts.mall_store_count, mall_area=charts.mall_area)
+    CHARTS.update({output_id: getattr(charts, output_id) for output_id in CHART_IDS})
+    if CHART_MODE == 'client' or PROGRESSIVE:
+        CLIENT_CHARTS.update({output_id: getattr(client_charts, output_id) for output_id in CHART_IDS})
+
+def load_app():
+    """
+    Everything the outputs need that is too slow for the import of this
+    module, run in the background by STARTUP (see startup.py)
+    """
+    global mall_revenue_data, mall_details, sales_cube, customers, customer_cube, dimensions, sales_ingested_size
+    global static_plots, static_plots_fingerprint
+    with STARTUP.step('plotting'):
+        load_plotting()
+    with STARTUP.step('datasets'):
+        mall_revenue_data, mall_details, sales_cube, customers, customer_cube, dimensions = prepare_datasets()
+        dimensions.save(DIMENSIONS_PATH)
+        sales_ingested_size = sales_fingerprint()['size']
+        ingest_new_sales()
+    request_segmentation()
+    with STARTUP.step('static_plots'):
+        static_plots, static_plots_fingerprint = prerender_static_plots()
+
+    use_last_sale_day(dimensions.last_day)
+
+def start_loading():
+    """
+    Starts load_app() in the background, then the warm-up of the plot cache.
+    Run by the startup of the app (see lifespan()) rather than at import, so
+    importing this module (the tests, benchmark.py, report.py) loads nothing
+    until it asks to.
+    """
+    STARTUP.run_in_background(
+        load_app,
+        after=(
+            (lambda: warm_up_plot_cache(int(os.environ.get('MALL_WARMUP_TOP_N', '20'))))
+            if os.environ.get('MALL_WARMUP', '1') == '1' and CHART_MODE == 'png' else None
+        )
+    )
 html_content = """
     <html>
         <h1><strong>California Mall Dashboard</strong></h1><br>
@@ -93,11 +539,8 @@ app_ui = ui.page_navbar(
                 ui.input_select(
                     id='details_select_mall',
                     label='Select mall',
-                    choices=[
-                        'Beverly Center', 'Del Amo Fashion Center', 'Fashion Valley', 'Glendale Galleria', 'Irvine Spectrum Center',
-                        'South Coast Plaza', 'Stanford Shopping Center', 'The Grove', 'Westfield Century City', 'Westfield Valley Fair'
-                    ] ,
-                    selected=['Beverly Center'],
+                    choices=mall_choices(ui_dimensions, with_all=False),
+                    selected=[DEFAULT_DETAILS_MALL],
                     multiple=False
                 )
             ),
@@ -127,11 +570,12 @@ app_ui = ui.page_navbar(
             ui.layout_columns(
                 ui.card(
                     ui.card_header("Year Picker"),
-                    ui.input_select(
+                    ui.input_checkbox_group(
                         id="select_year",
-                        label="Select year",
-                        choices=["2021", "2022", "2023"],
-                        selected="2023"
+                        label="Select years to compare",
+                        choices=ui_dimensions.years,
+                        selected=list(DEFAULT_YEARS),
+                        inline=True
                     )
                 ),
                 ui.card(
@@ -139,11 +583,8 @@ app_ui = ui.page_navbar(
                     ui.input_select(
                         id='revenue_select_mall',
                         label='Select mall',
-                        choices=[
-                            'All', 'Beverly Center', 'Del Amo Fashion Center', 'Fashion Valley', 'Glendale Galleria', 'Irvine Spectrum',
-                            'South Coast Plaza', 'Stanford Shopping Center', 'The Grove', 'Westfield Century City', 'Westfield Valley Fair'
-                        ] ,
-                        selected=['All'],
+                        choices=mall_choices(ui_dimensions),
+                        selected=[DEFAULT_MALL],
                         multiple=False
                     )
                 )
@@ -163,8 +604,52 @@ app_ui = ui.page_navbar(
                 ui.output_text("max_monthly_revenue")
             ),
         ),
-        ui.card(ui.output_plot('line_monthly_revenue')),
-        ui.card(ui.output_plot('bar_mall_revenue'))
+        ui.layout_columns(
+            ui.card(
+                ui.card_header("Revenue Change (vs. the year before)"),
+                ui.output_text("yoy_revenue_change")
+            ),
+            ui.card(
+                ui.card_header("Revenue Growth (vs. the year before)"),
+                ui.output_text("yoy_revenue_growth")
+            ),
+        ),
+        ui.card(output_chart('line_monthly_revenue')),
+        ui.card(output_chart('bar_mall_revenue')),
+        export_card('revenue', 'Sales of the years and mall', 'Monthly totals'),
+        ui.card(
+            ui.layout_columns(
+                ui.card(
+                    ui.card_header("Date Range Picker"),
+                    # Set to the loaded DEFAULT_DATE_RANGE by fill_date_range() when it differs
+                    ui.input_date_range(
+                        id="revenue_date_range",
+                        label="Select dates",
+                        start=None if ui_date_range is None else ui_date_range[0].date(),
+                        end=None if ui_date_range is None else ui_date_range[1].date()
+                    ),
+                    ui.input_radio_buttons(
+                        id="revenue_window",
+                        label="Show",
+                        choices=DATE_WINDOWS,
+                        selected=DEFAULT_WINDOW
+                    )
+                ),
+                ui.card(
+                    ui.card_header("Revenue in the Window"),
+                    ui.output_text("window_revenue")
+                ),
+                ui.card(
+                    ui.card_header("Transactions in the Window"),
+                    ui.output_text("window_transactions")
+                ),
+                ui.card(
+                    ui.card_header("Highest Earning Day"),
+                    ui.output_text("window_best_day")
+                )
+            )
+        ),
+        ui.card(output_chart('daily_revenue'))
     ),
 
     # Nav Bar 2: Product Categories
@@ -188,8 +673,8 @@ app_ui = ui.page_navbar(
                     ui.input_select(
                         id="category_select_year",
                         label="Select year",
-                        choices=["2021", "2022", "2023"],
-                        selected="2023"
+                        choices=ui_dimensions.years,
+                        selected=DEFAULT_YEAR
                     )
                 ),
                 ui.card(
@@ -197,11 +682,8 @@ app_ui = ui.page_navbar(
                     ui.input_select(
                         id='category_select_mall',
                         label='Select mall',
-                        choices=[
-                            'All', 'Beverly Center', 'Del Amo Fashion Center', 'Fashion Valley', 'Glendale Galleria', 'Irvine Spectrum',
-                            'South Coast Plaza', 'Stanford Shopping Center', 'The Grove', 'Westfield Century City', 'Westfield Valley Fair'
-                        ] ,
-                        selected=['All'],
+                        choices=mall_choices(ui_dimensions),
+                        selected=[DEFAULT_MALL],
                         multiple=False
                     )
                 )
@@ -229,447 +711,850 @@ app_ui = ui.page_navbar(
                 ui.input_select(
                     id='select_month',
                     label='Select Month',
-                    choices=["All", "January", "February", "March", "April", "May", "June",
-                                "July", "August", "September", "October", "November", "December"],
-                    selected='January'
+                    choices=month_choices(ui_dimensions, DEFAULT_YEAR),
+                    selected=DEFAULT_MONTH
                 )
             ),
-            ui.card(ui.output_plot('one_month_categorical_revenue')),
+            ui.card(output_chart('one_month_categorical_revenue')),
             ui.layout_columns(
-                ui.card(ui.output_plot('one_month_categorical_sales')),
-                ui.card(ui.output_plot('one_month_categorical_quantity')),
-            )
+                ui.card(output_chart('one_month_categorical_sales')),
+                ui.card(output_chart('one_month_categorical_quantity')),
+            ),
+            export_card('category_month', 'Sales of the month', 'Totals per category')
         ),
-        ui.card(ui.output_plot('monthly_categorical_sales')),
+        ui.card(output_chart('monthly_categorical_sales')),
         ui.layout_columns(
-            ui.card(ui.output_plot('monthly_mall_category_sales')),
+            ui.card(output_chart('monthly_mall_category_sales')),
             ui.card(
                 ui.HTML('<p><strong>Play around with the data to change the plot on the left</strong></p>'),
                 ui.input_select(
                     id='category_select_year_plot',
                     label='Select Year',
-                    choices=['2021', '2022', '2023'],
-                    selected=['2023'],
+                    choices=ui_dimensions.years,
+                    selected=[DEFAULT_YEAR],
                     multiple=False
                 ),
                 ui.input_checkbox_group(
                     id='category_select_mall_plot',
                     label='Select the malls to view',
-                    choices=['Beverly Center', 'Del Amo Fashion Center', 'Fashion Valley', 'Glendale Galleria', 'Irvine Spectrum',
-                            'South Coast Plaza', 'Stanford Shopping Center', 'The Grove', 'Westfield Century City', 'Westfield Valley Fair'],
-                    selected=['Beverly Center', 'Del Amo Fashion Center'],
+                    choices=mall_choices(ui_dimensions, with_all=False),
+                    selected=list(DEFAULT_PLOT_MALLS),
                     inline=True
                 ),
                 ui.input_select(
                     id='category_select_category_plot',
                     label='Select category',
-                    choices=['Clothing', 'Souvenir', 'Food & Beverage', 'Cosmetics', 'Toys',
-                            'Shoes', 'Books', 'Technology'],
-                    selected=['Clothing'],
+                    choices=ui_dimensions.categories,
+                    selected=[DEFAULT_PLOT_CATEGORY],
                     multiple=False
                 )
             )
+        ),
+        export_card('category_plot', 'Sales of the category', 'Monthly totals per mall')
+    ),
+
+    # Nav Bar 3: Customers
+    ui.nav_panel(
+        'Customers',
+        ui.HTML("""
+            <h4>Who buys in the malls</h4>
+            <p>
+                Revenue split by the age, gender and payment method of the customers, per mall and year. <br>
+            </p>
+        """),
+        ui.card(
+            ui.layout_columns(
+                ui.card(
+                    ui.card_header("Year Picker"),
+                    ui.input_select(
+                        id="customer_select_year",
+                        label="Select year",
+                        choices=ui_dimensions.years,
+                        selected=DEFAULT_YEAR
+                    )
+                ),
+                ui.card(
+                    ui.card_header('Mall Picker'),
+                    ui.input_select(
+                        id='customer_select_mall',
+                        label='Select mall',
+                        choices=mall_choices(ui_dimensions),
+                        selected=[DEFAULT_MALL],
+                        multiple=False
+                    )
+                )
+            )
+        ),
+        ui.card(
+            ui.layout_columns(
+                ui.card(
+                    ui.card_header("Total Revenue"),
+                    ui.output_text("customer_total_revenue")
+                ),
+                ui.card(
+                    ui.card_header("Average Transaction Value"),
+                    ui.output_text("customer_avg_transaction")
+                ),
+                ui.card(
+                    ui.card_header("Top Spending Age Band"),
+                    ui.output_text("customer_top_age_band")
+                )
+            )
+        ),
+        ui.card(output_chart('revenue_by_age_band')),
+        ui.layout_columns(
+            ui.card(output_chart('revenue_by_gender')),
+            ui.card(output_chart('revenue_by_payment_method')),
+        ),
+        ui.layout_columns(
+            ui.card(output_chart('customer_revenue_per_mall')),
+            ui.card(
+                ui.HTML('<p><strong>Split the revenue of every mall by</strong></p>'),
+                ui.input_radio_buttons(
+                    id='customer_select_attribute',
+                    label='Customer attribute',
+                    choices=CUSTOMER_ATTRIBUTE_LABELS,
+                    selected=DEFAULT_CUSTOMER_ATTRIBUTE
+                )
+            )
         )
     ),
 
-    title='California Mall Dashboard'
+    # Nav Bar 4: Customer Segments
+    ui.nav_panel(
+        'Customer Segments',
+        ui.HTML("""
+            <h4>Customer segments</h4>
+            <p>
+                Customers grouped by k-means on how recently they bought, how often they bought, what they spent (RFM) and their age. <br>
+                Segment 1 is the segment spending the most per customer. <br>
+            </p>
+        """),
+        ui.card(
+            ui.layout_columns(
+                ui.card(
+                    ui.card_header("Year Picker"),
+                    ui.input_select(
+                        id="segment_select_year",
+                        label="Select year",
+                        choices=ui_dimensions.years,
+                        selected=DEFAULT_YEAR
+                    )
+                ),
+                ui.card(
+                    ui.card_header("Segmentation"),
+                    ui.output_text("segment_status")
+                )
+            )
+        ),
+        ui.card(
+            ui.card_header("Segment Profiles"),
+            ui.output_ui("segment_profiles")
+        ),
+        ui.layout_columns(
+            ui.card(output_chart('segment_sizes')),
+            ui.card(output_chart('segment_revenue_per_mall')),
+        )
+    ),
+
+    title='California Mall Dashboard',
+    header=ui.TagList(
+        ui.output_ui('startup_status'),
+        client_charts.PROGRESSIVE_HEAD if PROGRESSIVE else client_charts.HEAD if CHART_MODE == 'client' else None
+    )
 )
 
 
 # ---- 3. SERVER ----
+# The inputs the charts and cards are filtered by, debounced in every session (see debounce.py)
+FILTER_INPUTS = [
+    'select_year', 'revenue_select_mall', 'revenue_date_range', 'revenue_window',
+    'category_select_year', 'category_select_mall', 'select_month',
+    'category_select_year_plot', 'category_select_mall_plot', 'category_select_category_plot',
+    'customer_select_year', 'customer_select_mall', 'customer_select_attribute',
+    'segment_select_year',
+]
+
 def server(input, output, session):
+    filters = DebouncedInputs(input, FILTER_INPUTS)
+
+    # The state of STARTUP, checked every 250 ms until it is done
+    startup_state = reactive.Value(STARTUP.state)
+
+    @reactive.Effect
+    def watch_startup():
+        if not STARTUP.done:
+            reactive.invalidate_later(0.25)
+        startup_state.set(STARTUP.state)
+
+    def wait_for_data():
+        """
+        Stops the calling output, leaving it empty, until the data is loaded
+        """
+        req(startup_state() == 'ready')
+
+    @reactive.poll(poll_new_sales, float(os.environ.get('MALL_INGEST_INTERVAL', '5')))
+    def current_data_version():
+        """
+        The data_version, invalidating every data dependent output when new sales arrive
+        """
+        wait_for_data()
+        return data_version
+
+    @output
+    @render.ui
+    def startup_status():
+        state = startup_state()
+        if state == 'loading':
+            return ui.div('Loading the sales data, the charts will appear in a moment...', class_='alert alert-info')
+        if state == 'failed':
+            return ui.div(f'The sales data could not be loaded ({STARTUP.error}).', class_='alert alert-danger')
+        return None
+
+    date_range_filled = False
+
+    @reactive.Effect
+    def fill_date_range():
+        """
+        Sets the Date Range Picker to DEFAULT_DATE_RANGE once per session, once
+        the sales are loaded, unless the page was built with it already or the
+        range was picked meanwhile
+        """
+        nonlocal date_range_filled
+        wait_for_data()
+        if date_range_filled:
+            return
+        date_range_filled = True
+        default = tuple(day.date() for day in DEFAULT_DATE_RANGE)
+        built = None if ui_date_range is None else tuple(day.date() for day in ui_date_range)
+        with reactive.isolate():
+            shown = tuple(input.revenue_date_range())
+        if default != built and (built is None or shown == built):
+            ui.update_date_range('revenue_date_range', start=default[0], end=default[1])
+
+    # The choices the pickers of this page show, built from ui_dimensions
+    shown = {'dimensions': ui_dimensions, 'months': month_choices(ui_dimensions, DEFAULT_YEAR)}
+
+    def still_picked(id, choices, default):
+        """
+        What a picker getting new choices keeps picked: what was picked, when
+        still among the choices, or else the default
+        """
+        with reactive.isolate():
+            picked = input[id]()
+        if isinstance(picked, (tuple, list)):
+            return [value for value in picked if value in choices] or list(default)
+        return picked if picked in choices else default
+
+    @reactive.Effect
+    def fill_choices():
+        """
+        Updates the pickers to the malls, categories and years of the data,
+        when they differ from the ones the page was built with
+        """
+        current_data_version()
+        if dimensions == shown['dimensions']:
+            return
+        shown['dimensions'] = dimensions
+        malls, years = mall_choices(dimensions), dimensions.years
+        for id, choices, default in [
+            ('details_select_mall', dimensions.malls, DEFAULT_DETAILS_MALL),
+            ('revenue_select_mall', malls, DEFAULT_MALL),
+            ('category_select_mall', malls, DEFAULT_MALL),
+            ('customer_select_mall', malls, DEFAULT_MALL),
+            ('category_select_year', years, DEFAULT_YEAR),
+            ('category_select_year_plot', years, DEFAULT_YEAR),
+            ('customer_select_year', years, DEFAULT_YEAR),
+            ('segment_select_year', years, DEFAULT_YEAR),
+            ('category_select_category_plot', dimensions.categories, DEFAULT_PLOT_CATEGORY),
+        ]:
+            ui.update_select(id, choices=choices, selected=still_picked(id, choices, default))
+        ui.update_checkbox_group(
+            'select_year', choices=years, selected=still_picked('select_year', years, DEFAULT_YEARS), inline=True
+        )
+        ui.update_checkbox_group(
+            'category_select_mall_plot', choices=dimensions.malls,
+            selected=still_picked('category_select_mall_plot', dimensions.malls, DEFAULT_PLOT_MALLS), inline=True
+        )
+
+    @reactive.Effect
+    def fill_months():
+        """
+        Offers only the months sold in of the year picked in the Month Picker
+        """
+        current_data_version()
+        choices = month_choices(dimensions, filters.category_select_year())
+        if choices != shown['months']:
+            shown['months'] = choices
+            ui.update_select('select_month', choices=choices, selected=still_picked('select_month', choices, 'All'))
+
+    def picked_year(year):
+        """
+        A year picked, failing the calling output at once when the data has no such year
+        """
+        wait_for_data()
+        dimensions.check(years=[year])
+        return year
+
+    # The key and data of the chart each output last sent a preliminary spec of
+    preliminaries = {}
+
+    async def cached_plot(output_id, *inputs, data=None):
+        """
+        Returns the image of a chart from the process-wide PLOT_CACHE,
+        drawing it at the output's current size on a miss, from data or else
+        from chart_data().
+        With RENDER_POOL enabled the drawing happens in a worker process, and
+        it is abandoned as soon as a newer input invalidates this output.
+        With PROGRESSIVE, a miss first returns the spec of the chart, and the
+        output runs again right after to draw the PNG.
+        """
+        width = session.clientdata.output_width(output_id)
+        height = session.clientdata.output_height(output_id)
+        pixelratio = session.clientdata.pixelratio()
+        version = current_data_version()
+        access_log.record(output_id, inputs, width, height, pixelratio)
+        key = plot_key(output_id, inputs, version, width, height, pixelratio)
+
+        if PROGRESSIVE:
+            sent = preliminaries.pop(output_id, None)
+            if sent is not None and sent[0] == key:
+                data = sent[1]
+            elif key not in PLOT_CACHE:
+                if data is None:
+                    data = chart_data(data_sources(version), output_id, *inputs)
+                preliminaries[output_id] = (key, data)
+                # Sent with this flush, the PNG is drawn in the next one
+                reactive.invalidate_later(0)
+                return {'spec': CLIENT_CHARTS[output_id](data, *inputs)}
+
+        if not RENDER_POOL.enabled:
+            cache_result(output_id, key in PLOT_CACHE)
+            with draw_phase():
+                png = PLOT_CACHE.get_or_render(
+                    key, lambda: render_plot_png(
+                        CHARTS[output_id](data if data is not None else chart_data(data_sources(version), output_id, *inputs), *inputs),
+                        width, height, pixelratio
+                    )
+                )
+            return png_image_data(png)
+
+        png = PLOT_CACHE.get(key)
+        cache_result(output_id, png is not None)
+        if png is None:
+            render = asyncio.ensure_future(
+                RENDER_POOL.render(
+                    key, output_id, data if data is not None else chart_data(data_sources(version), output_id, *inputs), inputs,
+                    width, height, pixelratio
+                )
+            )
+            reactive.get_current_context().on_invalidate(render.cancel)
+            try:
+                with draw_phase():
+                    png = await render
+            except asyncio.CancelledError:
+                raise SilentCancelOutputException()
+        return png_image_data(png)
+
+    async def chart(output_id, *inputs, data=None):
+        """
+        Returns what the output of a chart sends for the CHART_MODE,
+        the image of a server drawn PNG or the spec of a browser drawn chart.
+        data is what the chart is drawn from when a calc of the session has
+        it already, it must be what chart_data() returns for the inputs.
+        """
+        if CHART_MODE == 'png':
+            return await cached_plot(output_id, *inputs, data=data)
+        version = current_data_version()
+        return CLIENT_CHARTS[output_id](data if data is not None else chart_data(data_sources(version), output_id, *inputs), *inputs)
 
     # Nav Bar 1: Revenue
     @reactive.Calc
-    def filtered_year():
+    @instrument
+    def revenue_years():
         """
-        Returnes a queried version of our dataset based on the selected year
+        The years picked, in order. Nothing is shown until at least one is.
         """
-        year = int(input.select_year())
-        df = mall_revenue_data.copy(deep=True)
-        return df[df["Year"] == year]
+        years = filters.select_year()
+        req(years)
+        wait_for_data()
+        dimensions.check(years=years)
+        return tuple(sorted(years, key=int))
 
     @reactive.Calc
-    def filtered_mall():
+    @instrument
+    def revenue_cube():
         """
-        A 2nd query added over the filtered_year() dataset, where we will
-        return the dataset based on the selected mall
+        The aggregate cube of every year sliced by the selected mall
         """
-        df = filtered_year()
-        mall = input.revenue_select_mall()
-        if mall == 'All':
-            return df
-        return df[df['shopping_mall'].isin([mall])]
+        current_data_version()
+        return cube_year_mall(sales_cube, None, filters.revenue_select_mall())
 
     @reactive.Calc
+    @instrument
+    def revenue_summary():
+        """
+        Every statistic of the Revenue cards and monthly chart, for every year,
+        in one groupby of revenue_cube(). Picking other years only selects other
+        rows of it, so comparing years costs the same as showing one.
+        """
+        return summarize(revenue_cube())
+
+    @reactive.Calc
+    @instrument
+    def revenue_years_summary():
+        """
+        The monthly and yearly rows of revenue_summary() for the years picked
+        """
+        return summary_years(revenue_summary(), revenue_years())
+
+    @reactive.Calc
+    @instrument
     def filtered_mall_details():
+        wait_for_data()
         selected_mall = input.details_select_mall()
-        df = mall_details.copy(deep=True)
-        return df[df['shopping_mall'] == selected_mall]
+        return mall_details.rows(shopping_mall=[selected_mall])
 
     @output
     @render.ui
+    @instrument
     def get_mall_details():
-        df = filtered_mall_details()
-        df.columns = ['Shopping Mall', 'Construction Year', 'Area (sqm)', 'Location', 'Store Count']
-        items = "".join(
-            f"<strong>{col}:</strong> {df[col].iloc[0]}"
-            f"<br>"
-            for col in df.columns
-        )[0:-4]
-
-        return ui.HTML(f"<ul style='padding-left:0; list-style:none;'>{items}</ul>")
+        return mall_details_html(filtered_mall_details())
 
     @output
-    @render.plot
+    @plot_png
+    @instrument
     def mall_store_count():
-        df = mall_details.copy(deep=True)
-        df = df[['shopping_mall', 'store_count']]
-
-        plot = (
-            ggplot(data=df)
-            + aes(x='shopping_mall', y='store_count')
-            + geom_bar(stat='identity', color='black', fill='blue')
-            + geom_text(
-                aes(label='store_count'),
-                va='top',
-                position='identity',
-                nudge_y = 0.11 * df['store_count'].max() 
-            )
-            + labs(
-                title = f'Number of stores per mall',
-                x='Mall',
-                y='# of Stores'
-            )
-            + theme_minimal()
-            + theme(axis_text_x=element_text(rotation=45, ha='right'))
-        )
-
-        return plot.draw()
+        wait_for_data()
+        return png_image_data(static_plot('mall_store_count'), style='object-fit: contain;')
 
     @output
-    @render.plot
+    @plot_png
+    @instrument
     def mall_area():
-        df = mall_details.copy(deep=True)
-        df['area (sqm)'] = df['area (sqm)'].apply(lambda x: int("".join(x.split(','))))
-        df['store_size_per_sqm'] = df['area (sqm)'] / df['store_count']
-        df['label'] = df['store_size_per_sqm'].apply(lambda x: f'{x:,.2f} sqm')
-        df = df[['shopping_mall', 'store_size_per_sqm', 'label']]
-
-        plot = (
-            ggplot(data=df)
-            + aes(x='shopping_mall', y='store_size_per_sqm')
-            + geom_bar(stat='identity', color='black', fill='blue')
-            + geom_text(
-                aes(label='label'),
-                va='center',
-                position='identity',
-                nudge_y = 0.07 * df['store_size_per_sqm'].max()
-            )
-            + coord_flip()
-            + labs(
-                title = 'Compactness of mall',
-                x='Mall',
-                y='Area per store (mall_area / store_count)'
-            )
-            + theme_minimal()
-        )
-
-        return plot.draw()
+        wait_for_data()
+        return png_image_data(static_plot('mall_area'), style='object-fit: contain;')
 
     @output
     @render.text
+    @instrument
     def total_revenue():
-        df = filtered_mall()
-        total = df["price"].sum()
+        total = revenue_years_summary()[1]['price'].sum()
         return f"$ {total:,.2f}"
 
     @output
     @render.text
+    @instrument
     def avg_monthly_revenue():
-        df = filtered_mall()
-        monthly = df.groupby("Month")["price"].sum()
-        avg = monthly.mean()
+        avg = revenue_years_summary()[0]['price'].mean()
         return f"$ {avg:,.2f}"
 
     @output
     @render.text
+    @instrument
     def max_monthly_revenue():
-        month_array = ["January", "February", "March", "April", "May", "June",
-                       "July", "August", "September", "October", "November", "December"]
-        df = filtered_mall()
-        month, price = df.groupby('Month')[['price']].sum().reset_index().sort_values('price', ascending=True).iloc[-1, 0:]
-        return f'{month_array[int(month) - 1]} : $ {price:,.2f}'
-    
+        df = revenue_years_summary()[0]
+        year, month, price = df[['Year', 'Month', 'price']].sort_values('price', ascending=True).iloc[-1, 0:]
+        if len(revenue_years()) > 1:
+            return f'{MONTHS[int(month) - 1]} {int(year)} : $ {price:,.2f}'
+        return f'{MONTHS[int(month) - 1]} : $ {price:,.2f}'
+
     @output
-    @render.plot
-    def line_monthly_revenue():
-        df = filtered_mall()[['Month', 'price']].groupby('Month').sum().reset_index()
-        df = df.sort_values('Month', ascending=True)
-        year = int(input.select_year())
-        plot = (
-            ggplot(df)
-            + aes(x='Month', y='price')
-            + geom_line()
-            + geom_point(color='black')
-            + scale_x_continuous(
-                breaks= [i + 1 for i in range(12)], 
-                labels=["Jan","Feb","Mar","Apr","May","Jun","Jul","Aug","Sep","Oct","Nov","Dec"]
-            )
-            + labs(
-                title=f'Monthly Revenue ({year})',
-                x='Month',
-                y='Revenue'
-            )
-            + theme_minimal()
+    @render.text
+    @instrument
+    def yoy_revenue_change():
+        df = revenue_years_summary()[1].dropna(subset=['price_change'])
+        if df.empty:
+            return '-'
+        return ' | '.join(
+            f"{year}: {'+' if change >= 0 else '-'}$ {abs(change):,.2f}"
+            for year, change in zip(df['Year'], df['price_change'])
         )
-        return plot.draw()
-
-    @output
-    @render.plot
-    def bar_mall_revenue():
-        df = filtered_year()
-        df = df.groupby('shopping_mall')[['price']].sum().reset_index().sort_values('price')
-        df['label'] = df['price'].apply(lambda x: f"$ {x:,.2f}")
-
-        plot = (
-            ggplot(data=df)
-            + aes(x='shopping_mall', y='price')
-            + geom_bar(stat='identity', color='black', fill='blue')
-            + geom_text(
-                aes(label='label'),
-                va='top',
-                position='identity',
-                nudge_y = 0.11 * df['price'].max() 
-            )
-            + labs(
-                title = f'Total revenue per mall ({input.select_year()})',
-                x='Mall',
-                y='Revenue'
-            )
-            + theme_minimal()
-            + theme(axis_text_x=element_text(rotation=45, ha='right'))
+
+    @output
+    @render.text
+    @instrument
+    def yoy_revenue_growth():
+        df = revenue_years_summary()[1].dropna(subset=['price_growth'])
+        if df.empty:
+            return '-'
+        return ' | '.join(f'{year}: {growth:+.1f}%' for year, growth in zip(df['Year'], df['price_growth']))
+    
+    @output
+    @chart_renderer
+    @instrument
+    async def line_monthly_revenue():
+        return await chart(
+            'line_monthly_revenue', revenue_years(), filters.revenue_select_mall(), data=revenue_summary()
         )
 
-        return plot.draw()
+    @output
+    @chart_renderer
+    @instrument
+    async def bar_mall_revenue():
+        return await chart('bar_mall_revenue', revenue_years())
 
-    # Nav Bar 2: Product Categories
     @reactive.Calc
-    def category_filtered_year():
+    @instrument
+    def revenue_window_days():
         """
-        For the Product Categories Nav Bar.
-        Returnes a queried version of our dataset based on the selected year
+        The first and last day of the selected window, as ISO dates
         """
-        year = int(input.category_select_year())
-        df = mall_revenue_data.copy(deep=True)
-        return df[df["Year"] == year]
-    
+        first, last = filters.revenue_date_range()
+        req(first, last)
+        return tuple(day.date().isoformat() for day in date_window(filters.revenue_window(), first, last))
+
     @reactive.Calc
-    def category_filtered_mall():
+    @instrument
+    def window_daily_totals():
         """
-        For the Product Categories Nav Bar
-        A 2nd query added over the filtered_year() dataset, where we will
-        return the dataset based on the selected mall
+        The revenue and transactions of every day of the window, from a
+        binary searched slice of the sales sorted by date
         """
-        df = category_filtered_year()
-        mall = input.category_select_mall()
-        if mall == 'All':
-            return df
-        return df[df['shopping_mall'].isin([mall])]
-    
+        current_data_version()
+        return chart_data(data_sources(), 'daily_revenue', *revenue_window_days(), filters.revenue_select_mall())
+
+    @output
+    @render.text
+    @instrument
+    def window_revenue():
+        df = window_daily_totals()
+        return f"$ {df['price'].sum():,.2f} in {len(df)} days"
+
+    @output
+    @render.text
+    @instrument
+    def window_transactions():
+        return f"{window_daily_totals()['invoice_no'].sum():,}"
+
+    @output
+    @render.text
+    @instrument
+    def window_best_day():
+        df = window_daily_totals()
+        if not df['price'].sum():
+            return '-'
+        best = df.loc[df['price'].idxmax()]
+        return f"{best['Date']:%b %d, %Y} : $ {best['price']:,.2f}"
+
+    @output
+    @chart_renderer
+    @instrument
+    async def daily_revenue():
+        return await chart('daily_revenue', *revenue_window_days(), filters.revenue_select_mall())
+
+    # Nav Bar 2: Product Categories
     @reactive.Calc
-    def category_filtered_category_plot():
+    @instrument
+    def category_cube():
         """
-        Returns a dataframe with the selected malls
-        This is for the "Number of {category} sales per mall"
+        For the Product Categories Nav Bar.
+        The aggregate cube sliced by the selected year and mall
         """
-        selected_malls = input.category_select_mall_plot()
-        selected_category = input.category_select_category_plot()
-        df = category_filtered_year()
-        return df[np.logical_and(df['shopping_mall'].isin(selected_malls), df['category'].isin([selected_category]))]
+        current_data_version()
+        return cube_year_mall(sales_cube, picked_year(filters.category_select_year()), filters.category_select_mall())
 
     @reactive.Calc
-    def category_filtered_month_plot():
+    @instrument
+    def category_summary():
         """
-        A method used to filter for the selected month input.select_month()
-        Used in the Category Pie Chart
+        For the Product Categories Nav Bar.
+        Every statistic of the cards and one month charts, in one groupby of category_cube()
         """
-        month = input.select_month()
-        month = 1 if month == 'January' else 2 if month == 'February' else 3 if month == 'March' else 4 if month == 'April' else 5 \
-            if month == 'May' else 6 if month == 'June' else 7 if month == 'July' else 8 if month == 'August' else 9 if month == 'September' \
-            else 10 if month  == 'October' else 11 if month  == 'November' else 12 if month == 'December' else 13
-        df = category_filtered_mall()
-        if month != 13:
-            df = df[df['Month'] == month]
-        return df
-
-    @reactive.Calc
-    def category_filtered_all_plot():
-        df = mall_revenue_data.copy(deep=True)
-        year = input.category_select_year_plot()
-        mall = input.category_select_mall_plot()
-        category = input.category_select_category_plot()
-
-        print(year, mall, category)
-
-        df_conditions = np.logical_and(np.logical_and(df['Year'] == int(year), df['shopping_mall'].isin(mall)), df['category'] == category)
-        df = df[df_conditions]
-        return df
+        return summarize(category_cube())
 
     @output
     @render.text
+    @instrument
     def total_transactions():
-        df = category_filtered_mall()
-        return df['invoice_no'].count()
+        return category_summary()['total']['invoice_no']
     
     @output
     @render.text
+    @instrument
     def avg_transactions():
-        df = category_filtered_mall()
-        return f'{df.groupby("Month")["invoice_no"].count().mean():,.0f}'
+        return f'{category_summary()["monthly"]["invoice_no"].mean():,.0f}'
     
     @output
     @render.text
+    @instrument
     def max_monthly_transactions():
-        month_array = ["January", "February", "March", "April", "May", "June",
-                       "July", "August", "September", "October", "November", "December"]
-        df = category_filtered_mall()
-        month, count = df.groupby('Month')['invoice_no'].count().reset_index().sort_values('invoice_no').iloc[-1, :]
-        return f'{month_array[int(month) - 1]}: {count}'
+        df = category_summary()['monthly']
+        month, count = df[['Month', 'invoice_no']].sort_values('invoice_no').iloc[-1, :]
+        return f'{MONTHS[int(month) - 1]}: {count}'
     
     @output
-    @render.plot
-    def one_month_categorical_sales():
-        df = category_filtered_month_plot()
-        df = df.groupby(['category'])['invoice_no'].count().reset_index()
-
-        plot = (
-            ggplot(data=df)
-            + aes(x='category', y='invoice_no')
-            + geom_bar(stat='identity', color='black', fill='blue')
-            + geom_text(
-                aes(label='invoice_no'),
-                va='top',
-                position='identity',
-                nudge_y = 0.11 * df['invoice_no'].max() 
-            )
-            + labs(
-                title = f'Number of transactions per category ({input.select_month()} {input.category_select_year()})',
-                x='Category',
-                y='# of Transactions'
-            )
-            + theme_minimal()
-            + theme(axis_text_x=element_text(rotation=45, ha='right'))
+    @chart_renderer
+    @instrument
+    async def one_month_categorical_sales():
+        return await chart(
+            'one_month_categorical_sales', filters.category_select_year(), filters.category_select_mall(), filters.select_month(),
+            data=category_summary()
         )
 
-        return plot.draw()
+    @output
+    @chart_renderer
+    @instrument
+    async def one_month_categorical_quantity():
+        return await chart(
+            'one_month_categorical_quantity', filters.category_select_year(), filters.category_select_mall(), filters.select_month(),
+            data=category_summary()
+        )
 
     @output
-    @render.plot
-    def one_month_categorical_quantity():
-        df = category_filtered_month_plot()
-        df = df.groupby(['category'])['quantity'].sum().reset_index()
+    @chart_renderer
+    @instrument
+    async def one_month_categorical_revenue():
+        return await chart(
+            'one_month_categorical_revenue', filters.category_select_year(), filters.category_select_mall(), filters.select_month(),
+            data=category_summary()
+        )
 
-        plot = (
-            ggplot(data=df)
-            + aes(x='category', y='quantity')
-            + geom_bar(stat='identity', color='black', fill='blue')
-            + geom_text(
-                aes(label='quantity'),
-                va='top',
-                position='identity',
-                nudge_y = 0.11 * df['quantity'].max() 
-            )
-            + labs(
-                title = f'Quantity bought per category ({input.select_month()} {input.category_select_year()})',
-                x='Category',
-                y='# of Transactions'
-            )
-            + theme_minimal()
-            + theme(axis_text_x=element_text(rotation=45, ha='right'))
+    @output
+    @chart_renderer
+    @instrument
+    async def monthly_categorical_sales():
+        return await chart(
+            'monthly_categorical_sales', filters.category_select_mall()
         )
 
-        return plot.draw()
+    @output
+    @chart_renderer
+    @instrument
+    async def monthly_mall_category_sales():
+        return await chart(
+            'monthly_mall_category_sales', picked_year(filters.category_select_year_plot()), tuple(filters.category_select_mall_plot()),
+            filters.category_select_category_plot()
+        )
+
+    # Exports: the sales behind the revenue, month and category views, read in
+    # chunks from the shared sales so an export never holds them all at once
+    def export_download(prefix, name):
+        """
+        A download button named after its view and the export format picked
+        """
+        fmt = input[f'{prefix}_export_format']
+        return render.download_button(
+            filename=lambda: export_filename(name, fmt()),
+            media_type=lambda: EXPORT_FORMATS[fmt()][0]
+        )
+
+    def mall_filter(mall):
+        return {} if mall == 'All' else {'shopping_mall': [mall]}
 
     @output
-    @render.plot
-    def one_month_categorical_revenue():
-        df = category_filtered_month_plot()
-        df = df.groupby(['category'])['price'].sum().reset_index()
-        df['price_details'] = df['price'].apply(lambda x: f'$ {x:,.2f}k')
+    @export_download('revenue', 'revenue_sales')
+    def revenue_export_rows():
+        wait_for_data()
+        ranges = [year_range(year) for year in revenue_years()]
+        return export(
+            sales_chunks(mall_revenue_data, ranges, **mall_filter(filters.revenue_select_mall())),
+            input.revenue_export_format()
+        )
 
-        plot = (
-            ggplot(data=df)
-            + aes(x='category', y='price')
-            + geom_bar(stat='identity', color='black', fill='blue')
-            + geom_text(
-                aes(label='price_details'),
-                va='top',
-                position='identity',
-                nudge_y = 0.11 * df['price'].max() 
-            )
-            + labs(
-                title = f'Revenue earned per category ({input.select_month()} {input.category_select_year()})',
-                x='Category',
-                y='Revenue'
-            )
-            + theme_minimal()
-            + theme(axis_text_x=element_text(rotation=45, ha='right'))
+    @output
+    @export_download('revenue', 'revenue_monthly_totals')
+    def revenue_export_totals():
+        wait_for_data()
+        monthly, _ = revenue_years_summary()
+        return export_totals(monthly, input.revenue_export_format())
+
+    @output
+    @export_download('category_month', 'category_month_sales')
+    def category_month_export_rows():
+        wait_for_data()
+        year, month = picked_year(filters.category_select_year()), month_number(filters.select_month())
+        ranges = [year_range(year) if month is None else month_range(year, month)]
+        return export(
+            sales_chunks(mall_revenue_data, ranges, **mall_filter(filters.category_select_mall())),
+            input.category_month_export_format()
         )
 
-        return plot.draw()
-
-    @output
-    @render.plot
-    def monthly_categorical_sales():
-        df = mall_revenue_data.copy(deep=True)
-        df = df.groupby(['Month', 'category'])['invoice_no'].count().reset_index()
-        title_1 = 'Transactions in the' if input.category_select_mall() != 'All' else 'Transactions in'
-        title_2 = 'Mall' if input.category_select_mall() != 'All' else 'Malls'
-        plot = (
-            ggplot(data=df)
-            + aes(x='Month', y='invoice_no', color='category')
-            + geom_line()
-            + geom_point()
-            + labs(
-                title=f'{title_1} {input.category_select_mall()} {title_2}',
-                x='Month',
-                y='Number of Transactions',
-                color='Category'
-            )
-            + scale_x_continuous(
-                breaks= [i + 1 for i in range(12)], 
-                labels=["Jan","Feb","Mar","Apr","May","Jun","Jul","Aug","Sep","Oct","Nov","Dec"]
-            )
+    @output
+    @export_download('category_month', 'category_month_totals')
+    def category_month_export_totals():
+        wait_for_data()
+        summary = category_summary()
+        month = month_number(filters.select_month())
+        if month is None:
+            totals = summary['by_category']
+        else:
+            totals = summary['by_month_category']
+            totals = totals[totals['Month'] == month]
+        return export_totals(totals, input.category_month_export_format())
+
+    @output
+    @export_download('category_plot', 'category_plot_sales')
+    def category_plot_export_rows():
+        wait_for_data()
+        return export(
+            sales_chunks(
+                mall_revenue_data, [year_range(picked_year(filters.category_select_year_plot()))],
+                shopping_mall=list(filters.category_select_mall_plot()), category=[filters.category_select_category_plot()]
+            ),
+            input.category_plot_export_format()
         )
-        return plot.draw()
-    
+
     @output
-    @render.plot
-    def monthly_mall_category_sales():
-        chosen_category = input.category_select_category_plot()
-        if not chosen_category:
-            return (ggplot() + labs(title="Select a specific category.")).draw()
-        
-        df = category_filtered_all_plot()
-        df = df.groupby(['Month', 'shopping_mall'])['invoice_no'].count().reset_index()
-        plot = (
-            ggplot(data=df)
-            + aes(x='Month', y='invoice_no', color='shopping_mall')
-            + geom_line()
-            + geom_point()
-            + labs(
-                title=f'Number of {chosen_category} sales per mall',
-                x='Month',
-                y='Number of Transactions',
-                color='Malls'
-            )
-            + scale_x_continuous(
-                breaks= [i + 1 for i in range(12)], 
-                labels=["Jan","Feb","Mar","Apr","May","Jun","Jul","Aug","Sep","Oct","Nov","Dec"]
-            )
+    @export_download('category_plot', 'category_plot_monthly_totals')
+    def category_plot_export_totals():
+        wait_for_data()
+        cube = slice_cube(
+            sales_cube, year=int(picked_year(filters.category_select_year_plot())), malls=list(filters.category_select_mall_plot()),
+            categories=[filters.category_select_category_plot()]
         )
-        return plot.draw()
+        totals = cube.groupby(['Year', 'Month', 'shopping_mall'], observed=True)[['price', 'quantity', 'invoice_no']].sum()
+        return export_totals(totals.reset_index(), input.category_plot_export_format())
+
+    # Nav Bar 3: Customers
+    @reactive.Calc
+    @instrument
+    def customer_cube_slice():
+        """
+        The customer cube sliced by the selected year and mall
+        """
+        current_data_version()
+        return cube_year_mall(customer_cube, picked_year(filters.customer_select_year()), filters.customer_select_mall())
+
+    @output
+    @render.text
+    @instrument
+    def customer_total_revenue():
+        return f"$ {customer_cube_slice()['price'].sum():,.2f}"
+
+    @output
+    @render.text
+    @instrument
+    def customer_avg_transaction():
+        df = customer_cube_slice()
+        transactions = df['invoice_no'].sum()
+        return f"$ {df['price'].sum() / transactions:,.2f}" if transactions else '-'
+
+    @output
+    @render.text
+    @instrument
+    def customer_top_age_band():
+        revenue = customer_cube_slice().groupby('age_band', observed=True)['price'].sum()
+        if revenue.empty or not revenue.sum():
+            return '-'
+        return f"{revenue.idxmax()} ({revenue.max() / revenue.sum():.1%} of revenue)"
+
+    @output
+    @chart_renderer
+    @instrument
+    async def revenue_by_age_band():
+        return await chart('revenue_by_age_band', picked_year(filters.customer_select_year()), filters.customer_select_mall())
+
+    @output
+    @chart_renderer
+    @instrument
+    async def revenue_by_gender():
+        return await chart('revenue_by_gender', picked_year(filters.customer_select_year()), filters.customer_select_mall())
+
+    @output
+    @chart_renderer
+    @instrument
+    async def revenue_by_payment_method():
+        return await chart('revenue_by_payment_method', picked_year(filters.customer_select_year()), filters.customer_select_mall())
+
+    @output
+    @chart_renderer
+    @instrument
+    async def customer_revenue_per_mall():
+        return await chart('customer_revenue_per_mall', picked_year(filters.customer_select_year()), filters.customer_select_attribute())
+
+    # Nav Bar 4: Customer Segments
+    @reactive.Calc
+    @instrument
+    def segment_result():
+        """
+        The segmentation of the current data. While it is computed in the
+        background this is the last one done (None before the first), and it
+        is checked again every second. A segmentation that failed is not retried.
+        """
+        version = current_data_version()
+        request_segmentation()
+        if SEGMENTS.get(version) is None and SEGMENTS.error(version) is None:
+            reactive.invalidate_later(1)
+        return SEGMENTS.latest(version)
+
+    @output
+    @render.text
+    @instrument
+    def segment_status():
+        result = segment_result()
+        version = current_data_version()
+        error = SEGMENTS.error(version)
+        if error is not None:
+            return f'Segmentation failed: {error}'
+        if result is None:
+            return f'Segmenting {len(customers):,} customers...'
+        profiles = result['profiles']
+        status = f"{len(profiles)} segments of {profiles['customers'].sum():,} customers"
+        return status if SEGMENTS.get(version) is not None else f'{status}, updating with the new sales...'
+
+    @output
+    @render.ui
+    @instrument
+    def segment_profiles():
+        result = segment_result()
+        req(result is not None)
+        df = result['profiles']
+        df = pd.DataFrame({
+            'Segment': df['segment'].astype(str),
+            'Customers': df['customers'].map('{:,}'.format),
+            'Days Since Last Purchase': df['recency'].map('{:,.0f}'.format),
+            'Purchases': df['frequency'].map('{:,.2f}'.format),
+            'Spent per Customer': df['monetary'].map('$ {:,.2f}'.format),
+            'Average Age': df['age'].map('{:,.1f}'.format),
+            'Share of Revenue': df['revenue_share'].map('{:.1f}%'.format),
+        })
+        return ui.HTML(df.to_html(index=False, border=0, classes='table table-sm'))
+
+    @output
+    @chart_renderer
+    @instrument
+    async def segment_sizes():
+        req(segment_result() is not None)
+        return await chart('segment_sizes')
+
+    @output
+    @chart_renderer
+    @instrument
+    async def segment_revenue_per_mall():
+        req(segment_result() is not None)
+        return await chart('segment_revenue_per_mall', picked_year(filters.segment_select_year()))
+
+
+def plot_cache_metrics():
+    stats = PLOT_CACHE.stats()
+    return (
+        gauge_lines('mall_plot_cache_bytes', 'Size of the PNGs in the render cache', stats['bytes'])
+        + gauge_lines('mall_plot_cache_entries', 'Charts in the render cache', stats['entries'])
+        + gauge_lines('mall_plot_cache_evictions', 'Charts evicted from the render cache so far', stats['evictions'])
+        + gauge_lines('mall_data_version', 'Version of the shared sales data', data_version)
+        + gauge_lines('mall_startup_ready', 'Whether the data and plotting stack are loaded (1) or not yet (0)', int(STARTUP.ready))
+        + gauge_lines('mall_startup_seconds', 'Time from the import to the end of the background startup', STARTUP.seconds or 0)
+    )
+
+async def readiness(request):
+    """
+    200 once the background startup is done, 503 while it loads or when it failed
+    """
+    return JSONResponse(
+        {'state': STARTUP.state, 'error': STARTUP.error, 'steps': STARTUP.steps},
+        status_code=200 if STARTUP.ready else 503
+    )
 
+# The Shiny app, with the Prometheus metrics served next to it at /metrics
+# and the readiness of its startup at /ready, loading the data once it starts
+@asynccontextmanager
+async def lifespan(_):
+    start_loading()
+    yield
 
-app = App(app_ui, server)
\ No newline at end of file
+app = Starlette(routes=[
+    Route('/metrics', metrics_endpoint(plot_cache_metrics)),
+    Route('/ready', readiness),
+    Mount('/', App(app_ui, server)),
+], lifespan=lifespan)
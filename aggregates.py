@@ -0,0 +1,168 @@
+"""
+The Year x Month x mall x category aggregate cube the dashboard outputs are served from,
+and the date ranges answered from the sales frame sorted by invoice_date.
+"""
+import numpy as np
+import pandas as pd
+
+from dataset_cache import concat_frames
+from dimensions import UnknownSelection, category_codes
+
+MONTHS = ["January", "February", "March", "April", "May", "June",
+          "July", "August", "September", "October", "November", "December"]
+
+
+def build_sales_cube(df):
+    """
+    Aggregates the sales rows once into a Year x Month x mall x category cube.
+    Each row holds the revenue (price), the quantity sold, and the number of
+    transactions (invoice_no) of that combination, so the dashboard outputs
+    only need to slice a few thousand rows instead of regrouping the raw sales.
+    """
+    # Prices are stored as float32, which is exact to the cent for single prices
+    # but not for sums, so they are widened and rounded back to cents first
+    df = df.assign(price=df['price'].astype('float64').round(2))
+    return (
+        df.groupby(['Year', 'Month', 'shopping_mall', 'category'], observed=True)
+        .agg(price=('price', 'sum'), quantity=('quantity', 'sum'), invoice_no=('invoice_no', 'count'))
+        .reset_index()
+    )
+
+def add_to_sales_cube(cube, rows):
+    """
+    Returns the cube updated with new sales rows, by aggregating only the new
+    rows and adding them to the matching cells of the cube
+    """
+    keys = ['Year', 'Month', 'shopping_mall', 'category']
+    return (
+        concat_frames(cube, build_sales_cube(rows))
+        .groupby(keys, observed=True)[['price', 'quantity', 'invoice_no']].sum()
+        .reset_index()
+    )
+
+def slice_cube(cube, year=None, month=None, malls=None, categories=None, years=None):
+    """
+    Returns the rows of the aggregate cube matching the given filters.
+    A filter left as None keeps every value of that key. The malls and
+    categories are compared by their codes, and one the cube doesn't hold
+    raises UnknownSelection.
+    Unused levels of the categorical columns are dropped so the plots don't list them.
+    """
+    mask = np.ones(len(cube), dtype=bool)
+    if year is not None:
+        mask &= cube['Year'].to_numpy() == year
+    if years is not None:
+        mask &= np.isin(cube['Year'].to_numpy(), [int(year) for year in years])
+    if month is not None:
+        mask &= cube['Month'].to_numpy() == month
+    if malls is not None:
+        mask &= np.isin(cube['shopping_mall'].cat.codes.to_numpy(), category_codes(cube['shopping_mall'], malls))
+    if categories is not None:
+        mask &= np.isin(cube['category'].cat.codes.to_numpy(), category_codes(cube['category'], categories))
+    df = cube[mask]
+    return df.assign(**{
+        col: df[col].cat.remove_unused_categories()
+        for col in df.columns
+        if isinstance(df[col].dtype, pd.CategoricalDtype)
+    })
+
+def summarize(cube):
+    """
+    Computes every statistic the cards and charts of a tab read from its
+    slice of the cube, grouping the slice only once, by Year x Month x category:
+        by_month_category  the revenue, quantity and transactions per Year x Month x category
+        monthly            the same per Year x Month, summed from by_month_category
+        yearly             the same per Year, with the change and growth (%) of
+                           the revenue since the year before (NaN without it)
+        by_category        the same per category, summed from by_month_category
+        total              the same over the whole slice
+    The sums after the first groupby are over at most years x 12 x categories rows,
+    so a slice of several years costs about the same as a slice of one.
+    """
+    columns = ['price', 'quantity', 'invoice_no']
+    by_month_category = cube.groupby(['Year', 'Month', 'category'], observed=True)[columns].sum().reset_index()
+    monthly = by_month_category.groupby(['Year', 'Month'])[columns].sum().reset_index().sort_values(['Year', 'Month'])
+    yearly = monthly.groupby('Year')[columns].sum().reset_index()
+    previous = yearly.set_index('Year')['price'].reindex(yearly['Year'] - 1).to_numpy()
+    yearly['price_change'] = yearly['price'] - previous
+    yearly['price_growth'] = yearly['price_change'] / previous * 100
+    by_category = by_month_category.groupby('category', observed=True)[columns].sum().reset_index()
+    return {
+        'by_month_category': by_month_category,
+        'monthly': monthly,
+        'yearly': yearly,
+        'by_category': by_category,
+        'total': {col: monthly[col].sum() for col in columns},
+    }
+
+def summary_years(summary, years):
+    """
+    Returns the monthly and yearly rows of a summary for the given years
+    """
+    years = [int(year) for year in years]
+    monthly, yearly = summary['monthly'], summary['yearly']
+    return monthly[monthly['Year'].isin(years)], yearly[yearly['Year'].isin(years)]
+
+def month_number(month):
+    """
+    Converts a month name from the Month Picker into its number (1 - 12),
+    returns None for 'All' and raises UnknownSelection for anything else
+    """
+    if month == 'All':
+        return None
+    if month not in MONTHS:
+        raise UnknownSelection(f'no month {month!r}')
+    return MONTHS.index(month) + 1
+
+# The windows of the Date Range Picker, each ending on the last day picked
+DATE_WINDOWS = {
+    'range': 'Picked dates',
+    '30': 'Last 30 days',
+    '90': 'Last 90 days',
+    'qtd': 'Quarter to date',
+}
+
+def date_window(window, first, last):
+    """
+    Returns the first and last day (both included) of a window of DATE_WINDOWS
+    ending on last: the picked first - last range, its last 30 or 90 days,
+    or its quarter to date
+    """
+    last = pd.Timestamp(last).normalize()
+    if window in ('30', '90'):
+        return last - pd.Timedelta(days=int(window) - 1), last
+    if window == 'qtd':
+        return last.to_period('Q').start_time, last
+    return min(pd.Timestamp(first).normalize(), last), last
+
+def day_range(first, last):
+    """
+    Converts the first and last day (both included) into the [start, stop) range of rows_between()
+    """
+    return pd.Timestamp(first).normalize(), pd.Timestamp(last).normalize() + pd.Timedelta(days=1)
+
+def year_range(year):
+    return pd.Timestamp(year=int(year), month=1, day=1), pd.Timestamp(year=int(year) + 1, month=1, day=1)
+
+def month_range(year, month):
+    start = pd.Timestamp(year=int(year), month=month, day=1)
+    return start, start + pd.offsets.MonthBegin(1)
+
+def daily_totals(rows, first, last):
+    """
+    Sums the revenue and counts the transactions of every day from first to
+    last, of rows sorted by invoice_date. Every day of a run of sales is
+    contiguous, so its total is one reduceat() over the run boundaries,
+    without any hashing or sorting.
+    """
+    days = rows['invoice_date'].to_numpy().astype('datetime64[D]')
+    if len(days):
+        starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+        totals = pd.DataFrame({
+            'price': np.add.reduceat(rows['price'].to_numpy().astype('float64'), starts).round(2),
+            'invoice_no': np.diff(np.r_[starts, len(days)]),
+        }, index=pd.DatetimeIndex(days[starts]))
+    else:
+        totals = pd.DataFrame({'price': np.zeros(0), 'invoice_no': np.zeros(0, dtype=np.int64)})
+    dates = pd.date_range(pd.Timestamp(first).normalize(), pd.Timestamp(last).normalize(), freq='D', name='Date')
+    return totals.reindex(dates, fill_value=0).reset_index()
@@ -0,0 +1,262 @@
+"""
+Benchmarks the data loading, the filter chains and the chart rendering of the
+dashboard on synthetic sales data of growing sizes.
+
+For every size a sales_data.csv with the columns the app expects is generated
+once (and reused by later runs), then this script times:
+    - prepare_datasets(), with a cold and a warm columnar cache
+    - the queries of the reactive calcs in server(), on the sales and the cubes
+    - building and drawing every chart
+and, once per run, the import of ShinyApp.py and its background startup in a
+fresh interpreter. It writes the timings as JSON. Given the JSON of an earlier
+run as --baseline, it lists every timing that got slower than the tolerance
+and exits with 1, as it does when the import takes longer than --import-budget.
+
+    python benchmark.py [--sizes 100000 1000000 10000000] [--output results.json]
+                        [--baseline previous.json] [--tolerance 0.25] [--import-budget 1.5]
+"""
+import os
+
+# Benchmarks draw in this process, with nothing rendering in the background
+os.environ.setdefault('MALL_WARMUP', '0')
+os.environ.setdefault('MALL_RENDER_WORKERS', '0')
+
+import argparse
+import json
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+import ShinyApp as app
+from aggregates import summarize
+from dataset_cache import DATA_DIR
+from render_cache import render_plot_png
+from segments import segment_customers
+from startup import IMPORT_BUDGET_SECONDS
+
+BENCH_DIR = os.path.join(DATA_DIR, '.bench')
+DEFAULT_SIZES = [100_000, 1_000_000, 10_000_000]
+
+CATEGORIES = ['Books', 'Clothing', 'Cosmetics', 'Food & Beverage', 'Shoes', 'Souvenir', 'Technology', 'Toys']
+# Unit price of each category, a sale costs quantity times this
+UNIT_PRICES = [15.15, 300.08, 40.66, 5.23, 600.17, 11.73, 1050.0, 35.84]
+FIRST_DAY = pd.Timestamp('2021-01-01')
+LAST_DAY = pd.Timestamp('2023-03-08')
+
+
+def generate_sales_csv(path, rows, seed=0, chunk_size=1_000_000):
+    """
+    Writes rows random sales in the layout of sales_data.csv, one chunk at a time
+    """
+    rng = np.random.default_rng(seed)
+    malls = pd.read_csv(os.path.join(DATA_DIR, 'shopping_mall_data.csv'))['shopping_mall'].to_numpy()
+    customers = pd.read_csv(os.path.join(DATA_DIR, 'customer_data.csv'))['customer_id'].to_numpy()
+    days = (LAST_DAY - FIRST_DAY).days + 1
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w', newline='') as f:
+        for start in range(0, rows, chunk_size):
+            n = min(chunk_size, rows - start)
+            category = rng.integers(len(CATEGORIES), size=n)
+            quantity = rng.integers(1, 6, size=n)
+            dates = FIRST_DAY + pd.to_timedelta(rng.integers(days, size=n), unit='D')
+            pd.DataFrame({
+                'invoice_no': 'I' + pd.Series(np.arange(start, start + n)).astype(str),
+                'customer_id': customers[rng.integers(len(customers), size=n)],
+                'category': np.array(CATEGORIES)[category],
+                'quantity': quantity,
+                'price': (np.array(UNIT_PRICES)[category] * quantity).round(2),
+                'invoice date': dates.strftime('%m/%d/%Y'),
+                'shopping_mall': malls[rng.integers(len(malls), size=n)],
+            }).to_csv(f, index=False, header=start == 0)
+    os.replace(path + '.tmp', path)
+
+
+def prepare_data_dir(rows):
+    """
+    Returns a folder holding a generated sales_data.csv of rows rows and a
+    copy of the mall details and customers, generating them on the first run
+    """
+    data_dir = os.path.join(BENCH_DIR, str(rows))
+    sales_path = os.path.join(data_dir, 'sales_data.csv')
+    if not os.path.exists(sales_path):
+        print(f'generating {rows:,} rows...', file=sys.stderr)
+        generate_sales_csv(sales_path, rows)
+    for name in ['shopping_mall_data.csv', 'customer_data.csv']:
+        shutil.copy(os.path.join(DATA_DIR, name), data_dir)
+    return data_dir
+
+
+def summary(times):
+    return {'min': min(times), 'median': statistics.median(times), 'max': max(times), 'repeat': len(times)}
+
+
+def timed(func, repeat):
+    """
+    Calls func() repeat times, returning the min, median and max wall time in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return summary(times)
+
+
+STARTUP_SCRIPT = """
+import json, time
+start = time.perf_counter()
+import ShinyApp
+imported = time.perf_counter()
+ShinyApp.start_loading()
+ShinyApp.STARTUP.wait()
+print(json.dumps({'import': imported - start, 'ready': time.perf_counter() - start}))
+"""
+
+
+def benchmark_startup(repeat):
+    """
+    Times the import of ShinyApp.py, and the time until its background
+    startup is done, each in a fresh interpreter so nothing is imported yet
+    """
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, '-c', STARTUP_SCRIPT], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout
+        runs.append(json.loads(out.splitlines()[-1]))
+    return {'timings': {f'startup.{step}': summary([run[step] for run in runs]) for step in ['import', 'ready']}}
+
+
+def benchmark_size(rows, repeat):
+    data_dir = prepare_data_dir(rows)
+    results = {}
+
+    def cold_load():
+        shutil.rmtree(os.path.join(data_dir, '.cache'), ignore_errors=True)
+        app.prepare_datasets(data_dir)
+
+    results['prepare_datasets.cold'] = timed(cold_load, 1)
+    results['prepare_datasets.warm'] = timed(lambda: app.prepare_datasets(data_dir), repeat)
+    frame, mall_details, cube, customers, customer_cube, _ = app.prepare_datasets(data_dir)
+    results['segment_customers'] = timed(lambda: segment_customers(frame.rows(), customers), repeat)
+    segments = segment_customers(frame.rows(), customers)
+
+    year, mall = app.DEFAULT_YEAR, app.DEFAULT_MALL
+    one_mall = app.DEFAULT_PLOT_MALLS[0]
+    chains = {
+        'filter_date_range(90 days)': lambda: app.filter_date_range(frame, *app.DEFAULT_WINDOW_DAYS, mall),
+        'revenue_cube': lambda: app.cube_year_mall(cube, year, mall),
+        'category_cube(one mall)': lambda: app.cube_year_mall(cube, year, one_mall),
+        'revenue_summary(every year)': lambda: summarize(app.cube_year_mall(cube, None, mall)),
+        'category_summary': lambda: summarize(app.cube_year_mall(cube, year, mall)),
+    }
+    for name, chain in chains.items():
+        results[f'filter.{name}'] = timed(chain, repeat)
+
+    width, height, pixelratio = app.DEFAULT_PLOT_SIZE
+    plots = {
+        output_id: (lambda build=build: build(mall_details.rows()))
+        for output_id, build in app.STATIC_PLOTS.items()
+    }
+    sources = {'sales': frame, 'cube': cube, 'customer_cube': customer_cube, 'segments': segments}
+    plots.update({
+        output_id: (lambda output_id=output_id: app.CHARTS[output_id](
+            app.chart_data(sources, output_id, *app.DEFAULT_VIEW[output_id]), *app.DEFAULT_VIEW[output_id]
+        ))
+        for output_id in app.CHARTS
+    })
+    for output_id, build in plots.items():
+        results[f'render.{output_id}.build'] = timed(build, repeat)
+        results[f'render.{output_id}.draw'] = timed(
+            lambda build=build: render_plot_png(build(), width, height, pixelratio), repeat
+        )
+    return {'rows': rows, 'csv_bytes': os.path.getsize(os.path.join(data_dir, 'sales_data.csv')), 'timings': results}
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Lists the timings whose median got slower than the baseline by more than tolerance
+    """
+    runs = [('startup', results['startup'], baseline.get('startup', {}))]
+    runs += [
+        (f'{int(size):,} rows', run, baseline.get('sizes', {}).get(size, {}))
+        for size, run in results['sizes'].items()
+    ]
+    slower = []
+    for label, run, before in runs:
+        before = before.get('timings', {})
+        for name, timing in run['timings'].items():
+            if name in before and timing['median'] > before[name]['median'] * (1 + tolerance):
+                slower.append((label, name, before[name]['median'], timing['median']))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark loading, filtering and rendering on synthetic sales data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='number of sales rows to benchmark')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of every timing, the median is compared')
+    parser.add_argument('--output', default=None, help='where to write the JSON results (default: benchmark-<time>.json)')
+    parser.add_argument('--baseline', default=None, help='JSON results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown over the baseline, 0.25 = 25%%')
+    parser.add_argument(
+        '--import-budget', type=float, default=IMPORT_BUDGET_SECONDS,
+        help='longest allowed median import of ShinyApp.py, in seconds (default: MALL_IMPORT_BUDGET or 1.5)'
+    )
+    args = parser.parse_args()
+    # The data of ShinyApp itself is loaded first, so it doesn't overlap the timings
+    app.start_loading()
+    app.STARTUP.wait()
+
+    started = datetime.now(timezone.utc)
+    results = {
+        'started': started.isoformat(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'machine': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'sizes': {},
+    }
+    print('benchmarking the startup...', file=sys.stderr)
+    results['startup'] = benchmark_startup(args.repeat)
+    for rows in args.sizes:
+        print(f'benchmarking {rows:,} rows...', file=sys.stderr)
+        results['sizes'][str(rows)] = benchmark_size(rows, args.repeat)
+
+    output = args.output or f'benchmark-{started:%Y%m%d-%H%M%S}.json'
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'results written to {output}')
+
+    runs = [('startup', results['startup'])]
+    runs += [(f'{int(size):,} rows', run) for size, run in results['sizes'].items()]
+    for label, run in runs:
+        print(f'\n{label}')
+        for name, timing in run['timings'].items():
+            print(f'  {name:<80} {timing["median"] * 1000:>10.1f} ms')
+
+    failed = False
+    imported = results['startup']['timings']['startup.import']['median']
+    if imported > args.import_budget:
+        print(f'OVER BUDGET importing ShinyApp.py took {imported:.2f}s, the budget is {args.import_budget:.2f}s')
+        failed = True
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = regressions(results, json.load(f), args.tolerance)
+        for label, name, before, after in slower:
+            print(f'REGRESSION {label} {name}: {before * 1000:.1f} ms -> {after * 1000:.1f} ms')
+        failed = failed or bool(slower)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
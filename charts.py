@@ -0,0 +1,426 @@
+"""
+The plotnine charts of the dashboard.
+
+Every chart is a plain function of the shared data (the mall details table,
+the aggregate cube, or the summary of a slice of it from aggregates.summarize())
+and the raw input values it depends on, so it can be built inside a session,
+by the render cache, or without any Shiny session at all.
+The small series each chart plots are computed by the *_series functions,
+shared with the browser-drawn charts of client_charts.py.
+"""
+import pandas as pd
+from plotnine import ggplot, aes, geom_bar, geom_line, geom_point, geom_text
+from plotnine import theme_minimal, theme, labs, scale_x_continuous, scale_y_continuous, element_text, coord_flip
+
+from aggregates import slice_cube, summary_years, month_number
+from customers import CUSTOMER_ATTRIBUTE_LABELS
+
+MONTH_LABELS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+def _selected_malls(mall):
+    return None if mall == 'All' else [mall]
+
+
+def _years_label(years):
+    return ', '.join(str(year) for year in years)
+
+
+# Nav Bar 1: Mall Details
+def mall_store_count(mall_details):
+    df = mall_details[['shopping_mall', 'store_count']]
+
+    return (
+        ggplot(data=df)
+        + aes(x='shopping_mall', y='store_count')
+        + geom_bar(stat='identity', color='black', fill='blue')
+        + geom_text(
+            aes(label='store_count'),
+            va='top',
+            position='identity',
+            nudge_y = 0.11 * df['store_count'].max()
+        )
+        + labs(
+            title = f'Number of stores per mall',
+            x='Mall',
+            y='# of Stores'
+        )
+        + theme_minimal()
+        + theme(axis_text_x=element_text(rotation=45, ha='right'))
+    )
+
+
+def mall_area(mall_details):
+    df = mall_details[['shopping_mall', 'store_size_per_sqm']]
+    df = df.assign(label=df['store_size_per_sqm'].apply(lambda x: f'{x:,.2f} sqm'))
+
+    return (
+        ggplot(data=df)
+        + aes(x='shopping_mall', y='store_size_per_sqm')
+        + geom_bar(stat='identity', color='black', fill='blue')
+        + geom_text(
+            aes(label='label'),
+            va='center',
+            position='identity',
+            nudge_y = 0.07 * df['store_size_per_sqm'].max()
+        )
+        + coord_flip()
+        + labs(
+            title = 'Compactness of mall',
+            x='Mall',
+            y='Area per store (mall_area / store_count)'
+        )
+        + theme_minimal()
+    )
+
+
+# Nav Bar 2: Revenue
+# Both charts take the tuple of years picked, and compare them when there are several
+def monthly_revenue_series(summary, years):
+    monthly, _ = summary_years(summary, years)
+    return monthly[['Year', 'Month', 'price']].assign(year=monthly['Year'].astype(str))
+
+
+def mall_revenue_series(cube, years):
+    df = slice_cube(cube, years=years)
+    df = df.groupby(['Year', 'shopping_mall'], observed=True)[['price']].sum().reset_index().sort_values('price')
+    return df.assign(year=df['Year'].astype(str))
+
+
+def line_monthly_revenue(summary, years, mall):
+    df = monthly_revenue_series(summary, years)
+    compare = len(years) > 1
+
+    return (
+        ggplot(df)
+        + (aes(x='Month', y='price', color='year') if compare else aes(x='Month', y='price'))
+        + geom_line()
+        + (geom_point() if compare else geom_point(color='black'))
+        + scale_x_continuous(
+            breaks= [i + 1 for i in range(12)],
+            labels=MONTH_LABELS
+        )
+        + labs(
+            title=f'Monthly Revenue ({_years_label(years)})',
+            x='Month',
+            y='Revenue',
+            color='Year'
+        )
+        + theme_minimal()
+    )
+
+
+def bar_mall_revenue(cube, years):
+    df = mall_revenue_series(cube, years)
+    title = f'Total revenue per mall ({_years_label(years)})'
+
+    if len(years) > 1:
+        return (
+            ggplot(data=df)
+            + aes(x='shopping_mall', y='price', fill='year')
+            + geom_bar(stat='identity', position='dodge', color='black')
+            + labs(title=title, x='Mall', y='Revenue', fill='Year')
+            + theme_minimal()
+            + theme(axis_text_x=element_text(rotation=45, ha='right'))
+        )
+
+    df['label'] = df['price'].apply(lambda x: f"$ {x:,.2f}")
+    return (
+        ggplot(data=df)
+        + aes(x='shopping_mall', y='price')
+        + geom_bar(stat='identity', color='black', fill='blue')
+        + geom_text(
+            aes(label='label'),
+            va='top',
+            position='identity',
+            nudge_y = 0.11 * df['price'].max()
+        )
+        + labs(
+            title = title,
+            x='Mall',
+            y='Revenue'
+        )
+        + theme_minimal()
+        + theme(axis_text_x=element_text(rotation=45, ha='right'))
+    )
+
+
+def daily_revenue(daily_totals, first, last, mall):
+    where = 'all malls' if mall == 'All' else mall
+
+    return (
+        ggplot(daily_totals)
+        + aes(x='Date', y='price')
+        + geom_line()
+        + labs(
+            title=f'Daily revenue in {where} ({first} to {last})',
+            x='Day',
+            y='Revenue'
+        )
+        + theme_minimal()
+        + theme(axis_text_x=element_text(rotation=45, ha='right'))
+    )
+
+
+# Nav Bar 3: Product Categories
+def one_month_by_category_series(summary, month, column):
+    month = month_number(month)
+    if month is None:
+        df = summary['by_category']
+    else:
+        df = summary['by_month_category']
+        df = df[df['Month'] == month]
+    return pd.DataFrame({
+        'category': df['category'].cat.remove_unused_categories().to_numpy(),
+        column: df[column].to_numpy(),
+    })
+
+
+def monthly_category_series(cube):
+    return cube.groupby(['Month', 'category'], observed=True)['invoice_no'].sum().reset_index()
+
+
+def monthly_mall_series(cube, year, malls, category):
+    df = slice_cube(cube, year=int(year), malls=list(malls), categories=[category])
+    return df.groupby(['Month', 'shopping_mall'], observed=True)['invoice_no'].sum().reset_index()
+
+
+def one_month_categorical_sales(summary, year, mall, month):
+    df = one_month_by_category_series(summary, month, 'invoice_no')
+
+    return (
+        ggplot(data=df)
+        + aes(x='category', y='invoice_no')
+        + geom_bar(stat='identity', color='black', fill='blue')
+        + geom_text(
+            aes(label='invoice_no'),
+            va='top',
+            position='identity',
+            nudge_y = 0.11 * df['invoice_no'].max()
+        )
+        + labs(
+            title = f'Number of transactions per category ({month} {year})',
+            x='Category',
+            y='# of Transactions'
+        )
+        + theme_minimal()
+        + theme(axis_text_x=element_text(rotation=45, ha='right'))
+    )
+
+
+def one_month_categorical_quantity(summary, year, mall, month):
+    df = one_month_by_category_series(summary, month, 'quantity')
+
+    return (
+        ggplot(data=df)
+        + aes(x='category', y='quantity')
+        + geom_bar(stat='identity', color='black', fill='blue')
+        + geom_text(
+            aes(label='quantity'),
+            va='top',
+            position='identity',
+            nudge_y = 0.11 * df['quantity'].max()
+        )
+        + labs(
+            title = f'Quantity bought per category ({month} {year})',
+            x='Category',
+            y='# of Transactions'
+        )
+        + theme_minimal()
+        + theme(axis_text_x=element_text(rotation=45, ha='right'))
+    )
+
+
+def one_month_categorical_revenue(summary, year, mall, month):
+    df = one_month_by_category_series(summary, month, 'price')
+    df['price_details'] = df['price'].apply(lambda x: f'$ {x:,.2f}k')
+
+    return (
+        ggplot(data=df)
+        + aes(x='category', y='price')
+        + geom_bar(stat='identity', color='black', fill='blue')
+        + geom_text(
+            aes(label='price_details'),
+            va='top',
+            position='identity',
+            nudge_y = 0.11 * df['price'].max()
+        )
+        + labs(
+            title = f'Revenue earned per category ({month} {year})',
+            x='Category',
+            y='Revenue'
+        )
+        + theme_minimal()
+        + theme(axis_text_x=element_text(rotation=45, ha='right'))
+    )
+
+
+def monthly_categorical_sales(cube, mall):
+    df = monthly_category_series(cube)
+    title_1 = 'Transactions in the' if mall != 'All' else 'Transactions in'
+    title_2 = 'Mall' if mall != 'All' else 'Malls'
+
+    return (
+        ggplot(data=df)
+        + aes(x='Month', y='invoice_no', color='category')
+        + geom_line()
+        + geom_point()
+        + labs(
+            title=f'{title_1} {mall} {title_2}',
+            x='Month',
+            y='Number of Transactions',
+            color='Category'
+        )
+        + scale_x_continuous(
+            breaks= [i + 1 for i in range(12)],
+            labels=MONTH_LABELS
+        )
+    )
+
+
+def monthly_mall_category_sales(cube, year, malls, category):
+    if not category:
+        return ggplot() + labs(title="Select a specific category.")
+
+    df = monthly_mall_series(cube, year, malls, category)
+
+    return (
+        ggplot(data=df)
+        + aes(x='Month', y='invoice_no', color='shopping_mall')
+        + geom_line()
+        + geom_point()
+        + labs(
+            title=f'Number of {category} sales per mall',
+            x='Month',
+            y='Number of Transactions',
+            color='Malls'
+        )
+        + scale_x_continuous(
+            breaks= [i + 1 for i in range(12)],
+            labels=MONTH_LABELS
+        )
+    )
+
+
+# Nav Bar 4: Customers
+def customer_revenue_series(cube, year, mall, attribute):
+    df = slice_cube(cube, year=int(year), malls=_selected_malls(mall))
+    df = df.groupby(attribute, observed=True)[['price', 'invoice_no']].sum().reset_index()
+    total = df['price'].sum()
+    df['share'] = df['price'] / total * 100 if total else 0.0
+    return df
+
+
+def customer_mall_series(cube, year, attribute):
+    df = slice_cube(cube, year=int(year))
+    return df.groupby(['shopping_mall', attribute], observed=True)[['price']].sum().reset_index()
+
+
+def _customer_revenue_bars(cube, year, mall, attribute):
+    df = customer_revenue_series(cube, year, mall, attribute)
+    df['label'] = df['share'].apply(lambda x: f'{x:.1f}%')
+    label = CUSTOMER_ATTRIBUTE_LABELS[attribute]
+    where = 'all malls' if mall == 'All' else mall
+
+    return (
+        ggplot(data=df)
+        + aes(x=attribute, y='price')
+        + geom_bar(stat='identity', color='black', fill='blue')
+        + geom_text(
+            aes(label='label'),
+            va='top',
+            position='identity',
+            nudge_y = 0.11 * df['price'].max() if len(df) else 0
+        )
+        + labs(
+            title = f'Revenue per {label.lower()} in {where} ({year})',
+            x=label,
+            y='Revenue'
+        )
+        + theme_minimal()
+    )
+
+
+def revenue_by_age_band(cube, year, mall):
+    return _customer_revenue_bars(cube, year, mall, 'age_band')
+
+
+def revenue_by_gender(cube, year, mall):
+    return _customer_revenue_bars(cube, year, mall, 'gender')
+
+
+def revenue_by_payment_method(cube, year, mall):
+    return _customer_revenue_bars(cube, year, mall, 'payment_method')
+
+
+def customer_revenue_per_mall(cube, year, attribute):
+    df = customer_mall_series(cube, year, attribute)
+    label = CUSTOMER_ATTRIBUTE_LABELS[attribute]
+
+    return (
+        ggplot(data=df)
+        + aes(x='shopping_mall', y='price', fill=attribute)
+        + geom_bar(stat='identity', position='fill', color='black')
+        + scale_y_continuous(labels=lambda shares: [f'{share:.0%}' for share in shares])
+        + labs(
+            title = f'Share of revenue per {label.lower()} in every mall ({year})',
+            x='Mall',
+            y='Share of revenue',
+            fill=label
+        )
+        + theme_minimal()
+        + theme(axis_text_x=element_text(rotation=45, ha='right'))
+    )
+
+
+# Nav Bar 5: Customer Segments
+def segment_size_series(profiles):
+    df = profiles[['segment', 'customers', 'revenue_share']].copy()
+    df['label'] = df['revenue_share'].apply(lambda x: f'{x:.1f}%')
+    return df
+
+
+def segment_mall_series(cube, year):
+    df = slice_cube(cube, year=int(year))
+    return df.groupby(['shopping_mall', 'segment'], observed=True)[['price']].sum().reset_index()
+
+
+def segment_sizes(profiles):
+    df = segment_size_series(profiles)
+
+    return (
+        ggplot(data=df)
+        + aes(x='segment', y='customers')
+        + geom_bar(stat='identity', color='black', fill='blue')
+        + geom_text(
+            aes(label='label'),
+            va='top',
+            position='identity',
+            nudge_y = 0.11 * df['customers'].max() if len(df) else 0
+        )
+        + labs(
+            title = 'Customers per segment (label: share of revenue)',
+            x='Segment',
+            y='# of Customers'
+        )
+        + theme_minimal()
+    )
+
+
+def segment_revenue_per_mall(cube, year):
+    df = segment_mall_series(cube, year)
+
+    return (
+        ggplot(data=df)
+        + aes(x='shopping_mall', y='price', fill='segment')
+        + geom_bar(stat='identity', position='fill', color='black')
+        + scale_y_continuous(labels=lambda shares: [f'{share:.0%}' for share in shares])
+        + labs(
+            title = f'Share of revenue per customer segment in every mall ({year})',
+            x='Mall',
+            y='Share of revenue',
+            fill='Segment'
+        )
+        + theme_minimal()
+        + theme(axis_text_x=element_text(rotation=45, ha='right'))
+    )
@@ -0,0 +1,348 @@
+"""
+Browser-drawn versions of the input-dependent charts of charts.py.
+
+Instead of a PNG drawn on the server, each chart is sent as a small Vega-Lite
+spec holding only its aggregated series (at most a few hundred numbers), and
+the browser draws it with vega-embed. Picked with MALL_CHART_MODE=client.
+
+With MALL_PROGRESSIVE=1 the PNG mode sends these specs too, as the
+preliminary of a chart not drawn yet: the browser draws the spec at once with
+a Preliminary badge, and the server drawn PNG replaces it when it is ready
+(see progressive_chart).
+"""
+from shiny import ui
+from shiny.render.renderer import Renderer
+
+from charts import (
+    CUSTOMER_ATTRIBUTE_LABELS, MONTH_LABELS, monthly_revenue_series, mall_revenue_series,
+    one_month_by_category_series, monthly_category_series, monthly_mall_series, customer_revenue_series,
+    customer_mall_series, segment_size_series, segment_mall_series
+)
+
+VEGA_LITE_SCHEMA = 'https://vega.github.io/schema/vega-lite/v5.json'
+CHART_HEIGHT = '400px'
+
+# vega-embed and the output binding drawing the specs sent by vega_chart
+HEAD = ui.TagList(
+    ui.tags.script(src='https://cdn.jsdelivr.net/npm/vega@5'),
+    ui.tags.script(src='https://cdn.jsdelivr.net/npm/vega-lite@5'),
+    ui.tags.script(src='https://cdn.jsdelivr.net/npm/vega-embed@6'),
+    ui.tags.script("""
+        (function() {
+            var binding = new Shiny.OutputBinding();
+            $.extend(binding, {
+                find: function(scope) {
+                    return $(scope).find('.mall-vega-output');
+                },
+                renderValue: function(el, spec) {
+                    if (el.vegaView) {
+                        el.vegaView.finalize();
+                        el.vegaView = null;
+                    }
+                    if (!spec) return;
+                    vegaEmbed(el, spec, {actions: false}).then(function(result) {
+                        el.vegaView = result.view;
+                    });
+                }
+            });
+            Shiny.outputBindings.register(binding, 'mall.vegaOutput');
+        })();
+    """),
+)
+
+# HEAD, and the output binding of progressive_chart: a Vega-Lite spec is drawn
+# as a preliminary chart, an image as the final one
+PROGRESSIVE_HEAD = ui.TagList(
+    HEAD,
+    ui.tags.style("""
+        .mall-progressive-output { position: relative; }
+        .mall-progressive-output.preliminary.recalculating { opacity: 1; }
+        .mall-progressive-chart { width: 100%; height: 100%; }
+        .mall-preliminary-badge {
+            position: absolute; top: 4px; right: 4px; padding: 1px 8px; border-radius: 8px;
+            background: #fff3cd; color: #664d03; font-size: 0.8em;
+        }
+    """),
+    ui.tags.script("""
+        (function() {
+            var binding = new Shiny.OutputBinding();
+            $.extend(binding, {
+                find: function(scope) {
+                    return $(scope).find('.mall-progressive-output');
+                },
+                renderValue: function(el, value) {
+                    if (el.vegaView) {
+                        el.vegaView.finalize();
+                        el.vegaView = null;
+                    }
+                    $(el).empty().toggleClass('preliminary', !!(value && value.spec));
+                    if (!value) return;
+                    if (value.spec) {
+                        var chart = $('<div class="mall-progressive-chart">').appendTo(el)[0];
+                        $('<span class="mall-preliminary-badge">Preliminary</span>').appendTo(el);
+                        vegaEmbed(chart, value.spec, {actions: false}).then(function(result) {
+                            // The final image may have replaced the chart already
+                            if (chart.parentNode === el) el.vegaView = result.view;
+                            else result.view.finalize();
+                        });
+                        return;
+                    }
+                    var img = document.createElement('img');
+                    $.each(value, function(name, attr) { img.setAttribute(name, attr); });
+                    el.appendChild(img);
+                }
+            });
+            Shiny.outputBindings.register(binding, 'mall.progressiveOutput');
+        })();
+    """),
+)
+
+
+def output_vega(id, height=CHART_HEIGHT):
+    return ui.div(id=id, class_='mall-vega-output', style=f'width: 100%; height: {height};')
+
+
+def output_progressive(id, height=CHART_HEIGHT):
+    # shiny-report-size makes the browser report the size the PNG is drawn at
+    return ui.div(id=id, class_='mall-progressive-output shiny-report-size', style=f'width: 100%; height: {height};')
+
+
+class vega_chart(Renderer[dict]):
+    """
+    Sends a Vega-Lite spec to an output_vega(), drawn by the browser
+    """
+    def auto_output_ui(self):
+        return output_vega(self.output_id)
+
+    async def transform(self, value):
+        return dict(value)
+
+
+class progressive_chart(Renderer[dict]):
+    """
+    Sends to an output_progressive() either {'spec': a Vega-Lite spec}, drawn
+    by the browser as a preliminary chart, or the image data of its PNG
+    (see png_image_data() of render_cache.py)
+    """
+    def auto_output_ui(self):
+        return output_progressive(self.output_id)
+
+    async def transform(self, value):
+        return dict(value)
+
+
+def _records(df):
+    """
+    The rows of df as JSON-ready dicts, with categorical labels as plain strings
+    and amounts rounded to the cent
+    """
+    df = df.astype({col: str for col in df.columns if df[col].dtype == 'category'})
+    return df.round(2).to_dict('records')
+
+
+def _spec(title, df, **spec):
+    return {
+        '$schema': VEGA_LITE_SCHEMA,
+        'title': title,
+        'width': 'container',
+        'height': 'container',
+        'autosize': {'type': 'fit', 'contains': 'padding'},
+        'data': {'values': _records(df)},
+        **spec,
+    }
+
+
+def _month_axis(title='Month'):
+    return {'field': 'month', 'type': 'ordinal', 'sort': MONTH_LABELS, 'title': title}
+
+
+def _with_month_labels(df):
+    return df.assign(month=[MONTH_LABELS[int(month) - 1] for month in df['Month']])
+
+
+def _labelled_bars(title, df, x, x_title, y, y_title, label=None, sort=None):
+    label = label or y
+    encoding = {
+        'x': {'field': x, 'type': 'nominal', 'title': x_title, 'sort': sort, 'axis': {'labelAngle': -45}},
+        'y': {'field': y, 'type': 'quantitative', 'title': y_title},
+    }
+    return _spec(
+        title, df,
+        encoding=encoding,
+        layer=[
+            {'mark': {'type': 'bar', 'color': 'blue', 'stroke': 'black'}, 'encoding': {'tooltip': [{'field': label}]}},
+            {'mark': {'type': 'text', 'dy': -6}, 'encoding': {'text': {'field': label}}},
+        ],
+    )
+
+
+def _monthly_lines(title, df, color, color_title, y_title):
+    return _spec(
+        title, _with_month_labels(df),
+        mark={'type': 'line', 'point': True},
+        encoding={
+            'x': _month_axis(),
+            'y': {'field': 'invoice_no', 'type': 'quantitative', 'title': y_title},
+            'color': {'field': color, 'type': 'nominal', 'title': color_title},
+            'tooltip': [{'field': color}, {'field': 'month'}, {'field': 'invoice_no', 'title': y_title}],
+        },
+    )
+
+
+# Nav Bar 2: Revenue
+def line_monthly_revenue(summary, years, mall):
+    df = _with_month_labels(monthly_revenue_series(summary, years).drop(columns='Year'))
+    encoding = {
+        'x': _month_axis(),
+        'y': {'field': 'price', 'type': 'quantitative', 'title': 'Revenue'},
+        'tooltip': [{'field': 'year'}, {'field': 'month'}, {'field': 'price', 'title': 'Revenue', 'format': '$,.2f'}],
+    }
+    if len(years) > 1:
+        encoding['color'] = {'field': 'year', 'type': 'nominal', 'title': 'Year'}
+    return _spec(
+        f'Monthly Revenue ({", ".join(years)})', df,
+        mark={'type': 'line', 'point': True if len(years) > 1 else {'color': 'black'}},
+        encoding=encoding,
+    )
+
+
+def bar_mall_revenue(cube, years):
+    df = mall_revenue_series(cube, years).drop(columns='Year')
+    title = f'Total revenue per mall ({", ".join(years)})'
+    if len(years) > 1:
+        return _spec(
+            title, df,
+            mark={'type': 'bar', 'stroke': 'black'},
+            encoding={
+                'x': {'field': 'shopping_mall', 'type': 'nominal', 'title': 'Mall', 'axis': {'labelAngle': -45}},
+                'xOffset': {'field': 'year'},
+                'y': {'field': 'price', 'type': 'quantitative', 'title': 'Revenue'},
+                'color': {'field': 'year', 'type': 'nominal', 'title': 'Year'},
+                'tooltip': [{'field': 'shopping_mall'}, {'field': 'year'}, {'field': 'price', 'format': '$,.2f'}],
+            },
+        )
+    df = df.assign(label=df['price'].apply(lambda x: f"$ {x:,.2f}"))
+    return _labelled_bars(
+        title, df, 'shopping_mall', 'Mall', 'price', 'Revenue',
+        label='label', sort='y'
+    )
+
+
+def daily_revenue(daily_totals, first, last, mall):
+    where = 'all malls' if mall == 'All' else mall
+    return _spec(
+        f'Daily revenue in {where} ({first} to {last})', daily_totals.assign(Date=daily_totals['Date'].dt.strftime('%Y-%m-%d')),
+        mark={'type': 'line'},
+        encoding={
+            'x': {'field': 'Date', 'type': 'temporal', 'title': 'Day'},
+            'y': {'field': 'price', 'type': 'quantitative', 'title': 'Revenue'},
+            'tooltip': [{'field': 'Date', 'type': 'temporal'}, {'field': 'price', 'title': 'Revenue', 'format': '$,.2f'},
+                        {'field': 'invoice_no', 'title': 'Transactions'}],
+        },
+    )
+
+
+# Nav Bar 3: Product Categories
+def one_month_categorical_sales(summary, year, mall, month):
+    df = one_month_by_category_series(summary, month, 'invoice_no')
+    return _labelled_bars(
+        f'Number of transactions per category ({month} {year})', df,
+        'category', 'Category', 'invoice_no', '# of Transactions'
+    )
+
+
+def one_month_categorical_quantity(summary, year, mall, month):
+    df = one_month_by_category_series(summary, month, 'quantity')
+    return _labelled_bars(
+        f'Quantity bought per category ({month} {year})', df,
+        'category', 'Category', 'quantity', '# of Transactions'
+    )
+
+
+def one_month_categorical_revenue(summary, year, mall, month):
+    df = one_month_by_category_series(summary, month, 'price')
+    df = df.assign(price_details=df['price'].apply(lambda x: f'$ {x:,.2f}k'))
+    return _labelled_bars(
+        f'Revenue earned per category ({month} {year})', df,
+        'category', 'Category', 'price', 'Revenue', label='price_details'
+    )
+
+
+def monthly_categorical_sales(cube, mall):
+    title_1 = 'Transactions in the' if mall != 'All' else 'Transactions in'
+    title_2 = 'Mall' if mall != 'All' else 'Malls'
+    return _monthly_lines(
+        f'{title_1} {mall} {title_2}', monthly_category_series(cube),
+        'category', 'Category', 'Number of Transactions'
+    )
+
+
+def monthly_mall_category_sales(cube, year, malls, category):
+    if not category:
+        # No category to slice the cube by: the chart of no sales
+        return _spec('Select a specific category.', cube.iloc[:0][['Month', 'shopping_mall', 'invoice_no']], mark='line')
+    return _monthly_lines(
+        f'Number of {category} sales per mall', monthly_mall_series(cube, year, malls, category),
+        'shopping_mall', 'Malls', 'Number of Transactions'
+    )
+
+
+# Nav Bar 4: Customers
+def _customer_revenue_bars(cube, year, mall, attribute):
+    df = customer_revenue_series(cube, year, mall, attribute)
+    df = df.assign(label=df['share'].apply(lambda x: f'{x:.1f}%'))
+    label = CUSTOMER_ATTRIBUTE_LABELS[attribute]
+    where = 'all malls' if mall == 'All' else mall
+    return _labelled_bars(
+        f'Revenue per {label.lower()} in {where} ({year})', df,
+        attribute, label, 'price', 'Revenue', label='label'
+    )
+
+
+def revenue_by_age_band(cube, year, mall):
+    return _customer_revenue_bars(cube, year, mall, 'age_band')
+
+
+def revenue_by_gender(cube, year, mall):
+    return _customer_revenue_bars(cube, year, mall, 'gender')
+
+
+def revenue_by_payment_method(cube, year, mall):
+    return _customer_revenue_bars(cube, year, mall, 'payment_method')
+
+
+def customer_revenue_per_mall(cube, year, attribute):
+    label = CUSTOMER_ATTRIBUTE_LABELS[attribute]
+    return _spec(
+        f'Share of revenue per {label.lower()} in every mall ({year})', customer_mall_series(cube, year, attribute),
+        mark={'type': 'bar', 'stroke': 'black'},
+        encoding={
+            'x': {'field': 'shopping_mall', 'type': 'nominal', 'title': 'Mall', 'axis': {'labelAngle': -45}},
+            'y': {'field': 'price', 'type': 'quantitative', 'title': 'Share of revenue',
+                  'stack': 'normalize', 'axis': {'format': '%'}},
+            'color': {'field': attribute, 'type': 'nominal', 'title': label},
+            'tooltip': [{'field': 'shopping_mall'}, {'field': attribute}, {'field': 'price', 'format': '$,.2f'}],
+        },
+    )
+
+
+# Nav Bar 5: Customer Segments
+def segment_sizes(profiles):
+    return _labelled_bars(
+        'Customers per segment (label: share of revenue)', segment_size_series(profiles),
+        'segment', 'Segment', 'customers', '# of Customers', label='label'
+    )
+
+
+def segment_revenue_per_mall(cube, year):
+    return _spec(
+        f'Share of revenue per customer segment in every mall ({year})', segment_mall_series(cube, year),
+        mark={'type': 'bar', 'stroke': 'black'},
+        encoding={
+            'x': {'field': 'shopping_mall', 'type': 'nominal', 'title': 'Mall', 'axis': {'labelAngle': -45}},
+            'y': {'field': 'price', 'type': 'quantitative', 'title': 'Share of revenue',
+                  'stack': 'normalize', 'axis': {'format': '%'}},
+            'color': {'field': 'segment', 'type': 'nominal', 'title': 'Segment'},
+            'tooltip': [{'field': 'shopping_mall'}, {'field': 'segment'}, {'field': 'price', 'format': '$,.2f'}],
+        },
+    )
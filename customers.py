@@ -0,0 +1,98 @@
+"""
+The customer dimension of the dashboard.
+
+customer_data.csv is loaded once into a CustomerTable indexed by customer_id.
+Every sale is joined to it once, at load time, through an integer surrogate
+key (the position of its customer in the table), and the revenue is
+aggregated once into a Year x mall x age band x gender x payment method cube,
+so the Customers tab only ever slices a few hundred rows.
+"""
+import numpy as np
+import pandas as pd
+
+from dataset_cache import concat_frames
+
+AGE_BANDS = ['18-24', '25-34', '35-44', '45-54', '55-64', '65+']
+AGE_BAND_EDGES = [0, 25, 35, 45, 55, 65, np.inf]
+# Label of the attributes of a sale whose customer is not in customer_data.csv
+UNKNOWN = 'Unknown'
+CUSTOMER_ATTRIBUTES = ['age_band', 'gender', 'payment_method']
+CUSTOMER_ATTRIBUTE_LABELS = {'age_band': 'Age band', 'gender': 'Gender', 'payment_method': 'Payment method'}
+
+
+class CustomerTable:
+    """
+    The customers, with a hash index from customer_id to their position,
+    which is the surrogate key sales are joined on
+    """
+    def __init__(self, df):
+        self._index = pd.Index(df['customer_id'])
+        if not self._index.is_unique:
+            raise ValueError('customer_data.csv lists a customer_id more than once')
+        self._ages = df['age'].astype('float64').to_numpy()
+        age_band = pd.cut(self._ages, AGE_BAND_EDGES, right=False, labels=AGE_BANDS)
+        # Attribute codes of every customer, with one more row for unknown customers
+        self._attributes = {}
+        for col, values in [('age_band', age_band), ('gender', df['gender']), ('payment_method', df['payment_method'])]:
+            values = pd.Categorical(values)
+            dtype = pd.CategoricalDtype([*values.categories, UNKNOWN])
+            codes = np.append(pd.Categorical(values, dtype=dtype).codes, dtype.categories.get_loc(UNKNOWN))
+            codes[codes < 0] = dtype.categories.get_loc(UNKNOWN)
+            self._attributes[col] = (codes, dtype)
+
+    def __len__(self):
+        return len(self._index)
+
+    def ages(self):
+        """
+        Returns the age of every customer, by surrogate key (NaN when unknown)
+        """
+        return self._ages
+
+    def keys(self, customer_ids):
+        """
+        Returns the surrogate keys of customer_ids, -1 for the unknown ones
+        """
+        return self._index.get_indexer(customer_ids).astype(np.int32)
+
+    def attributes(self, keys):
+        """
+        Returns the age band, gender and payment method of the customers of keys
+        """
+        keys = np.where(keys < 0, len(self), keys)
+        return pd.DataFrame({
+            col: pd.Categorical.from_codes(codes[keys], dtype=dtype)
+            for col, (codes, dtype) in self._attributes.items()
+        })
+
+
+def build_customer_cube(sales, customers):
+    """
+    Aggregates the sales (with their customer_key) into a
+    Year x mall x age band x gender x payment method cube of revenue (price),
+    quantity and number of transactions (invoice_no)
+    """
+    df = pd.concat([
+        sales[['Year', 'shopping_mall']].reset_index(drop=True),
+        customers.attributes(sales['customer_key'].to_numpy()),
+    ], axis=1)
+    df['price'] = sales['price'].to_numpy().astype('float64').round(2)
+    df['quantity'] = sales['quantity'].to_numpy()
+    df['invoice_no'] = 1
+    return (
+        df.groupby(['Year', 'shopping_mall', *CUSTOMER_ATTRIBUTES], observed=True)
+        [['price', 'quantity', 'invoice_no']].sum()
+        .reset_index()
+    )
+
+
+def add_to_customer_cube(cube, rows, customers):
+    """
+    Returns the customer cube updated with new sales rows (with their customer_key)
+    """
+    return (
+        concat_frames(cube, build_customer_cube(rows, customers))
+        .groupby(['Year', 'shopping_mall', *CUSTOMER_ATTRIBUTES], observed=True)
+        [['price', 'quantity', 'invoice_no']].sum()
+        .reset_index()
+    )
@@ -0,0 +1,418 @@
+"""
+Typed columnar cache for the CSV files in the Datasets folder.
+
+Parsing sales_data.csv (and its invoice dates) is the slowest part of booting
+the dashboard, so the parsed and typed frames are written once as uncompressed
+Feather files under Datasets/.cache and memory-mapped on later boots.
+Every column is written as a single chunk, so it is used in place, without
+copying (see attach_feather()).
+A cache file is rebuilt whenever the mtime, size or hash of its source CSV
+changes. Hashing reads the whole CSV, which is still far cheaper than parsing
+it; MALL_CACHE_VERIFY_HASH=0 skips it and only compares the mtime and size.
+
+Run this file to prebuild every cache (used by the buildCommand in render.yaml):
+    python dataset_cache.py [--force] [--report]
+With MALL_STREAMING_LOAD=1 the sales are prebuilt by the streaming loader of
+stream_loader.py instead, under the same memory ceiling as the app.
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # No file locks (Windows): concurrent builds then only rely on replacing()
+    fcntl = None
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BASE_DIR, "Datasets")
+CACHE_DIR = os.path.join(DATA_DIR, ".cache")
+# Drop-in CSV files of new invoices (same columns as sales_data.csv), merged
+# into the running dashboard. Write them elsewhere and move them in, so they
+# are never read half-written.
+INCOMING_DIR = os.path.join(DATA_DIR, "incoming")
+# The choices of the pickers, saved with the caches (see dimensions.py)
+DIMENSIONS_PATH = os.path.join(CACHE_DIR, "dimensions.json")
+
+# Bump whenever a reader below changes the layout of the frame it returns,
+# so that caches written by older code get rebuilt
+CACHE_VERSION = 4
+
+# Declared layout (column order and dtype) of every parsed frame.
+# Repeated labels are categoricals, so filters compare small integer codes.
+# invoice_no and customer_id are (nearly) unique per row, where a categorical
+# would only add a codes array on top of the strings, so they stay Arrow strings.
+# Month and Year are kept next to invoice_date as 1 and 2 byte integers
+# because every filter and the aggregate cube are keyed on them.
+SALES_SCHEMA = {
+    'invoice_no': 'string[pyarrow]',
+    'customer_id': 'string[pyarrow]',
+    'category': 'category',
+    'quantity': 'int8',
+    'price': 'float32',
+    'invoice_date': 'datetime64[ns]',
+    'shopping_mall': 'category',
+    'Month': 'int8',
+    'Year': 'int16',
+}
+
+MALL_SCHEMA = {
+    'shopping_mall': 'string[pyarrow]',
+    'construction_year': 'int16',
+    'area (sqm)': 'int32',
+    'location': 'string[pyarrow]',
+    'store_count': 'int16',
+    'store_size_per_sqm': 'float64',
+}
+
+CUSTOMER_SCHEMA = {
+    'customer_id': 'string[pyarrow]',
+    'gender': 'category',
+    'age': 'Int8',
+    'payment_method': 'category',
+}
+
+
+def apply_schema(df, schema):
+    """
+    Returns df with exactly the columns of schema, in order, cast to their declared dtypes
+    """
+    return df[list(schema)].astype(schema)
+
+
+def memory_report(before, after):
+    """
+    Compares the per-column memory (in bytes) of a frame before and after applying its schema
+    """
+    report = pd.DataFrame({
+        'dtype_before': before.dtypes.astype(str),
+        'bytes_before': before.memory_usage(index=False, deep=True),
+        'dtype_after': after.dtypes.astype(str),
+        'bytes_after': after.memory_usage(index=False, deep=True),
+    })
+    report.loc['TOTAL', ['bytes_before', 'bytes_after']] = report[['bytes_before', 'bytes_after']].sum()
+    return report
+
+
+def parse_sales(raw):
+    """
+    Converts the raw sales CSV frame into SALES_SCHEMA, sorted by invoice_date
+    """
+    mall = raw.copy()
+    mall['invoice_date'] = pd.to_datetime(mall['invoice date'])
+    mall['Month'] = mall['invoice_date'].dt.month
+    mall['Year'] = mall['invoice_date'].dt.year
+
+    mall = apply_schema(mall, SALES_SCHEMA)
+    mall = mall.sort_values("invoice_date")
+    return mall.reset_index(drop=True)
+
+
+SALES_CSV_DTYPES = {col: dtype for col, dtype in SALES_SCHEMA.items() if col not in ('invoice_date', 'Month', 'Year')}
+
+
+def read_sales_csv(path):
+    """
+    Parses the sales CSV into the frame used by the dashboard, sorted by invoice_date
+    """
+    return parse_sales(pd.read_csv(path, dtype=SALES_CSV_DTYPES))
+
+
+def read_sales_rows(path, offset):
+    """
+    Parses only the complete lines of the sales CSV after the byte offset
+    (the end of the rows already loaded). Returns the parsed rows and the
+    offset to continue from, which stops before a line still being written.
+    """
+    with open(path, 'rb') as f:
+        header = f.readline()
+        f.seek(max(offset, len(header)))
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    if end == 0:
+        return parse_sales(pd.read_csv(io.BytesIO(header), dtype=SALES_CSV_DTYPES)), offset
+    rows = pd.read_csv(io.BytesIO(header + data[:end]), dtype=SALES_CSV_DTYPES)
+    return parse_sales(rows), max(offset, len(header)) + end
+
+
+def concat_frames(*frames):
+    """
+    Concatenates frames of the same schema. Categorical columns stay
+    categorical, with the union of the categories of every frame.
+    """
+    frames = list(frames)
+    for col in frames[0].columns:
+        if not isinstance(frames[0][col].dtype, pd.CategoricalDtype):
+            continue
+        categories = frames[0][col].cat.categories
+        for df in frames[1:]:
+            categories = categories.append(df[col].cat.categories.difference(categories))
+        dtype = pd.CategoricalDtype(categories)
+        frames = [df.assign(**{col: df[col].astype(dtype)}) for df in frames]
+    return pd.concat(frames, ignore_index=True)
+
+
+def read_mall_csv(path):
+    """
+    Parses the mall details CSV, reading the "250,000" areas as integers,
+    and precomputes the area per store of each mall
+    """
+    mall_details = pd.read_csv(path, thousands=',')
+    mall_details['store_size_per_sqm'] = mall_details['area (sqm)'] / mall_details['store_count']
+    return apply_schema(mall_details, MALL_SCHEMA)
+
+
+def read_customer_csv(path):
+    """
+    Parses the customer CSV with categorical gender and payment method columns
+    """
+    return apply_schema(pd.read_csv(path, dtype=CUSTOMER_SCHEMA), CUSTOMER_SCHEMA)
+
+
+READERS = {
+    'sales_data.csv': read_sales_csv,
+    'shopping_mall_data.csv': read_mall_csv,
+    'customer_data.csv': read_customer_csv,
+}
+
+
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_fingerprint(path, with_hash=True):
+    """
+    Returns the mtime, size and (optionally) sha256 of a source file
+    """
+    stat = os.stat(path)
+    fingerprint = {'version': CACHE_VERSION, 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+    if with_hash:
+        fingerprint['sha256'] = file_hash(path)
+    return fingerprint
+
+
+def cache_paths(csv_path):
+    """
+    Returns the cache and fingerprint paths of csv_path, kept in a .cache
+    folder next to it (CACHE_DIR for the files of the Datasets folder)
+    """
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(csv_path)), '.cache')
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(cache_dir, f'{name}.feather'), os.path.join(cache_dir, f'{name}.json')
+
+
+def is_fresh(csv_path, verify_hash=False):
+    """
+    Checks whether the cache of csv_path was built from the current file.
+    The mtime and size are always compared, the hash only with verify_hash,
+    since hashing reads the whole file.
+    """
+    data_path, meta_path = cache_paths(csv_path)
+    if not (os.path.exists(data_path) and os.path.exists(meta_path)):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    current = source_fingerprint(csv_path, with_hash=False)
+    if any(meta.get(key) != value for key, value in current.items()):
+        return False
+    return not verify_hash or meta.get('sha256') == file_hash(csv_path)
+
+
+@contextmanager
+def cache_lock(directory):
+    """
+    Holds an exclusive lock on a cache folder, shared by every process using
+    it, so that workers booting together on a cold cache build each file once:
+    the others wait for the lock, then find the file fresh
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, '.lock'), 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def replacing(path, suffix='.tmp'):
+    """
+    Yields a temporary path, unique to this call, to write the new content of
+    path to. It is renamed over path once written, so a reader never sees a
+    half-written file, and removed if the writing fails.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.', suffix=suffix)
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def build_cache(csv_path, reader=None):
+    """
+    Parses csv_path and writes its Feather cache and fingerprint.
+    Both files are written to a temporary name first (see replacing()), so a
+    worker booting at the same time never reads a half-written cache.
+    """
+    reader = reader or READERS[os.path.basename(csv_path)]
+    data_path, meta_path = cache_paths(csv_path)
+    os.makedirs(os.path.dirname(data_path), exist_ok=True)
+
+    fingerprint = source_fingerprint(csv_path)
+    df = reader(csv_path)
+
+    with replacing(data_path) as tmp_path:
+        feather.write_feather(df, tmp_path, compression='uncompressed', chunksize=max(len(df), 1))
+    with replacing(meta_path) as tmp_path:
+        with open(tmp_path, 'w') as f:
+            json.dump(fingerprint, f)
+    return df
+
+
+def cached_fingerprint(csv_path):
+    """
+    Returns the fingerprint of the source file the cache of csv_path was built from
+    """
+    with open(cache_paths(csv_path)[1]) as f:
+        return json.load(f)
+
+
+def ensure_cache(csv_path, reader=None, verify_hash=None):
+    """
+    Rebuilds the cache of csv_path unless it is fresh, returning the path of its Feather file
+    """
+    if verify_hash is None:
+        verify_hash = os.environ.get('MALL_CACHE_VERIFY_HASH', '1') == '1'
+    if not is_fresh(csv_path, verify_hash=verify_hash):
+        with cache_lock(os.path.dirname(cache_paths(csv_path)[0])):
+            if not is_fresh(csv_path, verify_hash=verify_hash):
+                build_cache(csv_path, reader)
+    return cache_paths(csv_path)[0]
+
+
+def _column_values(column):
+    """
+    Converts a single chunk Arrow column to pandas values without copying it
+    """
+    chunk = column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()
+    if pa.types.is_dictionary(chunk.type):
+        categories = pd.CategoricalDtype(chunk.dictionary.to_pandas())
+        return pd.Categorical.from_codes(chunk.indices.to_numpy(zero_copy_only=True), dtype=categories, validate=False)
+    if pa.types.is_string(chunk.type) or pa.types.is_large_string(chunk.type):
+        return pd.arrays.ArrowStringArray(pa.chunked_array([chunk]))
+    if chunk.null_count == 0 and (pa.types.is_integer(chunk.type) or pa.types.is_floating(chunk.type)
+                                  or pa.types.is_timestamp(chunk.type)):
+        return chunk.to_numpy(zero_copy_only=True)
+    if pa.types.is_integer(chunk.type):
+        # Integers with missing values, as the nullable dtype (e.g. Int8) they were written from
+        name = chunk.type.to_pandas_dtype().__name__
+        dtype = pd.api.types.pandas_dtype(name.replace('uint', 'UInt').replace('int', 'Int'))
+        return dtype.__from_arrow__(pa.chunked_array([chunk]))
+    return chunk.to_pandas()
+
+
+def attach_feather(path):
+    """
+    Returns the frame of an uncompressed Feather file, with every column
+    memory-mapped read-only (numeric, date and categorical code columns)
+    or wrapping the mapped Arrow buffers (string columns)
+    """
+    table = feather.read_table(path, memory_map=True)
+    columns = {name: _column_values(table.column(name)) for name in table.column_names}
+    return pd.DataFrame(columns, copy=False)
+
+
+def load_dataset(csv_path, reader=None, verify_hash=None):
+    """
+    Returns the parsed frame of csv_path, memory-mapping its cache when it is
+    fresh (see attach_feather()) and rebuilding it otherwise.
+    verify_hash defaults to the MALL_CACHE_VERIFY_HASH environment variable.
+    """
+    if verify_hash is None:
+        verify_hash = os.environ.get('MALL_CACHE_VERIFY_HASH', '1') == '1'
+    data_path, _ = cache_paths(csv_path)
+    if not is_fresh(csv_path, verify_hash=verify_hash):
+        with cache_lock(os.path.dirname(data_path)):
+            if not is_fresh(csv_path, verify_hash=verify_hash):
+                return build_cache(csv_path, reader)
+    return attach_feather(data_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prebuild the columnar caches of the Datasets folder')
+    parser.add_argument('--force', action='store_true', help='rebuild even the caches that are fresh')
+    parser.add_argument('--report', action='store_true', help='print the per-column memory of the sales frame before and after its schema')
+    args = parser.parse_args()
+
+    if args.report:
+        raw = pd.read_csv(os.path.join(DATA_DIR, 'sales_data.csv'))
+        print(memory_report(raw, parse_sales(raw)).to_string())
+
+    streaming = os.environ.get('MALL_STREAMING_LOAD', '0') == '1'
+    for name in READERS:
+        path = os.path.join(DATA_DIR, name)
+        if streaming and name == 'sales_data.csv':
+            continue
+        if not os.path.exists(path):
+            print(f'{name}: not found, skipped')
+        elif not args.force and is_fresh(path, verify_hash=True):
+            print(f'{name}: cache is fresh')
+        else:
+            df = build_cache(path)
+            print(f'{name}: cached {len(df):,} rows')
+
+    if streaming:
+        # Imported here, stream_loader builds on this module
+        import logging
+        from customers import CustomerTable
+        from stream_loader import ensure_stream_cache, stream_cache_paths, stream_fingerprint_path
+
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+        sales_path, customer_path = os.path.join(DATA_DIR, 'sales_data.csv'), os.path.join(DATA_DIR, 'customer_data.csv')
+        if args.force:
+            for stale in [*stream_cache_paths(sales_path), stream_fingerprint_path(sales_path)]:
+                if os.path.exists(stale):
+                    os.remove(stale)
+        ensure_stream_cache(sales_path, customer_path, CustomerTable(load_dataset(customer_path)))
+        print('sales_data.csv: streamed cache is fresh')
+
+    # The choices of the pickers, so the first page served after a deploy has
+    # them before the app loaded any data (imported here, they build on this module)
+    from aggregates import build_sales_cube
+    from dimensions import Dimensions
+    from shared_frame import SharedFrame
+    from stream_loader import stream_cache_paths
+
+    sales_path = os.path.join(DATA_DIR, 'sales_data.csv')
+    if os.path.exists(sales_path):
+        if streaming:
+            kept_path, cube_path, _ = stream_cache_paths(sales_path)
+            sales, cube = SharedFrame(attach_feather(kept_path)), attach_feather(cube_path)
+        else:
+            sales = SharedFrame(load_dataset(sales_path))
+            cube = build_sales_cube(sales.rows())
+        Dimensions.build(sales, cube).save(DIMENSIONS_PATH)
+        print(f'dimensions: saved to {DIMENSIONS_PATH}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Debounced filter inputs.
+
+Clicking through several mall checkboxes or months sends every intermediate
+value to the server, and each one would invalidate the calcs and charts
+reading that input, drawing results nobody gets to see. debounced() holds an
+input back until it stopped changing for MALL_FILTER_DEBOUNCE_MS (300 ms by
+default, 0 turns it off), then passes it on only when it differs from the
+value passed on last: toggling a checkbox on and off again invalidates nothing.
+
+A chart already rendering in RENDER_POOL when its inputs change is abandoned
+by cached_plot() in ShinyApp.py. The changes passed on and coalesced are
+counted in the mall_filter_changes_total metric.
+"""
+import os
+import time
+
+from shiny import reactive
+
+from metrics import FILTER_CHANGES
+
+DEBOUNCE_SECONDS = int(os.environ.get('MALL_FILTER_DEBOUNCE_MS', '300')) / 1000
+# The effects of debounced() run before the outputs reading them
+PRIORITY = 100
+
+
+def debounced(source, name, delay=DEBOUNCE_SECONDS):
+    """
+    Returns a reactive value following source(), once it stopped changing for
+    delay seconds and only when its value changed. The first value is passed
+    on at once, so the first paint of a session is not delayed.
+    """
+    settled = reactive.Value()
+    deadline = reactive.Value(None)
+    latest = {}
+
+    @reactive.effect(priority=PRIORITY)
+    def _watch():
+        latest['value'] = source()
+        with reactive.isolate():
+            if not settled.is_set():
+                settled.set(latest['value'])
+                return
+            if deadline() is not None:
+                # The change still waiting is superseded by this one
+                FILTER_CHANGES.inc(name, 'coalesced')
+            deadline.set(time.monotonic() + delay)
+
+    @reactive.effect(priority=PRIORITY)
+    def _settle():
+        due = deadline()
+        if due is None:
+            return
+        remaining = due - time.monotonic()
+        if remaining > 0:
+            reactive.invalidate_later(remaining)
+            return
+        with reactive.isolate():
+            deadline.set(None)
+            if settled() == latest['value']:
+                FILTER_CHANGES.inc(name, 'coalesced')
+            else:
+                FILTER_CHANGES.inc(name, 'applied')
+                settled.set(latest['value'])
+
+    return settled
+
+
+class DebouncedInputs:
+    """
+    The debounced() values of some inputs of a session, read as filters.<id>()
+    like input.<id>(). Created once per session, in server().
+    """
+    def __init__(self, inputs, ids, delay=DEBOUNCE_SECONDS):
+        if delay > 0:
+            self._values = {id: debounced(inputs[id], id, delay) for id in ids}
+        else:
+            self._values = {id: inputs[id] for id in ids}
+
+    def __getattr__(self, id):
+        try:
+            return self._values[id]
+        except KeyError:
+            raise AttributeError(f'{id!r} is not a debounced input') from None
@@ -0,0 +1,118 @@
+"""
+The values the dashboard filters on, as found in the data.
+
+The choices of the mall, category, year and month pickers are read from a
+Dimensions built once per load of the sales (see prepare_datasets() in
+ShinyApp.py), so a new mall or year in the data shows up in the pickers
+without any code change, and a picker can't offer a value the data doesn't
+hold. Every mall and category has an id, its code in the categorical column
+of the sales frame, and the filters compare those integer codes rather than
+the names (see category_codes()).
+
+A selection the data doesn't hold raises UnknownSelection at once, instead of
+filtering everything down to an empty frame.
+
+The last Dimensions is also saved as JSON next to the columnar caches, so the
+UI built at import already has the choices of the data loaded last time.
+"""
+import json
+import os
+
+
+class UnknownSelection(ValueError):
+    """
+    A picked value that is not in the data
+    """
+
+
+def category_codes(column, values):
+    """
+    Returns the codes of values in a categorical column, raising
+    UnknownSelection for any value it doesn't hold
+    """
+    values = list(values)
+    codes = column.cat.categories.get_indexer(values)
+    if (codes < 0).any():
+        unknown = ', '.join(repr(value) for value, code in zip(values, codes) if code < 0)
+        raise UnknownSelection(f'no {column.name} {unknown} in the data')
+    return codes
+
+
+class Dimensions:
+    """
+    The malls and categories of the sales, each with its id, the months
+    of every year sold in, and the day of the last sale (as an ISO date)
+    """
+    def __init__(self, malls, categories, months, last_day=None):
+        self.mall_ids = {mall: i for i, mall in enumerate(malls)}
+        self.category_ids = {category: i for i, category in enumerate(categories)}
+        # {year: [months]}, as strings and month numbers like the pickers use them
+        self.months = {str(year): sorted(int(month) for month in year_months) for year, year_months in months.items()}
+        self.last_day = last_day
+
+    @classmethod
+    def build(cls, sales, cube):
+        """
+        Builds the Dimensions of a sales SharedFrame and of its aggregate cube
+        """
+        periods = cube[['Year', 'Month']].drop_duplicates()
+        months = {}
+        for year, month in zip(periods['Year'].to_numpy(), periods['Month'].to_numpy()):
+            months.setdefault(int(year), []).append(month)
+        return cls(
+            sales.categories('shopping_mall').tolist(), sales.categories('category').tolist(),
+            dict(sorted(months.items())), sales.last('invoice_date').date().isoformat() if len(sales) else None
+        )
+
+    @property
+    def malls(self):
+        return sorted(self.mall_ids)
+
+    @property
+    def categories(self):
+        return sorted(self.category_ids)
+
+    @property
+    def years(self):
+        return sorted(self.months, key=int)
+
+    def check(self, years=(), malls=(), categories=()):
+        """
+        Raises UnknownSelection for any of the years, malls (other than 'All')
+        or categories the data doesn't hold
+        """
+        for name, values, known in [('year', years, self.months), ('mall', malls, self.mall_ids),
+                                    ('category', categories, self.category_ids)]:
+            unknown = [value for value in values if value not in known and not (name == 'mall' and value == 'All')]
+            if unknown:
+                raise UnknownSelection(f'no {name} {", ".join(map(repr, unknown))} in the data')
+
+    def to_dict(self):
+        return {
+            'malls': list(self.mall_ids), 'categories': list(self.category_ids), 'months': self.months,
+            'last_day': self.last_day,
+        }
+
+    def __eq__(self, other):
+        # Equal when the pickers show the same choices, whatever the last day
+        return isinstance(other, Dimensions) and (
+            (self.mall_ids, self.category_ids, self.months) == (other.mall_ids, other.category_ids, other.months)
+        )
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns the Dimensions saved at path, or None when there are none
+        """
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+            return cls(saved['malls'], saved['categories'], saved['months'], saved.get('last_day'))
+        except (OSError, ValueError, KeyError):
+            return None
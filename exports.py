@@ -0,0 +1,144 @@
+"""
+Exports of the filtered sales and of their aggregates, as CSV or Parquet.
+
+A selection of several million sales would take gigabytes as one frame, then
+as one CSV string, so an export never builds either: the rows are read in
+frames of CHUNK_ROWS straight from the shared sales (SharedFrame.chunks_between()),
+and every frame is converted and sent before the next one is read. A Parquet
+export writes one row group per frame, drained as soon as it is written.
+
+Each frame is read and converted in a worker thread (see stream()), so the
+event loop keeps serving the other sessions while a large export runs.
+"""
+import asyncio
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+CHUNK_ROWS = int(os.environ.get('MALL_EXPORT_CHUNK_ROWS', '100000'))
+
+# The columns of an exported sale, as in sales_data.csv. With
+# MALL_STREAMING_LOAD=1 invoice_no and customer_id are not kept (see
+# stream_loader.py), so they are left out of the export.
+EXPORT_COLUMNS = ['invoice_no', 'customer_id', 'invoice_date', 'shopping_mall', 'category', 'quantity', 'price']
+
+# The media type and extension of every format
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+# The sums of the aggregates, named after what they count
+TOTAL_COLUMNS = {'invoice_no': 'transactions', 'price': 'revenue', 'price_change': 'revenue_change',
+                 'price_growth': 'revenue_growth'}
+
+_DONE = object()
+
+
+def export_filename(name, fmt):
+    return f'{name}.{EXPORT_FORMATS[fmt][1]}'
+
+
+def sales_chunks(frame, ranges, size=CHUNK_ROWS, **filters):
+    """
+    Yields the sales of a SharedFrame in the [start, stop) date ranges
+    matching the filters (see SharedFrame.positions()), in frames of at most
+    size rows. An empty frame is yielded when no sale matches, so the export
+    still has its columns.
+    """
+    columns = [col for col in EXPORT_COLUMNS if col in frame.columns]
+    empty = True
+    for start, stop in ranges:
+        for chunk in frame.chunks_between(start, stop, size, **filters):
+            if len(chunk):
+                empty = False
+                yield chunk[columns]
+    if empty:
+        start = ranges[0][0]
+        yield frame.rows_between(start, start)[columns]
+
+
+def csv_chunks(frames):
+    """
+    Yields the CSV text of every frame, the first one with the header
+    """
+    header = True
+    for frame in frames:
+        yield frame.to_csv(index=False, header=header)
+        header = False
+
+
+class _Sink:
+    """
+    The file a ParquetWriter writes to, keeping the bytes written until drain()
+    """
+    def __init__(self):
+        self.closed = False
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data, self._parts = b''.join(self._parts), []
+        return data
+
+
+def parquet_chunks(frames):
+    """
+    Yields the bytes of a Parquet file holding every frame, one row group per frame
+    """
+    sink = _Sink()
+    writer = None
+    try:
+        for frame in frames:
+            table = pa.Table.from_pandas(frame, schema=writer.schema if writer else None, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(sink, table.schema)
+            writer.write_table(table)
+            yield sink.drain()
+    finally:
+        if writer is not None:
+            writer.close()
+    # The footer
+    yield sink.drain()
+
+
+async def stream(chunks):
+    """
+    Yields the chunks of a generator, each one made in a worker thread
+    """
+    chunks = iter(chunks)
+    try:
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, _DONE)
+            if chunk is _DONE:
+                return
+            yield chunk
+    finally:
+        chunks.close()
+
+
+def export(frames, fmt):
+    """
+    Returns the async iterator of the bytes or text of frames exported as fmt,
+    for a render.download_button()
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f'unknown export format {fmt!r}')
+    return stream(csv_chunks(frames) if fmt == 'csv' else parquet_chunks(frames))
+
+
+def export_totals(totals, fmt):
+    """
+    export() of a frame of aggregates, small enough to be sent in one chunk
+    """
+    return export([totals.rename(columns=TOTAL_COLUMNS)], fmt)
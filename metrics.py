@@ -0,0 +1,207 @@
+"""
+Latency instrumentation of the dashboard outputs.
+
+Every reactive calc and render function of server() is wrapped with
+@instrument, which records per execution (i.e. per invalidation):
+    - the wall time
+    - its split between producing chart images (time spent inside draw_phase())
+      and the rest, which is the pandas work of filtering and aggregating
+    - the rows of the frame it returned
+    - whether its chart came from the render cache (see cache_result())
+The histograms are served in the Prometheus text format by metrics_endpoint,
+and with MALL_METRICS_LOG=1 every execution is also logged as one JSON line
+on the "mall.metrics" logger.
+"""
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+from starlette.responses import PlainTextResponse
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROWS_BUCKETS = (10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+logger = logging.getLogger('mall.metrics')
+LOG_EXECUTIONS = os.environ.get('MALL_METRICS_LOG', '0') == '1'
+
+
+class Histogram:
+    """
+    A Prometheus-style histogram with one series per output id
+    """
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, output_id, value):
+        with self._lock:
+            series = self._series.get(output_id)
+            if series is None:
+                series = self._series[output_id] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def exposition(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for output_id, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series['counts']):
+                    lines.append(f'{self.name}_bucket{{output="{output_id}",le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{output="{output_id}",le="+Inf"}} {series["count"]}')
+                lines.append(f'{self.name}_sum{{output="{output_id}"}} {series["sum"]}')
+                lines.append(f'{self.name}_count{{output="{output_id}"}} {series["count"]}')
+        return lines
+
+
+class Counter:
+    """
+    A Prometheus-style counter with one series per (output id, result)
+    """
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, output_id, result):
+        with self._lock:
+            self._values[(output_id, result)] = self._values.get((output_id, result), 0) + 1
+
+    def exposition(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for (output_id, result), value in sorted(self._values.items()):
+                lines.append(f'{self.name}{{output="{output_id}",result="{result}"}} {value}')
+        return lines
+
+
+WALL_SECONDS = Histogram('mall_output_seconds', 'Wall time of an output or calc execution', SECONDS_BUCKETS)
+PANDAS_SECONDS = Histogram('mall_output_pandas_seconds', 'Time spent filtering and aggregating (wall time minus drawing)', SECONDS_BUCKETS)
+DRAW_SECONDS = Histogram('mall_output_draw_seconds', 'Time spent building and drawing a chart, or waiting for its render', SECONDS_BUCKETS)
+ROWS = Histogram('mall_output_rows', 'Rows of the frame returned by a calc', ROWS_BUCKETS)
+CACHE = Counter('mall_plot_cache_total', 'Chart requests answered from the render cache (hit) or rendered (miss)')
+FILTER_CHANGES = Counter(
+    'mall_filter_changes_total',
+    'Filter input changes passed on to the outputs (applied) or dropped as superseded or unchanged (coalesced)'
+)
+METRICS = [WALL_SECONDS, PANDAS_SECONDS, DRAW_SECONDS, ROWS, CACHE, FILTER_CHANGES]
+
+# The timings of the executions in progress, innermost last. A calc pulled in
+# by an output runs inside that output's execution.
+_executions = contextvars.ContextVar('mall_metrics_executions', default=())
+
+
+@contextmanager
+def draw_phase():
+    """
+    Counts the time spent in the with block as drawing, for every execution in progress
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        for execution in _executions.get():
+            execution['draw'] += elapsed
+
+
+def cache_result(output_id, hit):
+    """
+    Records whether the chart of output_id was a render cache hit
+    """
+    CACHE.inc(output_id, 'hit' if hit else 'miss')
+    executions = _executions.get()
+    if executions:
+        executions[-1]['cache'] = 'hit' if hit else 'miss'
+
+
+def _start(name):
+    execution = {'output': name, 'draw': 0.0, 'cache': None, 'start': time.perf_counter()}
+    return execution, _executions.set(_executions.get() + (execution,))
+
+
+def _finish(execution, token, result):
+    _executions.reset(token)
+    name = execution['output']
+    wall = time.perf_counter() - execution['start']
+    WALL_SECONDS.observe(name, wall)
+    DRAW_SECONDS.observe(name, execution['draw'])
+    PANDAS_SECONDS.observe(name, max(0.0, wall - execution['draw']))
+    rows = len(result) if isinstance(result, pd.DataFrame) else None
+    if rows is not None:
+        ROWS.observe(name, rows)
+    if LOG_EXECUTIONS:
+        logger.info(json.dumps({
+            'output': name,
+            'wall_ms': round(wall * 1000, 3),
+            'pandas_ms': round(max(0.0, wall - execution['draw']) * 1000, 3),
+            'draw_ms': round(execution['draw'] * 1000, 3),
+            'rows': rows,
+            'cache': execution['cache'],
+        }))
+
+
+def instrument(func):
+    """
+    Wraps a calc or render function (sync or async) to record its executions,
+    put it below the @reactive.Calc / @render.* decorator
+    """
+    name = func.__name__
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            execution, token = _start(name)
+            result = None
+            try:
+                result = await func(*args, **kwargs)
+                return result
+            finally:
+                _finish(execution, token, result)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            execution, token = _start(name)
+            result = None
+            try:
+                result = func(*args, **kwargs)
+                return result
+            finally:
+                _finish(execution, token, result)
+    return wrapper
+
+
+def exposition(extra_lines=()):
+    """
+    Returns every metric in the Prometheus text format
+    """
+    lines = []
+    for metric in METRICS:
+        lines += metric.exposition()
+    lines += extra_lines
+    return '\n'.join(lines) + '\n'
+
+
+def gauge_lines(name, help, value):
+    return [f'# HELP {name} {help}', f'# TYPE {name} gauge', f'{name} {value}']
+
+
+def metrics_endpoint(extra=lambda: ()):
+    """
+    Returns a Starlette endpoint serving exposition(), plus the lines returned by extra()
+    """
+    async def endpoint(request):
+        return PlainTextResponse(exposition(extra()), media_type='text/plain; version=0.0.4')
+    return endpoint
@@ -0,0 +1,358 @@
+"""
+Process-wide cache of the rendered chart images.
+
+A chart is fully determined by its output id, the inputs it depends on, the
+version of the data and the size it is drawn at, so the PNG drawn for one
+session can be sent as-is to every other session asking for the same view.
+"""
+import asyncio
+import base64
+import io
+import json
+import multiprocessing
+import os
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+
+from shiny import ui
+from shiny.render.renderer import Renderer
+
+
+def figure_to_png(fig, width, height, pixelratio=1):
+    """
+    Saves a matplotlib figure as PNG bytes of width x height CSS pixels,
+    the same way shiny's render.plot sizes its figures
+    """
+    # pyplot is only imported once a chart is drawn, off the import path of the app
+    import matplotlib.pyplot as plt
+    try:
+        ppi = fig.get_dpi()
+        fig.set_size_inches(width / ppi, height / ppi)
+        fig.set_dpi(ppi * pixelratio)
+        if fig.get_layout_engine() is None:
+            fig.set_layout_engine(layout='tight')
+        with io.BytesIO() as buf:
+            fig.savefig(buf, format='png', dpi=ppi * pixelratio)
+            return buf.getvalue()
+    finally:
+        plt.close(fig)
+
+
+def png_image_data(png, width='100%', height='100%', **attrs):
+    """
+    Wraps PNG bytes into the image data an output_plot() displays,
+    any extra attrs are set as attributes of the <img> tag
+    """
+    return {
+        'src': 'data:image/png;base64,' + base64.b64encode(png).decode('utf-8'),
+        'width': width,
+        'height': height,
+        **attrs,
+    }
+
+
+class RenderCache:
+    """
+    A thread-safe LRU cache of PNG bytes bounded by their total size.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._rendering = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            png = self._entries.get(key)
+            if png is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return png
+
+    def put(self, key, png):
+        if len(png) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = png
+            self.size += len(png)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def get_or_render(self, key, render):
+        """
+        Returns the PNG cached under key, calling render() to draw it on a miss.
+        A key already being rendered by another thread is waited for, not drawn twice.
+        """
+        png = self.get(key)
+        if png is not None:
+            return png
+
+        with self._lock:
+            done = self._rendering.get(key)
+            owner = done is None
+            if owner:
+                done = self._rendering[key] = threading.Event()
+        if not owner:
+            done.wait()
+            png = self._entries.get(key)
+            if png is not None:
+                return png
+
+        try:
+            png = render()
+            self.put(key, png)
+            return png
+        finally:
+            if owner:
+                with self._lock:
+                    self._rendering.pop(key, None)
+                done.set()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+PLOT_CACHE = RenderCache(max_bytes=int(os.environ.get('MALL_PLOT_CACHE_MB', '64')) * 1024 * 1024)
+
+
+def plot_key(output_id, inputs, data_version, width, height, pixelratio):
+    """
+    The cache key of a chart: what it shows and the size it is drawn at
+    """
+    return (output_id, tuple(inputs), data_version, int(width), int(height), float(pixelratio))
+
+
+# pyplot keeps global figure state, so figures are drawn one at a time
+# even when the warm-up thread renders next to the sessions
+DRAW_LOCK = threading.Lock()
+
+
+def render_plot_png(plot, width, height, pixelratio=1):
+    """
+    Draws a plotnine ggplot into PNG bytes
+    """
+    with DRAW_LOCK:
+        return figure_to_png(plot.draw(), width, height, pixelratio)
+
+
+class AccessLog:
+    """
+    Counts how often each chart view (output id, inputs and size) is requested,
+    saved to a small JSON file so the counts survive restarts.
+    Only the max_views most requested views are kept past a save, since
+    inputs like the dates of daily_revenue make the views unbounded.
+    """
+    def __init__(self, path, save_every=50, max_views=500):
+        self.path = path
+        self.save_every = save_every
+        self.max_views = max_views
+        self._counts = Counter()
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        for output_id, inputs, width, height, pixelratio, count in entries:
+            # JSON turns the tuple inputs (e.g. several checked malls) into lists
+            inputs = tuple(tuple(value) if isinstance(value, list) else value for value in inputs)
+            self._counts[(output_id, inputs, width, height, pixelratio)] += count
+
+    def save(self):
+        with self._lock:
+            self._counts = Counter(dict(self._counts.most_common(self.max_views)))
+            entries = [[*view[:1], list(view[1]), *view[2:], count] for view, count in self._counts.items()]
+            self._unsaved = 0
+        with self._save_lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(entries, f)
+            os.replace(self.path + '.tmp', self.path)
+
+    def record(self, output_id, inputs, width, height, pixelratio):
+        """
+        Counts a request of a view, saving the counts every save_every requests
+        in a thread, off the event loop the outputs record from
+        """
+        with self._lock:
+            self._counts[(output_id, tuple(inputs), int(width), int(height), float(pixelratio))] += 1
+            self._unsaved += 1
+            should_save = self._unsaved >= self.save_every
+            if should_save:
+                self._unsaved = 0
+        if should_save:
+            threading.Thread(target=self.save, name='access-log', daemon=True).start()
+
+    def top(self, n):
+        """
+        Returns the n most requested views as (output_id, inputs, width, height, pixelratio)
+        """
+        with self._lock:
+            return [view for view, _ in self._counts.most_common(n)]
+
+    def common_size(self, output_id):
+        """
+        Returns the (width, height, pixelratio) an output is most often drawn at, or None
+        """
+        with self._lock:
+            sizes = Counter()
+            for (view_id, _, width, height, pixelratio), count in self._counts.items():
+                if view_id == output_id:
+                    sizes[(width, height, pixelratio)] += count
+        return sizes.most_common(1)[0][0] if sizes else None
+
+
+def warm_up(views, chart_data, charts, data_version, cache=PLOT_CACHE, pool=None):
+    """
+    Renders every (output_id, inputs, width, height, pixelratio) view into the
+    cache, skipping the ones already there. chart_data(output_id, *inputs)
+    returns the data of a view, drawn by charts[output_id], by a worker of the
+    pool when it is enabled so the warm-up never holds DRAW_LOCK against the
+    sessions. Returns the number of charts rendered.
+    """
+    rendered = 0
+    for output_id, inputs, width, height, pixelratio in views:
+        key = plot_key(output_id, inputs, data_version, width, height, pixelratio)
+        if key in cache:
+            continue
+        data = chart_data(output_id, *inputs)
+        if pool is not None and pool.enabled:
+            if pool.draw(key, output_id, data, inputs, width, height, pixelratio) is None:
+                # The pool was shut down, the process is exiting
+                break
+        else:
+            cache.get_or_render(key, lambda: render_plot_png(charts[output_id](data, *inputs), width, height, pixelratio))
+        rendered += 1
+    return rendered
+
+
+class plot_png(Renderer[dict]):
+    """
+    Sends the image data of an already rendered PNG (see png_image_data())
+    to an output_plot(), without any further drawing
+    """
+    def auto_output_ui(self):
+        return ui.output_plot(self.output_id)
+
+    async def transform(self, value):
+        return dict(value)
+
+
+def render_chart_png(chart_name, data, inputs, width, height, pixelratio):
+    """
+    Builds and draws a chart of charts.py, in a worker process of the render
+    pool or of report.py
+    """
+    import charts
+    return figure_to_png(getattr(charts, chart_name)(data, *inputs).draw(), width, height, pixelratio)
+
+
+class RenderPool:
+    """
+    Draws charts in a bounded pool of worker processes, so a slow matplotlib
+    draw never blocks the event loop every session is served from.
+    Sessions asking for the same chart share one render, and a render nobody
+    waits for anymore is cancelled if it hasn't started yet. Finished renders
+    are put in the cache even when their requester moved on.
+    """
+    def __init__(self, workers, cache=PLOT_CACHE):
+        self.workers = workers
+        self.cache = cache
+        self._executor = None
+        self._pending = {}
+
+    @property
+    def enabled(self):
+        return self.workers > 0
+
+    def _submit(self, key, chart_name, data, inputs, width, height, pixelratio):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context('spawn')
+            )
+        future = self._executor.submit(render_chart_png, chart_name, data, inputs, width, height, pixelratio)
+
+        def store(done):
+            if not done.cancelled() and done.exception() is None:
+                self.cache.put(key, done.result())
+        future.add_done_callback(store)
+        return future
+
+    def draw(self, key, chart_name, data, inputs, width, height, pixelratio):
+        """
+        Returns the PNG of chart_name(data, *inputs), drawn by a worker
+        process, blocking the calling thread (e.g. the warm-up), or None when
+        the pool is shut down meanwhile (at exit, concurrent.futures shuts it
+        down before shutdown() runs)
+        """
+        try:
+            future = self._submit(key, chart_name, data, inputs, width, height, pixelratio)
+        except RuntimeError:
+            return None
+        try:
+            return future.result()
+        except CancelledError:
+            return None
+
+    async def render(self, key, chart_name, data, inputs, width, height, pixelratio):
+        """
+        Returns the PNG of chart_name(data, *inputs), drawn by a worker process
+        """
+        entry = self._pending.get(key)
+        if entry is None:
+            future = asyncio.wrap_future(self._submit(key, chart_name, data, inputs, width, height, pixelratio))
+            entry = self._pending[key] = {'future': future, 'waiters': 0}
+            future.add_done_callback(lambda _: self._pending.pop(key, None))
+
+        entry['waiters'] += 1
+        try:
+            return await asyncio.shield(entry['future'])
+        finally:
+            entry['waiters'] -= 1
+            if entry['waiters'] == 0 and not entry['future'].done():
+                entry['future'].cancel()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+RENDER_POOL = RenderPool(
+    workers=int(os.environ.get('MALL_RENDER_WORKERS', max(0, (os.cpu_count() or 1) - 1)))
+)
@@ -0,0 +1,247 @@
+"""
+Renders the charts of the dashboard for every mall and year into a folder,
+without a Shiny session: the monthly report pack.
+
+The data is loaded the way the app loads it (ShinyApp.load_app()), and the
+charts are built by the functions of charts.py from the same data as the
+outputs of server(), given by ShinyApp.chart_data(). The drawing, which takes
+most of the time, is spread over a pool of worker processes. ShinyApp is only
+imported by main(), so the workers, which import this module again, don't
+load the data a second time: they only need render_cache and charts.
+
+    output/
+        manifest.json                   every chart: its inputs, file and size
+        mall_store_count.png, ...       the charts of no year or mall
+        <mall>/monthly_categorical_sales.png
+        <year>/bar_mall_revenue.png, ...         the charts of every mall of a year
+        <year>/<mall>/line_monthly_revenue.png, ...
+        <year>/<mall>/report.pdf        with --pdf, the charts of the mall and year
+
+    python report.py [--output report] [--years 2022 2023] [--malls All "The Grove"]
+                     [--workers 4] [--width 1100] [--height 400] [--pixelratio 2] [--pdf]
+"""
+import os
+
+# The report draws its charts in its own pool, with nothing rendering in the background
+os.environ.setdefault('MALL_WARMUP', '0')
+os.environ.setdefault('MALL_RENDER_WORKERS', '0')
+
+import argparse
+import json
+import multiprocessing
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+from functools import lru_cache
+
+import pandas as pd
+
+from customers import CUSTOMER_ATTRIBUTE_LABELS
+from dimensions import UnknownSelection
+from render_cache import render_chart_png
+
+# The charts drawn for every year and mall. Those not depending on the mall
+# (bar_mall_revenue, customer_revenue_per_mall, segment_revenue_per_mall) are
+# drawn once per year, monthly_categorical_sales once per mall.
+YEAR_MALL_CHARTS = [
+    'line_monthly_revenue', 'daily_revenue',
+    'one_month_categorical_sales', 'one_month_categorical_quantity', 'one_month_categorical_revenue',
+    'monthly_mall_category_sales', 'revenue_by_age_band', 'revenue_by_gender', 'revenue_by_payment_method',
+]
+
+
+def slug(name):
+    return re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-')
+
+
+def mall_dir(mall):
+    return 'all-malls' if mall == 'All' else slug(mall)
+
+
+class ReportData:
+    """
+    The data every chart of the report is drawn from, as ShinyApp.chart_data()
+    returns it for the data loaded by app
+    """
+    def __init__(self, app, segments):
+        self.app = app
+        self.sources = {**app.data_sources(), 'segments': segments}
+        self.last_sale_day = app.DEFAULT_DATE_RANGE[1]
+
+    @lru_cache(maxsize=None)
+    def year_days(self, year):
+        """
+        The first and last day of a year, up to the last sale
+        """
+        first = pd.Timestamp(year=int(year), month=1, day=1)
+        last = min(pd.Timestamp(year=int(year), month=12, day=31), self.last_sale_day)
+        return first.date().isoformat(), last.date().isoformat()
+
+    def __call__(self, output_id, *inputs):
+        if output_id in self.app.STATIC_PLOTS:
+            return self.app.mall_details.rows()
+        return self.app.chart_data(self.sources, output_id, *inputs)
+
+
+def report_views(data, years, malls, all_malls, category, static_plots):
+    """
+    Lists every chart of the report as (output_id, inputs, year, mall, path),
+    with its inputs as server() passes them. The monthly_mall_category_sales
+    charts are of category, the static_plots are drawn once.
+    """
+    views = []
+    for year in years:
+        for mall in malls:
+            where = os.path.join(year, mall_dir(mall))
+            inputs = {
+                'line_monthly_revenue': ((year,), mall),
+                'daily_revenue': (*data.year_days(year), mall),
+                'one_month_categorical_sales': (year, mall, 'All'),
+                'one_month_categorical_quantity': (year, mall, 'All'),
+                'one_month_categorical_revenue': (year, mall, 'All'),
+                'monthly_mall_category_sales': (
+                    year, tuple(all_malls) if mall == 'All' else (mall,), category
+                ),
+                'revenue_by_age_band': (year, mall),
+                'revenue_by_gender': (year, mall),
+                'revenue_by_payment_method': (year, mall),
+            }
+            views += [(output_id, inputs[output_id], year, mall, where) for output_id in YEAR_MALL_CHARTS]
+        views.append(('bar_mall_revenue', ((year,),), year, None, year))
+        views += [
+            ('customer_revenue_per_mall', (year, attribute), year, None, year)
+            for attribute in CUSTOMER_ATTRIBUTE_LABELS
+        ]
+        views.append(('segment_revenue_per_mall', (year,), year, None, year))
+    for mall in malls:
+        views.append(('monthly_categorical_sales', (mall,), None, mall, mall_dir(mall)))
+    views += [(output_id, (), None, None, '') for output_id in ['segment_sizes', *static_plots]]
+    return views
+
+
+def view_filename(output_id, inputs):
+    if output_id == 'customer_revenue_per_mall':
+        return f'{output_id}_{inputs[1]}.png'
+    return f'{output_id}.png'
+
+
+def render_views(views, data, size, workers):
+    """
+    Draws every view, in a pool of worker processes (in this one when
+    workers is 0). Yields every view with its PNG, or the error drawing it raised.
+    """
+    tasks = [(output_id, data(output_id, *inputs), inputs, *size) for output_id, inputs, *_ in views]
+    if workers == 0:
+        for view, task in zip(views, tasks):
+            try:
+                yield view, render_chart_png(*task), None
+            except Exception as e:
+                yield view, None, f'{type(e).__name__}: {e}'
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = {pool.submit(render_chart_png, *task): view for view, task in zip(views, tasks)}
+        for future in as_completed(futures):
+            error = future.exception()
+            yield futures[future], None if error else future.result(), error and f'{type(error).__name__}: {error}'
+
+
+def write_pdfs(output, entries):
+    """
+    Writes the charts of every year and mall, followed by the charts of every
+    mall of that year, into <year>/<mall>/report.pdf
+    """
+    from PIL import Image
+
+    def pages(paths):
+        return [Image.open(os.path.join(output, path)).convert('RGB') for path in paths]
+
+    charts = [entry for entry in entries if 'path' in entry]
+    written = []
+    for year in sorted({entry['year'] for entry in charts if entry['year'] and entry['mall']}):
+        year_paths = [entry['path'] for entry in charts if entry['year'] == year and entry['mall'] is None]
+        for mall in sorted({entry['mall'] for entry in charts if entry['year'] == year and entry['mall']}):
+            paths = [entry['path'] for entry in charts if entry['year'] == year and entry['mall'] == mall]
+            images = pages(paths + year_paths)
+            path = os.path.join(year, mall_dir(mall), 'report.pdf')
+            images[0].save(os.path.join(output, path), save_all=True, append_images=images[1:])
+            written.append(path)
+    return written
+
+
+def main():
+    # Imported here rather than with this module, see the docstring
+    import ShinyApp as app
+    from segments import segment_customers
+
+    parser = argparse.ArgumentParser(description='Render the dashboard charts of every mall and year into a folder')
+    parser.add_argument('--output', default='report', help='folder the charts and manifest.json are written to')
+    parser.add_argument('--years', nargs='+', default=None, help='years to report on (default: every year sold in)')
+    parser.add_argument('--malls', nargs='+', default=None, help="malls to report on, 'All' for every mall together (default: All and every mall)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='processes drawing the charts, 0 draws in this one')
+    parser.add_argument('--width', type=int, default=app.STATIC_PLOT_SIZE[0], help='width of the charts, in CSS pixels')
+    parser.add_argument('--height', type=int, default=app.STATIC_PLOT_SIZE[1], help='height of the charts, in CSS pixels')
+    parser.add_argument('--pixelratio', type=float, default=app.STATIC_PLOT_PIXELRATIO, help='device pixels per CSS pixel')
+    parser.add_argument('--pdf', action='store_true', help='also write one PDF per year and mall')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    app.start_loading()
+    app.STARTUP.wait()
+    all_malls = app.dimensions.malls
+    years = args.years or app.dimensions.years
+    malls = args.malls or ['All', *all_malls]
+    try:
+        app.dimensions.check(years=years, malls=malls)
+    except UnknownSelection as e:
+        parser.error(str(e))
+    segments = app.SEGMENTS.get(app.data_version) or segment_customers(app.mall_revenue_data.rows(), app.customers)
+    data = ReportData(app, segments)
+    loaded = time.perf_counter() - started
+
+    views = report_views(data, years, malls, all_malls, app.DEFAULT_PLOT_CATEGORY, app.STATIC_PLOTS)
+    os.makedirs(args.output, exist_ok=True)
+    print(f'rendering {len(views)} charts with {args.workers} workers...', file=sys.stderr)
+    entries, failed = [], 0
+    for (output_id, inputs, year, mall, where), png, error in render_views(
+        views, data, (args.width, args.height, args.pixelratio), args.workers
+    ):
+        entry = {'chart': output_id, 'year': year, 'mall': mall, 'inputs': inputs}
+        if error:
+            failed += 1
+            entry['error'] = error
+            print(f'FAILED {output_id} {inputs}: {error}', file=sys.stderr)
+        else:
+            path = os.path.join(where, view_filename(output_id, inputs))
+            os.makedirs(os.path.join(args.output, where), exist_ok=True)
+            with open(os.path.join(args.output, path), 'wb') as f:
+                f.write(png)
+            entry.update(path=path, bytes=len(png))
+        entries.append(entry)
+
+    pdfs = write_pdfs(args.output, entries) if args.pdf else []
+    order = {view[:2]: n for n, view in enumerate(views)}
+    entries.sort(key=lambda entry: order.get((entry['chart'], tuple(entry['inputs'])), -1))
+    manifest = {
+        'generated': datetime.now(timezone.utc).isoformat(),
+        'data_version': app.data_version,
+        'sales': app.sales_fingerprint(),
+        'years': years,
+        'malls': malls,
+        'size': {'width': args.width, 'height': args.height, 'pixelratio': args.pixelratio},
+        'seconds': {'load': round(loaded, 2), 'total': round(time.perf_counter() - started, 2)},
+        'charts': entries,
+        'pdfs': pdfs,
+    }
+    with open(os.path.join(args.output, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, default=str)
+    print(f'{len(entries) - failed} charts written to {args.output} in {manifest["seconds"]["total"]:.1f}s'
+          f' ({failed} failed)')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
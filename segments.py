@@ -0,0 +1,210 @@
+"""
+Customer segmentation: recency, frequency and monetary value (RFM) of every
+customer, clustered together with their age by a NumPy k-means.
+
+The segmentation of the whole dataset takes a few seconds, so it runs once per
+data version in a background thread (SegmentationJob) and sessions read the
+cached result.
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+N_SEGMENTS = int(os.environ.get('MALL_SEGMENTS', '5'))
+FEATURES = ['recency', 'frequency', 'monetary', 'age']
+
+logger = logging.getLogger(__name__)
+
+
+def rfm_features(sales, customers):
+    """
+    Returns one row per customer with at least one sale: its customer_key,
+    the days since its last purchase (recency), its number of purchases
+    (frequency), what it spent (monetary) and its age
+    """
+    keys = sales['customer_key'].to_numpy()
+    known = keys >= 0
+    keys = keys[known]
+    days = sales['invoice_date'].to_numpy()[known].astype('datetime64[D]').astype(np.int64)
+    price = sales['price'].to_numpy()[known].astype(np.float64)
+
+    frequency = np.bincount(keys, minlength=len(customers))
+    monetary = np.bincount(keys, weights=price, minlength=len(customers))
+    last_purchase = np.full(len(customers), np.iinfo(np.int64).min)
+    np.maximum.at(last_purchase, keys, days)
+
+    buyers = np.flatnonzero(frequency)
+    return pd.DataFrame({
+        'customer_key': buyers.astype(np.int32),
+        'recency': (days.max() + 1 - last_purchase[buyers]).astype(np.float64) if len(days) else np.empty(0),
+        'frequency': frequency[buyers].astype(np.float64),
+        'monetary': monetary[buyers].round(2),
+        'age': customers.ages()[buyers],
+    })
+
+
+def _nearest(points, centers, chunk_size=1_000_000):
+    """
+    Returns the index of the nearest center of every point
+    """
+    center_norms = (centers ** 2).sum(axis=1)
+    labels = np.empty(len(points), dtype=np.intp)
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start:start + chunk_size]
+        # |p - c|^2 = |p|^2 - 2 p.c + |c|^2, and |p|^2 doesn't change the argmin
+        labels[start:start + chunk_size] = (center_norms - 2 * chunk @ centers.T).argmin(axis=1)
+    return labels
+
+
+def _kmeans_plus_plus(points, k, rng):
+    centers = [points[rng.integers(len(points))]]
+    distances = ((points - centers[0]) ** 2).sum(axis=1)
+    for _ in range(1, k):
+        total = distances.sum()
+        i = rng.choice(len(points), p=distances / total) if total > 0 else rng.integers(len(points))
+        centers.append(points[i])
+        distances = np.minimum(distances, ((points - points[i]) ** 2).sum(axis=1))
+    return np.array(centers)
+
+
+def kmeans(points, k, seed=0, max_iter=100, tol=1e-4, init_sample=10_000):
+    """
+    Clusters the rows of points into k clusters (Lloyd's algorithm, seeded by
+    k-means++ on a sample of init_sample points). Stops once fewer than a tol
+    fraction of the points change cluster. Returns the cluster of every point
+    and the cluster centers.
+    """
+    rng = np.random.default_rng(seed)
+    k = min(k, len(points))
+    sample = points[rng.choice(len(points), min(len(points), init_sample), replace=False)]
+    centers = _kmeans_plus_plus(sample, k, rng)
+
+    labels = None
+    for _ in range(max_iter):
+        new_labels = _nearest(points, centers)
+        if labels is not None and np.count_nonzero(new_labels != labels) <= tol * len(points):
+            break
+        labels = new_labels
+        counts = np.bincount(labels, minlength=k)
+        sums = np.stack([np.bincount(labels, weights=points[:, d], minlength=k) for d in range(points.shape[1])], axis=1)
+        # An empty cluster keeps its center
+        centers = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centers)
+    return new_labels, centers
+
+
+def segment_customers(sales, customers, k=N_SEGMENTS, seed=0):
+    """
+    Segments the customers of the sales. Returns a dict of:
+        profiles     one row per segment (size, average RFM and age, revenue share)
+        cube         the revenue and transactions per Year x mall x segment
+        assignments  the segment number of every customer_key (-1 without any sale)
+    Segments are numbered by average spend, "Segment 1" spending the most.
+    """
+    features = rfm_features(sales, customers)
+    points = features[FEATURES].to_numpy(dtype=np.float64, copy=True)
+    points[:, 3] = np.where(np.isnan(points[:, 3]), np.nanmedian(points[:, 3]), points[:, 3])
+    # RFM values are heavily skewed, so they are clustered on a log scale,
+    # then every feature is standardized so none dominates the distances
+    points[:, :3] = np.log1p(points[:, :3])
+    points = (points - points.mean(axis=0)) / np.where(points.std(axis=0) > 0, points.std(axis=0), 1)
+    labels, _ = kmeans(points, k, seed=seed)
+
+    # Number the clusters by decreasing average spend
+    spend = np.bincount(labels, weights=features['monetary'].to_numpy()) / np.maximum(np.bincount(labels), 1)
+    rank = np.empty(len(spend), dtype=np.intp)
+    rank[np.argsort(-spend)] = np.arange(len(spend))
+    names = [f'Segment {i + 1}' for i in range(len(spend))]
+    segment = pd.Categorical.from_codes(rank[labels], categories=names)
+
+    profiles = (
+        features.assign(segment=segment)
+        .groupby('segment', observed=True)
+        .agg(customers=('customer_key', 'size'), recency=('recency', 'mean'), frequency=('frequency', 'mean'),
+             monetary=('monetary', 'mean'), age=('age', 'mean'), revenue=('monetary', 'sum'))
+        .reset_index()
+    )
+    profiles['revenue_share'] = profiles['revenue'] / profiles['revenue'].sum() * 100
+
+    assignments = np.full(len(customers), -1, dtype=np.int8)
+    assignments[features['customer_key'].to_numpy()] = rank[labels]
+    keys = sales['customer_key'].to_numpy()
+    codes = np.where(keys >= 0, assignments[keys], -1)
+    cube = (
+        pd.DataFrame({
+            'Year': sales['Year'].to_numpy(),
+            'shopping_mall': sales['shopping_mall'].to_numpy(),
+            'segment': pd.Categorical.from_codes(codes, categories=names),
+            'price': sales['price'].to_numpy().astype(np.float64).round(2),
+            'invoice_no': 1,
+        })
+        .groupby(['Year', 'shopping_mall', 'segment'], observed=True)[['price', 'invoice_no']].sum()
+        .reset_index()
+    )
+    return {'profiles': profiles, 'cube': cube, 'assignments': assignments}
+
+
+class SegmentationJob:
+    """
+    Runs a segmentation in a background thread, at most once per data version,
+    and keeps the results of the last few versions. A segmentation that raised
+    is not run again for its version, its error is kept instead.
+    """
+    def __init__(self, keep=2):
+        self.keep = keep
+        self._results = OrderedDict()
+        self._errors = OrderedDict()
+        self._running = None
+        self._lock = threading.Lock()
+
+    def get(self, version):
+        """
+        Returns the result of version, or None while it is not computed
+        """
+        with self._lock:
+            return self._results.get(version)
+
+    def latest(self, version):
+        """
+        Returns the result of the newest version up to version, or None when
+        none is computed yet
+        """
+        with self._lock:
+            done = [done for done in self._results if done <= version]
+            return self._results[max(done)] if done else None
+
+    def error(self, version):
+        """
+        Returns the exception the segmentation of version raised, or None
+        """
+        with self._lock:
+            return self._errors.get(version)
+
+    def request(self, version, compute):
+        """
+        Starts compute() in the background for version, unless it already
+        ran or runs. The result is then returned by get(version).
+        """
+        with self._lock:
+            if version in self._results or version in self._errors or self._running == version:
+                return
+            self._running = version
+        threading.Thread(target=self._run, args=(version, compute), name=f'segmentation-{version}', daemon=True).start()
+
+    def _run(self, version, compute):
+        result = error = None
+        try:
+            result = compute()
+        except Exception as e:
+            logger.exception('Segmentation of data version %s failed', version)
+            error = e
+        with self._lock:
+            if self._running == version:
+                self._running = None
+            store = self._results if error is None else self._errors
+            store[version] = result if error is None else error
+            while len(store) > self.keep:
+                store.popitem(last=False)
@@ -0,0 +1,387 @@
+"""
+The read-only frames shared by every session, and by every worker process.
+
+A SharedFrame answers the dashboard filters from positional indexes instead
+of scanning or copying the whole frame. With MALL_SHARED_DATA=1 the sales
+frame is not loaded into each worker at all: its columns are memory-mapped
+read-only, zero-copy, from the Feather cache of dataset_cache.py, and so are
+its indexes, saved as .npy files next to the cache by the first worker that
+needs them. Every worker then shares the same pages of the OS page cache,
+so an extra worker costs neither the memory nor the load time of a copy.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+
+from dataset_cache import attach_feather, cache_lock, concat_frames, replacing
+from dimensions import UnknownSelection
+
+
+def freeze_frame(df):
+    """
+    Rebuilds a frame on top of read-only column arrays, so an in-place write
+    to data shared by every session raises instead of silently changing it.
+    Arrays that are read-only already (e.g. memory-mapped) are not copied.
+    """
+    columns = {}
+    for col in df.columns:
+        values = df[col].array
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            codes = values.codes
+            if not isinstance(codes.base, np.ndarray) or codes.base.flags.writeable:
+                codes = np.array(codes)
+                codes.setflags(write=False)
+            values = pd.Categorical.from_codes(codes, dtype=df[col].dtype, validate=False)
+        elif isinstance(df[col].dtype, np.dtype):
+            values = df[col].to_numpy()
+            if values.flags.writeable:
+                values = values.copy()
+                values.setflags(write=False)
+        columns[col] = values
+    return pd.DataFrame(columns, index=df.index, copy=False)
+
+
+def _position_dtype(rows):
+    return np.int32 if rows < np.iinfo(np.int32).max else np.int64
+
+
+class ColumnIndex:
+    """
+    The row positions of every value of a column, stored as one array of
+    positions grouped by value (each group in ascending order) and the
+    offsets of each group, so looking a value up is a slice, not a copy
+    """
+    def __init__(self, keys, order, offsets):
+        self._lookup = {key: i for i, key in enumerate(keys)}
+        self.keys = list(keys)
+        self.order = order
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, column):
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            keys, codes = column.cat.categories.tolist(), np.asarray(column.cat.codes)
+        else:
+            keys, codes = np.unique(column.to_numpy(), return_inverse=True)
+            keys = keys.tolist()
+        order = np.argsort(codes, kind='stable').astype(_position_dtype(len(column)))
+        # Missing values (code -1) sort first and are left out of every group
+        order = order[np.count_nonzero(codes < 0):]
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(codes[codes >= 0], minlength=len(keys)), out=offsets[1:])
+        order.setflags(write=False)
+        return cls(keys, order, offsets)
+
+    @classmethod
+    def empty(cls):
+        return cls([], np.empty(0, dtype=np.int32), np.zeros(1, dtype=np.int64))
+
+    def extended(self, column, start):
+        """
+        Returns a new index with the rows of column added at the positions
+        from start on, after every row of this one. Only the new rows are
+        sorted, each group is then moved to its new offset.
+        """
+        added = ColumnIndex.build(column)
+        keys = self.keys + [key for key in added.keys if key not in self._lookup]
+        lookup = {key: i for i, key in enumerate(keys)}
+        slots = np.array([lookup[key] for key in added.keys], dtype=np.intp)
+        counts = np.zeros(len(keys), dtype=np.int64)
+        counts[:len(self.keys)] = np.diff(self.offsets)
+        added_counts = np.diff(added.offsets)
+        totals = counts.copy()
+        totals[slots] += added_counts
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(totals, out=offsets[1:])
+
+        order = np.empty(offsets[-1], dtype=_position_dtype(start + len(column)))
+        shifts = offsets[:len(self.keys)] - self.offsets[:-1]
+        order[np.arange(len(self.order)) + np.repeat(shifts, counts[:len(self.keys)])] = self.order
+        shifts = offsets[slots] + counts[slots] - added.offsets[:-1]
+        order[np.arange(len(added.order)) + np.repeat(shifts, added_counts)] = added.order + start
+        order.setflags(write=False)
+        return ColumnIndex(keys, order, offsets)
+
+    def __contains__(self, key):
+        return key in self._lookup
+
+    def __getitem__(self, key):
+        i = self._lookup[key]
+        return self.order[self.offsets[i]:self.offsets[i + 1]]
+
+
+class SharedFrame:
+    """
+    A read-only frame shared by every session.
+    The rows are only handed out through rows(), which answers the filters
+    from positional indexes built once per column in index_columns and
+    returns a take() slice (or a copy-on-write view when nothing is filtered),
+    so sessions never copy nor mutate the whole frame.
+    A frame sorted by its sorted_by column also answers ranges of that column
+    with rows_between(), by binary search.
+    The rows added by merged() are kept in a separate tail after the frame,
+    with indexes of their own, so the frame (memory-mapped with
+    MALL_SHARED_DATA=1) and its indexes are never copied by new sales.
+    """
+    def __init__(self, df, index_columns=(), indexes=None, sorted_by=None, tail=None, tail_indexes=None):
+        self._frame = freeze_frame(df)
+        self._index_columns = list(index_columns)
+        self._indexes = indexes or {col: ColumnIndex.build(self._frame[col]) for col in index_columns}
+        self._sorted_by = sorted_by
+        if sorted_by is not None and not self._frame[sorted_by].is_monotonic_increasing:
+            raise ValueError(f'the frame is not sorted by {sorted_by}')
+        # The rows after the frame, indexed at their positions in the whole
+        self._tail = None if tail is None else freeze_frame(tail)
+        self._tail_indexes = tail_indexes
+
+    @classmethod
+    def attach(cls, feather_path, index_columns=(), sorted_by=None):
+        """
+        Returns the SharedFrame of a Feather file written by dataset_cache.py,
+        memory-mapping its columns and indexes instead of reading them
+        """
+        df = attach_feather(feather_path)
+        return cls(df, index_columns, indexes=attach_indexes(feather_path, df, index_columns), sorted_by=sorted_by)
+
+    def __len__(self):
+        return len(self._frame) + (0 if self._tail is None else len(self._tail))
+
+    @property
+    def columns(self):
+        return self._frame.columns
+
+    def last(self, col):
+        """
+        The value of col in the last row
+        """
+        return self._slice(len(self) - 1, len(self))[col].iloc[0]
+
+    def categories(self, col):
+        """
+        The categories of a categorical column, whose positions are their codes
+        """
+        return self._frame[col].cat.categories
+
+    def positions(self, **filters):
+        """
+        Returns the sorted row positions matching every filter, where each
+        filter maps an indexed column to the list of values to keep.
+        Returns None when no filter is given. Raises UnknownSelection for a
+        value the column doesn't hold.
+        """
+        positions = None
+        for col, values in filters.items():
+            indexes = [self._indexes[col]] + ([] if self._tail is None else [self._tail_indexes[col]])
+            unknown = [value for value in values if not any(value in index for index in indexes)]
+            if unknown:
+                raise UnknownSelection(f'no {col} {", ".join(map(repr, unknown))} in the data')
+            matches = [index[value] for value in values for index in indexes if value in index]
+            matches = np.sort(np.concatenate(matches)) if matches else np.empty(0, dtype=np.intp)
+            positions = matches if positions is None else np.intersect1d(positions, matches, assume_unique=True)
+        return positions
+
+    def with_columns(self, **columns):
+        """
+        Returns a SharedFrame with extra columns, sharing the columns and indexes of this one
+        """
+        size = len(self._frame)
+        return SharedFrame(
+            self._frame.assign(**{col: values[:size] for col, values in columns.items()}), self._index_columns,
+            indexes=self._indexes, sorted_by=self._sorted_by,
+            tail=None if self._tail is None else self._tail.assign(**{col: values[size:] for col, values in columns.items()}),
+            tail_indexes=self._tail_indexes
+        )
+
+    def _slice(self, lo, hi):
+        """
+        The rows from position lo to hi, a copy-on-write view unless they
+        span both the frame and the tail
+        """
+        size = len(self._frame)
+        if self._tail is None or hi <= size:
+            return self._frame.iloc[lo:hi]
+        if lo >= size:
+            return self._tail.iloc[lo - size:hi - size]
+        return pd.concat([self._frame.iloc[lo:], self._tail.iloc[:hi - size]])
+
+    def _take(self, positions):
+        size = len(self._frame)
+        if self._tail is None or not len(positions) or positions[-1] < size:
+            return self._frame.take(positions)
+        split = np.searchsorted(positions, size)
+        if split == 0:
+            return self._tail.take(positions - size)
+        return pd.concat([self._frame.take(positions[:split]), self._tail.take(positions[split:] - size)])
+
+    def rows(self, **filters):
+        """
+        Returns the rows matching the filters (see positions())
+        """
+        positions = self.positions(**filters)
+        if positions is None:
+            return self._slice(0, len(self))
+        return self._take(positions)
+
+    def bounds(self, start, stop):
+        """
+        Returns the first and last + 1 row positions whose sorted_by value is
+        in [start, stop), found by binary search
+        """
+        lo = hi = 0
+        for part in [self._frame] + ([] if self._tail is None else [self._tail]):
+            values = part[self._sorted_by].to_numpy()
+            part_lo, part_hi = np.searchsorted(values, np.asarray([start, stop], dtype=values.dtype))
+            lo, hi = lo + int(part_lo), hi + int(part_hi)
+        return lo, max(lo, hi)
+
+    def rows_between(self, start, stop, **filters):
+        """
+        Returns the rows whose sorted_by value is in [start, stop) matching
+        the filters (see positions()). Without filters they are a contiguous
+        slice of the frame, so the query costs O(log n) and no copy.
+        """
+        lo, hi = self.bounds(start, stop)
+        positions = self.positions(**filters)
+        if positions is None:
+            return self._slice(lo, hi)
+        return self._take(positions[np.searchsorted(positions, lo):np.searchsorted(positions, hi)])
+
+    def chunks_between(self, start, stop, size, **filters):
+        """
+        Yields the rows of rows_between() in frames of at most size rows, so
+        a large selection is never copied as a whole
+        """
+        lo, hi = self.bounds(start, stop)
+        positions = self.positions(**filters)
+        if positions is None:
+            for first in range(lo, hi, size):
+                yield self._slice(first, min(first + size, hi))
+            return
+        positions = positions[np.searchsorted(positions, lo):np.searchsorted(positions, hi)]
+        for first in range(0, len(positions), size):
+            yield self._take(positions[first:first + size])
+
+    def merged(self, df):
+        """
+        Returns a new SharedFrame with the rows of df added, kept sorted by
+        sorted_by. The frame itself is left untouched, so sessions still
+        reading it are not affected.
+        New rows that come after every existing one only extend the tail and
+        its indexes; older ones are merged and sorted into a new whole frame.
+        """
+        sort_column = self._sorted_by
+        if sort_column is not None and len(self) and len(df):
+            if df[sort_column].min() < self.last(sort_column):
+                merged = concat_frames(self.rows(), df).sort_values(sort_column, kind='stable', ignore_index=True)
+                return SharedFrame(merged, index_columns=self._index_columns, sorted_by=sort_column)
+            if not df[sort_column].is_monotonic_increasing:
+                df = df.sort_values(sort_column, kind='stable')
+
+        tail = self._frame.iloc[:0] if self._tail is None else self._tail
+        tail_indexes = self._tail_indexes or {col: ColumnIndex.empty() for col in self._index_columns}
+        start = len(self)
+        # Starting from the empty frame keeps its categories first, so the
+        # codes of the frame still hold with the categories of the new rows
+        tail = concat_frames(self._frame.iloc[:0], tail, df)
+        tail.index = pd.RangeIndex(len(self._frame), len(self._frame) + len(tail))
+        added = tail.iloc[start - len(self._frame):]
+        frame = self._frame.assign(**{
+            col: pd.Categorical.from_codes(self._frame[col].array.codes, dtype=tail[col].dtype, validate=False)
+            for col in tail.columns
+            if isinstance(tail[col].dtype, pd.CategoricalDtype) and tail[col].dtype != self._frame[col].dtype
+        })
+        return SharedFrame(
+            frame, self._index_columns, indexes=self._indexes, sorted_by=sort_column, tail=tail,
+            tail_indexes={col: index.extended(added[col], start) for col, index in tail_indexes.items()}
+        )
+
+
+def is_newer(path, sources):
+    """
+    Checks whether the file at path exists and is at least as recent as every source file
+    """
+    return os.path.exists(path) and all(os.stat(path).st_mtime_ns >= os.stat(source).st_mtime_ns for source in sources)
+
+
+def cached_array(path, sources, build):
+    """
+    Memory-maps the .npy file at path, first writing build() to it when it is
+    missing or older than any of the source files it is derived from
+    """
+    if not is_newer(path, sources):
+        with cache_lock(os.path.dirname(path)):
+            if not is_newer(path, sources):
+                with replacing(path, suffix='.tmp.npy') as tmp_path:
+                    np.save(tmp_path, build())
+    return np.load(path, mmap_mode='r')
+
+
+def cached_frame(path, sources, build):
+    """
+    Returns the frame of the Feather file at path, first writing build() to it
+    when it is missing or older than any of the source files it is derived from
+    """
+    if not is_newer(path, sources):
+        with cache_lock(os.path.dirname(path)):
+            if not is_newer(path, sources):
+                with replacing(path) as tmp_path:
+                    feather.write_feather(build(), tmp_path, compression='uncompressed')
+    return feather.read_feather(path)
+
+
+def _index_paths(feather_path, col):
+    base = os.path.splitext(feather_path)[0]
+    return f'{base}.index.json', f'{base}.{col}.order.npy'
+
+
+def _saved_index(feather_path, col, source):
+    """
+    The saved keys and offsets of the index of a column, None when they are
+    missing or older than the Feather file
+    """
+    meta_path, order_path = _index_paths(feather_path, col)
+    if not (os.path.exists(meta_path) and os.path.exists(order_path)):
+        return None
+    with open(meta_path) as f:
+        saved = json.load(f).get(col)
+    return saved if saved is not None and saved['source_mtime_ns'] == source else None
+
+
+def _save_index(feather_path, col, source, column):
+    """
+    Builds and saves the index of a column, with the cache folder locked
+    since the indexes of every column share one meta file
+    """
+    meta_path, order_path = _index_paths(feather_path, col)
+    index = ColumnIndex.build(column)
+    with replacing(order_path, suffix='.tmp.npy') as tmp_path:
+        np.save(tmp_path, index.order)
+    meta = {}
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+    meta[col] = {'source_mtime_ns': source, 'keys': index.keys, 'offsets': index.offsets.tolist()}
+    with replacing(meta_path) as tmp_path:
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+    return meta[col]
+
+
+def attach_indexes(feather_path, df, index_columns):
+    """
+    Memory-maps the saved indexes of the columns of a Feather file, building
+    and saving the ones missing or older than the file
+    """
+    source = os.stat(feather_path).st_mtime_ns
+    indexes = {}
+    for col in index_columns:
+        saved = _saved_index(feather_path, col, source)
+        if saved is None:
+            with cache_lock(os.path.dirname(feather_path)):
+                saved = _saved_index(feather_path, col, source) or _save_index(feather_path, col, source, df[col])
+        indexes[col] = ColumnIndex(saved['keys'], np.load(_index_paths(feather_path, col)[1], mmap_mode='r'),
+                                   np.array(saved['offsets']))
+    return indexes
@@ -0,0 +1,95 @@
+"""
+Background startup of the dashboard.
+
+Loading the datasets and importing the plotting stack (plotnine, matplotlib,
+and through them scipy and statsmodels) take seconds, so ShinyApp.py only
+builds the UI and the app at import. The rest runs in a background thread
+through STARTUP.run_in_background(), started when the app starts serving (or
+by the scripts that need the data), so importing ShinyApp.py loads nothing.
+The page and the 'Dashboard Description' tab are served right away, the outputs showing data wait for STARTUP.ready,
+and /ready answers 503 until then.
+
+IMPORT_BUDGET_SECONDS is the import time of ShinyApp.py that benchmark.py
+checks, to catch whatever slips back onto the import path.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+IMPORT_BUDGET_SECONDS = float(os.environ.get('MALL_IMPORT_BUDGET', '1.5'))
+
+logger = logging.getLogger('mall.startup')
+
+
+class Startup:
+    """
+    The state of the background startup: 'loading', then 'ready' or 'failed',
+    with the time every step took
+    """
+    def __init__(self):
+        self.state = 'loading'
+        self.error = None
+        self.steps = {}
+        self.started = time.perf_counter()
+        self.seconds = None
+        self._done = threading.Event()
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self.state == 'ready'
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @contextmanager
+    def step(self, name):
+        """
+        Times one step of the startup into steps
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps[name] = time.perf_counter() - start
+            logger.info('startup: %s took %.2fs', name, self.steps[name])
+
+    def run_in_background(self, load, after=None):
+        """
+        Runs load() in a daemon thread, then marks the startup ready (or
+        failed when load() raised) and runs after(), e.g. a cache warm-up
+        nobody needs to wait for. Only the first call starts anything.
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, args=(load, after), name='startup', daemon=True)
+        self._thread.start()
+
+    def _run(self, load, after):
+        try:
+            load()
+            self.state = 'ready'
+        except Exception as e:
+            logger.exception('startup failed')
+            self.error = f'{type(e).__name__}: {e}'
+            self.state = 'failed'
+        finally:
+            self.seconds = time.perf_counter() - self.started
+            self._done.set()
+        if self.ready and after is not None:
+            after()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the startup is done, raising RuntimeError when it failed
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError(f'startup still loading after {timeout}s')
+        if not self.ready:
+            raise RuntimeError(f'startup failed: {self.error}')
+
+
+STARTUP = Startup()
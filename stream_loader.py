@@ -0,0 +1,275 @@
+"""
+Streaming load of sales_data.csv, for exports too large to parse in one go.
+
+read_csv() of the whole file, then its date conversion and sort, peak at
+several times the size of the final frame. With MALL_STREAMING_LOAD=1 the
+sales are instead read in chunks sized to fit under MALL_LOAD_MEMORY_MB:
+every chunk is parsed, joined to its customers and added to the sales and
+customer cubes, then only the columns the dashboard filters on are kept, as
+compact arrays. The invoice_no and customer_id strings, by far the largest
+columns, are dropped once the cubes and the customer_key join are done.
+
+There is no global sort: every chunk is sorted by invoice_date, and when
+chunks overlap in time (exports are usually written in date order already)
+the kept rows are put in date order by a counting sort over the days, moving
+one column at a time.
+
+The result is written as Feather files next to the CSV cache and
+memory-mapped on later boots, until sales_data.csv or customer_data.csv change.
+"""
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from aggregates import add_to_sales_cube, build_sales_cube
+from customers import add_to_customer_cube, build_customer_cube
+from dataset_cache import SALES_CSV_DTYPES, cache_lock, cache_paths, parse_sales, replacing, source_fingerprint
+from shared_frame import is_newer
+
+MEMORY_LIMIT_MB = int(os.environ.get('MALL_LOAD_MEMORY_MB', '256'))
+
+# The columns kept per sale, and their bytes per row
+KEPT_COLUMNS = {
+    'category': np.int16,
+    'quantity': np.int8,
+    'price': np.float32,
+    'invoice_date': 'datetime64[ns]',
+    'shopping_mall': np.int16,
+    'Month': np.int8,
+    'Year': np.int16,
+    'customer_key': np.int32,
+}
+CATEGORICAL_COLUMNS = ['category', 'shopping_mall']
+KEPT_BYTES_PER_ROW = sum(np.dtype(dtype).itemsize for dtype in KEPT_COLUMNS.values())
+# Reordering the rows by date takes their destinations and a copy of the widest column
+REORDER_BYTES_PER_ROW = 4 + max(np.dtype(dtype).itemsize for dtype in KEPT_COLUMNS.values())
+# Peak memory of parsing a chunk, relative to its size in the CSV (measured ~3.7x),
+# and the memory taken whatever the chunk size (parser buffers, groupby of the cubes)
+PARSE_OVERHEAD = 4
+FIXED_OVERHEAD_MB = 24
+MIN_CHUNK_ROWS = 10_000
+
+logger = logging.getLogger('mall.loader')
+
+
+def log_progress(progress):
+    logger.info(
+        'loading %s: %.0f%% (%s rows, chunk %s)', progress['path'], progress['fraction'] * 100,
+        f"{progress['rows']:,}", progress['chunks']
+    )
+
+
+def plan_chunks(csv_path, memory_limit_mb):
+    """
+    Estimates the rows of csv_path from its first MB, and returns that
+    estimate and the rows per chunk fitting the memory left once the kept
+    columns of every row are accounted for. Raises MemoryError when the kept
+    columns alone don't fit.
+    """
+    size = os.path.getsize(csv_path)
+    with open(csv_path, 'rb') as f:
+        header = f.readline()
+        sample = f.read(1 << 20)
+    line_bytes = len(sample) / max(sample.count(b'\n'), 1) if sample else 1
+    rows = int((size - len(header)) / line_bytes) + 1
+
+    kept_bytes = rows * (KEPT_BYTES_PER_ROW + REORDER_BYTES_PER_ROW)
+    budget = (memory_limit_mb - FIXED_OVERHEAD_MB) * 2 ** 20 - kept_bytes
+    chunk_rows = int(budget / (line_bytes * PARSE_OVERHEAD))
+    if chunk_rows < MIN_CHUNK_ROWS:
+        raise MemoryError(
+            f'{csv_path} holds about {rows:,} sales, whose kept columns alone need '
+            f'{kept_bytes / 2 ** 20:,.0f} MB (plus {FIXED_OVERHEAD_MB} MB to parse them): '
+            f'raise MALL_LOAD_MEMORY_MB above {memory_limit_mb}'
+        )
+    return rows, chunk_rows
+
+
+class _Columns:
+    """
+    The kept columns of the rows loaded so far, in arrays grown as needed
+    """
+    def __init__(self, capacity):
+        self.rows = 0
+        self.arrays = {col: np.empty(capacity, dtype=dtype) for col, dtype in KEPT_COLUMNS.items()}
+        self.categories = {col: None for col in CATEGORICAL_COLUMNS}
+
+    def _codes(self, col, values):
+        """
+        The codes of a chunk's categorical values in the categories seen so far
+        """
+        categories = values.cat.categories
+        if self.categories[col] is None:
+            self.categories[col] = categories
+        else:
+            self.categories[col] = self.categories[col].append(categories.difference(self.categories[col]))
+        remap = np.append(self.categories[col].get_indexer(categories), -1)
+        return remap[values.cat.codes.to_numpy()]
+
+    def append(self, chunk):
+        end = self.rows + len(chunk)
+        if end > len(self.arrays['price']):
+            capacity = max(end, int(len(self.arrays['price']) * 1.25))
+            for col, array in self.arrays.items():
+                grown = np.empty(capacity, dtype=array.dtype)
+                grown[:self.rows] = array[:self.rows]
+                self.arrays[col] = grown
+        for col, array in self.arrays.items():
+            values = self._codes(col, chunk[col]) if col in CATEGORICAL_COLUMNS else chunk[col].to_numpy()
+            array[self.rows:end] = values
+        self.rows = end
+
+    def _move(self, destination):
+        """
+        Moves every row to its destination, one column at a time, so only one column is ever copied
+        """
+        for col, array in self.arrays.items():
+            moved = np.empty(self.rows, dtype=array.dtype)
+            moved[destination] = array[:self.rows]
+            self.arrays[col] = moved
+
+    def sort_by_date(self, block_rows):
+        """
+        Stably sorts the rows by invoice_date. Sale dates are whole days, so
+        the destination of every row is computed by a counting sort over the
+        days, one block of rows at a time, and the only other memory taken is
+        one copy of a column. Dates with a time of day fall back to an argsort.
+        """
+        dates = self.arrays['invoice_date'][:self.rows]
+        starts = range(0, self.rows, block_rows)
+        if not all((dates[s:s + block_rows] == dates[s:s + block_rows].astype('datetime64[D]')).all() for s in starts):
+            order = np.argsort(dates, kind='stable')
+            destination = np.empty_like(order)
+            destination[order] = np.arange(self.rows)
+            return self._move(destination)
+
+        first_day = dates.min().astype('datetime64[D]')
+        n_days = int((dates.max().astype('datetime64[D]') - first_day).astype(np.int64)) + 1
+
+        def days(start):
+            return (dates[start:start + block_rows].astype('datetime64[D]') - first_day).astype(np.int64)
+
+        counts = np.zeros(n_days, dtype=np.int64)
+        for start in starts:
+            counts += np.bincount(days(start), minlength=n_days)
+        next_free = np.cumsum(counts) - counts
+
+        destination = np.empty(self.rows, dtype=np.int32 if self.rows < np.iinfo(np.int32).max else np.int64)
+        for start in starts:
+            block_days = days(start)
+            order = np.argsort(block_days, kind='stable')
+            sorted_days = block_days[order]
+            rank = np.arange(len(sorted_days)) - np.searchsorted(sorted_days, sorted_days)
+            destination[start:start + block_rows][order] = next_free[sorted_days] + rank
+            next_free += np.bincount(block_days, minlength=n_days)
+        self._move(destination)
+
+    def frame(self):
+        columns = {}
+        for col, array in self.arrays.items():
+            values = array[:self.rows]
+            if col in CATEGORICAL_COLUMNS:
+                values = pd.Categorical.from_codes(values, categories=self.categories[col], validate=False)
+            columns[col] = values
+        return pd.DataFrame(columns, copy=False)
+
+
+def load_sales_streaming(csv_path, customers, memory_limit_mb=MEMORY_LIMIT_MB, progress=log_progress):
+    """
+    Reads the sales CSV chunk by chunk. Returns the kept columns of every sale
+    (with its customer_key instead of its customer_id), the sales cube and the
+    customer cube. progress is called after every chunk with the fraction of
+    the file read, the rows and the chunks so far.
+    """
+    rows_estimate, chunk_rows = plan_chunks(csv_path, memory_limit_mb)
+    size = os.path.getsize(csv_path)
+    columns = _Columns(int(rows_estimate * 1.05) + 1)
+    cube = customer_cube = None
+    in_order, last_date = True, None
+
+    with open(csv_path, 'rb') as f:
+        for n, raw in enumerate(pd.read_csv(f, dtype=SALES_CSV_DTYPES, chunksize=chunk_rows), start=1):
+            chunk = parse_sales(raw)
+            del raw
+            chunk['customer_key'] = customers.keys(chunk['customer_id'])
+            if cube is None:
+                cube, customer_cube = build_sales_cube(chunk), build_customer_cube(chunk, customers)
+            else:
+                cube = add_to_sales_cube(cube, chunk)
+                customer_cube = add_to_customer_cube(customer_cube, chunk, customers)
+
+            if len(chunk):
+                first, last = chunk['invoice_date'].iloc[[0, -1]]
+                if last_date is not None and first < last_date:
+                    in_order = False
+                last_date = last if last_date is None else max(last_date, last)
+            columns.append(chunk)
+            # Hand the Arrow buffers of the chunk back to the OS before parsing the next one
+            del chunk
+            pa.default_memory_pool().release_unused()
+            if progress:
+                progress({'path': csv_path, 'fraction': min(f.tell() / size, 1.0) if size else 1.0,
+                          'rows': columns.rows, 'chunks': n})
+
+    if cube is None:
+        # Only a header: the cubes of no sales
+        empty = parse_sales(pd.read_csv(csv_path, dtype=SALES_CSV_DTYPES, nrows=0))
+        empty['customer_key'] = customers.keys(empty['customer_id'])
+        cube, customer_cube = build_sales_cube(empty), build_customer_cube(empty, customers)
+
+    if not in_order:
+        logger.info('chunks of %s overlap in time, reordering %s rows by invoice_date', csv_path, f'{columns.rows:,}')
+        columns.sort_by_date(chunk_rows)
+    return columns.frame(), cube, customer_cube
+
+
+def stream_cache_paths(csv_path):
+    """
+    Returns the Feather paths of the kept sales, the sales cube and the customer cube of csv_path
+    """
+    base = os.path.splitext(cache_paths(csv_path)[0])[0] + '.stream'
+    return base + '.feather', base + '.cube.feather', base + '.customer_cube.feather'
+
+
+def stream_fingerprint_path(csv_path):
+    return os.path.splitext(cache_paths(csv_path)[0])[0] + '.stream.json'
+
+
+def stream_fingerprint(csv_path):
+    """
+    Returns the fingerprint (mtime and size) of the sales file the streamed
+    cache of csv_path was built from, like cached_fingerprint() of dataset_cache.py
+    """
+    with open(stream_fingerprint_path(csv_path)) as f:
+        return json.load(f)
+
+
+def ensure_stream_cache(csv_path, customer_path, customers, memory_limit_mb=MEMORY_LIMIT_MB, progress=log_progress):
+    """
+    Streams csv_path into the files of stream_cache_paths(), unless they are
+    newer than both the sales and the customer CSV. Returns their paths.
+    The fingerprint of the streamed file is written last, next to them.
+    """
+    paths = stream_cache_paths(csv_path)
+    fingerprint_path = stream_fingerprint_path(csv_path)
+
+    def fresh():
+        return all(is_newer(path, [csv_path, customer_path]) for path in [*paths, fingerprint_path])
+
+    if fresh():
+        return paths
+    with cache_lock(os.path.dirname(paths[0])):
+        if not fresh():
+            fingerprint = source_fingerprint(csv_path, with_hash=False)
+            for path, df in zip(paths, load_sales_streaming(csv_path, customers, memory_limit_mb, progress)):
+                with replacing(path) as tmp_path:
+                    feather.write_feather(df, tmp_path, compression='uncompressed', chunksize=max(len(df), 1))
+            with replacing(fingerprint_path) as tmp_path:
+                with open(tmp_path, 'w') as f:
+                    json.dump(fingerprint, f)
+    return paths
@@ -0,0 +1,35 @@
+"""
+Fixtures of the tests: a small Datasets folder of generated sales, and the
+frames and cubes the app loads from it
+"""
+import os
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Nothing is drawn in the background of the tests
+os.environ.setdefault('MALL_WARMUP', '0')
+os.environ.setdefault('MALL_RENDER_WORKERS', '0')
+
+from benchmark import generate_sales_csv
+from dataset_cache import DATA_DIR
+
+SALES_ROWS = 5000
+
+
+def make_data_dir(path):
+    for name in ['shopping_mall_data.csv', 'customer_data.csv']:
+        shutil.copy(os.path.join(DATA_DIR, name), path)
+    generate_sales_csv(os.path.join(path, 'sales_data.csv'), SALES_ROWS)
+    return str(path)
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    """
+    A Datasets folder of SALES_ROWS generated sales and the mall details and
+    customers of the repo, without any cache yet
+    """
+    return make_data_dir(tmp_path)
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+
+import ShinyApp as app
+from aggregates import date_window
+from render_cache import render_plot_png
+from segments import segment_customers
+from shared_frame import SharedFrame
+
+
+def snapshot(data):
+    """
+    A deep copy of data: a SharedFrame, a frame, an array or a dict of these
+    """
+    if isinstance(data, dict):
+        return {key: snapshot(value) for key, value in data.items()}
+    if isinstance(data, SharedFrame):
+        return data.rows().copy(deep=True)
+    return data.copy(deep=True) if isinstance(data, pd.DataFrame) else np.array(data)
+
+
+def assert_unchanged(data, before):
+    if isinstance(data, dict):
+        for key, value in data.items():
+            assert_unchanged(value, before[key])
+    elif isinstance(data, np.ndarray):
+        np.testing.assert_array_equal(data, before)
+    else:
+        pd.testing.assert_frame_equal(data.rows() if isinstance(data, SharedFrame) else data, before)
+
+
+def test_mall_details_html_leaves_the_shared_details_unchanged(data_dir):
+    mall_details = app.prepare_datasets(data_dir)[1]
+    before = snapshot(mall_details)
+    mall = before['shopping_mall'].iloc[0]
+
+    html = str(app.mall_details_html(mall_details.rows(shopping_mall=[mall])))
+
+    assert f'{before["area (sqm)"].iloc[0]:,}' in html
+    assert_unchanged(mall_details, before)
+
+
+def test_charts_leave_their_shared_data_unchanged(data_dir):
+    app.load_plotting()
+    sales, mall_details, cube, customers, customer_cube, _ = app.prepare_datasets(data_dir)
+    sources = {
+        'sales': sales, 'cube': cube, 'customer_cube': customer_cube,
+        'segments': segment_customers(sales.rows(), customers),
+    }
+    last_day = sales.rows()['invoice_date'].iloc[-1].normalize()
+    window = date_window(app.DEFAULT_WINDOW, last_day.replace(month=1, day=1), last_day)
+    views = {**app.DEFAULT_VIEW, 'daily_revenue': (*(day.date().isoformat() for day in window), app.DEFAULT_MALL)}
+    before = snapshot({**sources, 'mall_details': mall_details})
+
+    for build in app.STATIC_PLOTS.values():
+        render_plot_png(build(mall_details.rows()), 400, 200)
+    for output_id, build in app.CHARTS.items():
+        render_plot_png(build(app.chart_data(sources, output_id, *views[output_id]), *views[output_id]), 400, 200)
+
+    assert_unchanged({**sources, 'mall_details': mall_details}, before)
@@ -0,0 +1,11 @@
+import ShinyApp as app
+import client_charts
+
+
+def test_monthly_mall_category_sales_without_category(data_dir):
+    _, _, cube, _, _, _ = app.prepare_datasets(data_dir)
+
+    spec = client_charts.monthly_mall_category_sales(cube, app.DEFAULT_YEAR, (), '')
+
+    assert spec['title'] == 'Select a specific category.'
+    assert spec['data']['values'] == []
@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pandas as pd
+
+import dataset_cache
+from dataset_cache import load_dataset, read_mall_csv
+from dimensions import Dimensions
+
+
+def test_a_same_size_rewrite_keeping_the_mtime_rebuilds_the_cache(data_dir):
+    mall_path = os.path.join(data_dir, 'shopping_mall_data.csv')
+    before = load_dataset(mall_path, read_mall_csv)
+    load_dataset(mall_path, read_mall_csv)
+    stat = os.stat(mall_path)
+    with open(mall_path) as f:
+        content = f.read()
+    first = before['location'].iloc[0]
+    with open(mall_path, 'w') as f:
+        f.write(content.replace(first, first[::-1], 1))
+    os.utime(mall_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    after = load_dataset(mall_path, read_mall_csv)
+
+    assert after['location'].iloc[0] == first[::-1]
+
+
+def test_prebuild_saves_the_dimensions(data_dir, monkeypatch):
+    dimensions_path = os.path.join(data_dir, '.cache', 'dimensions.json')
+    monkeypatch.setattr(dataset_cache, 'DATA_DIR', data_dir)
+    monkeypatch.setattr(dataset_cache, 'DIMENSIONS_PATH', dimensions_path)
+    monkeypatch.setattr(sys, 'argv', ['dataset_cache.py'])
+    monkeypatch.delenv('MALL_STREAMING_LOAD', raising=False)
+
+    dataset_cache.main()
+
+    sales = pd.read_csv(os.path.join(data_dir, 'sales_data.csv'))
+    dimensions = Dimensions.load(dimensions_path)
+    assert dimensions.malls == sorted(sales['shopping_mall'].unique())
+    assert dimensions.last_day == pd.to_datetime(sales['invoice date']).max().date().isoformat()
@@ -0,0 +1,34 @@
+import json
+import threading
+
+from render_cache import AccessLog
+
+
+class RecordingLog(AccessLog):
+    """
+    An AccessLog noting the threads it is saved from
+    """
+    saved_from = ()
+
+    def save(self):
+        self.saved_from += (threading.current_thread().name,)
+        super().save()
+
+
+def test_access_log_keeps_the_most_requested_views_and_saves_in_a_thread(tmp_path):
+    path = str(tmp_path / 'access_log.json')
+    log = RecordingLog(path, save_every=10, max_views=3)
+    for _ in range(5):
+        log.record('line_monthly_revenue', (('2023',), 'All'), 800, 400, 1)
+    for day in range(5):
+        log.record('daily_revenue', (f'2023-01-{day + 1:02d}', '2023-03-01', 'All'), 800, 400, 1)
+    for thread in threading.enumerate():
+        if thread.name == 'access-log':
+            thread.join()
+
+    assert log.saved_from == ('access-log',)
+    with open(path) as f:
+        entries = json.load(f)
+    assert len(entries) == 3
+    assert entries[0][:2] == ['line_monthly_revenue', [['2023'], 'All']]
+    assert len(AccessLog(path).top(10)) == 3
@@ -0,0 +1,39 @@
+import threading
+
+from segments import SegmentationJob
+
+
+def run(job, version, compute):
+    """
+    Requests version and waits for its background thread
+    """
+    job.request(version, compute)
+    for thread in threading.enumerate():
+        if thread.name == f'segmentation-{version}':
+            thread.join()
+
+
+def test_failed_segmentation_is_kept_and_not_retried():
+    job = SegmentationJob()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        raise ValueError('no customers')
+
+    run(job, 1, compute)
+    run(job, 1, compute)
+
+    assert len(calls) == 1
+    assert job.get(1) is None
+    assert str(job.error(1)) == 'no customers'
+
+
+def test_latest_falls_back_to_the_last_version_done():
+    job = SegmentationJob()
+    run(job, 1, lambda: 'first')
+
+    assert job.latest(1) == 'first'
+    assert job.latest(2) == 'first'
+    assert job.get(2) is None
+    assert job.latest(0) is None
@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import ShinyApp as app
+from dataset_cache import concat_frames
+from shared_frame import SharedFrame
+
+
+def sales(hours, start, malls):
+    rng = np.random.default_rng(hours)
+    return pd.DataFrame({
+        'invoice_date': pd.date_range(start, periods=hours, freq='h'),
+        'shopping_mall': pd.Categorical(rng.choice(malls, hours)),
+        'price': rng.random(hours),
+    })
+
+
+def test_merged_rows_extend_the_tail_like_a_rebuild():
+    first = sales(500, '2023-01-01', ['A', 'B'])
+    frame = SharedFrame(first, ['shopping_mall'], sorted_by='invoice_date')
+    added = [sales(20, '2023-02-01', ['B', 'C']), sales(30, '2023-03-01', ['C', 'D'])]
+    merged = frame
+    for rows in added:
+        merged = merged.merged(rows)
+    rebuilt = SharedFrame(concat_frames(first, *added), ['shopping_mall'], sorted_by='invoice_date')
+
+    assert len(merged) == len(rebuilt)
+    assert merged.categories('shopping_mall').tolist() == ['A', 'B', 'C', 'D']
+    for mall in ['A', 'B', 'C', 'D']:
+        assert np.array_equal(merged.positions(shopping_mall=[mall]), rebuilt.positions(shopping_mall=[mall]))
+    start, stop = pd.Timestamp('2023-01-20'), pd.Timestamp('2023-03-02')
+    assert merged.bounds(start, stop) == rebuilt.bounds(start, stop)
+    pd.testing.assert_frame_equal(merged.rows_between(start, stop), rebuilt.rows_between(start, stop))
+    pd.testing.assert_frame_equal(
+        merged.rows_between(start, stop, shopping_mall=['B', 'C']), rebuilt.rows_between(start, stop, shopping_mall=['B', 'C'])
+    )
+    # The first frame and its indexes are shared, not copied
+    january = pd.Timestamp('2023-01-01'), pd.Timestamp('2023-01-10')
+    assert np.shares_memory(merged.rows_between(*january)['price'].to_numpy(), frame.rows()['price'].to_numpy())
+    assert merged._indexes is frame._indexes
+
+
+def test_merged_older_rows_are_sorted_in():
+    frame = SharedFrame(sales(500, '2023-01-01', ['A', 'B']), ['shopping_mall'], sorted_by='invoice_date')
+    merged = frame.merged(sales(3, '2023-01-05', ['C']))
+
+    assert len(merged) == 503
+    assert merged.rows()['invoice_date'].is_monotonic_increasing
+    assert len(merged.rows(shopping_mall=['C'])) == 3
+
+
+def appended(frame):
+    """
+    The last rows of a SharedFrame again, a day later, to merge into it
+    """
+    rows = frame.rows().iloc[-3:]
+    return rows.assign(invoice_date=rows['invoice_date'] + pd.Timedelta(days=1))
+
+
+@pytest.mark.parametrize('mode', ['memory', 'shared', 'streaming'])
+def test_writes_to_the_shared_sales_raise_or_leave_them_unchanged(data_dir, monkeypatch, mode):
+    monkeypatch.setattr(app, 'SHARED_DATA', mode == 'shared')
+    monkeypatch.setattr(app, 'STREAMING_LOAD', mode == 'streaming')
+    loaded = app.prepare_datasets(data_dir)[0]
+
+    for sales in [loaded, loaded.merged(appended(loaded))]:
+        before = sales.rows().copy(deep=True)
+        mall = before['shopping_mall'].iloc[-1]
+        last_day = before['invoice_date'].iloc[-1]
+        for rows in [
+            sales.rows(), sales.rows(shopping_mall=[mall]), sales.rows_between(last_day - pd.Timedelta(days=30), last_day),
+        ]:
+            rows.loc[rows.index[0], 'price'] = -1
+            rows.iloc[-1, rows.columns.get_loc('category')] = rows['category'].iloc[0]
+            rows['quantity'] = 0
+        for values in [sales.rows()['price'].to_numpy(), sales.rows()['price'].values, sales.rows()['Year'].to_numpy()]:
+            with pytest.raises(ValueError):
+                values[-1] = 0
+
+        pd.testing.assert_frame_equal(sales.rows(), before)
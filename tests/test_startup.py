@@ -0,0 +1,8 @@
+import threading
+
+import ShinyApp as app
+
+
+def test_importing_the_app_loads_nothing():
+    assert app.STARTUP.state == 'loading'
+    assert not any(thread.name == 'startup' for thread in threading.enumerate())
@@ -0,0 +1,36 @@
+import os
+
+import ShinyApp as app
+from conftest import SALES_ROWS
+from dataset_cache import cache_paths, read_sales_rows
+from stream_loader import stream_fingerprint
+
+
+def test_streaming_startup_from_an_empty_cache(data_dir, monkeypatch):
+    monkeypatch.setattr(app, 'STREAMING_LOAD', True)
+    sales_path = os.path.join(data_dir, 'sales_data.csv')
+
+    sales, _, cube, _, _, _ = app.prepare_datasets(data_dir)
+
+    assert len(sales) == SALES_ROWS
+    assert cube['invoice_no'].sum() == SALES_ROWS
+    # The offset appended rows are read from is the one of the streamed file,
+    # the CSV cache of the non-streaming load is never written
+    assert app.sales_fingerprint(sales_path) == stream_fingerprint(sales_path)
+    assert stream_fingerprint(sales_path)['size'] == os.path.getsize(sales_path)
+    assert not os.path.exists(cache_paths(sales_path)[1])
+
+
+def test_streaming_ingest_reads_only_appended_rows(data_dir, monkeypatch):
+    monkeypatch.setattr(app, 'STREAMING_LOAD', True)
+    sales_path = os.path.join(data_dir, 'sales_data.csv')
+    app.prepare_datasets(data_dir)
+    with open(sales_path) as f:
+        appended = f.readlines()[1:4]
+    with open(sales_path, 'a') as f:
+        f.writelines(appended)
+
+    rows, size = read_sales_rows(sales_path, app.sales_fingerprint(sales_path)['size'])
+
+    assert len(rows) == 3
+    assert size == os.path.getsize(sales_path)